@@ -0,0 +1,148 @@
+# admission.py
+"""
+Admission control and request deadlines for the QA endpoint
+
+At most `max_in_flight` questions are answered at once, and at most
+`max_queued` more wait (for no longer than `queue_timeout`) for a slot.
+Anything beyond that is shed immediately, so that a burst turns into fast
+503s instead of a queue that makes every request late.
+
+Each admitted request carries a `Deadline`, checked between the stages of
+answering (retrieval, inference), so work for a client that gave up
+or timed out stops at the next stage boundary.
+"""
+
+import asyncio
+import time
+from typing import Callable, Dict, Optional, List, Iterable
+
+class Overloaded(RuntimeError):
+    """Raised when a request can't be admitted."""
+    retry_after: int
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class DeadlineExceeded(RuntimeError):
+    """Raised when a request's deadline passed (or its client went away)."""
+    stage: str
+    abandoned: bool
+
+    def __init__(self, stage: str, abandoned: bool = False):
+        reason = 'client went away' if abandoned else 'deadline exceeded'
+        super().__init__(f'{reason} before {stage}')
+        self.stage = stage
+        self.abandoned = abandoned
+
+class Deadline:
+    """Point in time by which a request must be answered."""
+    expires: float
+    is_abandoned: Callable[[], bool]
+
+    def __init__(
+            self, timeout: float,
+            is_abandoned: Optional[Callable[[], bool]] = None
+        ):
+        self.expires = time.monotonic() + timeout
+        self.is_abandoned = is_abandoned or (lambda: False)
+
+    def remaining(self) -> float:
+        return self.expires - time.monotonic()
+
+    def check(self, stage: str):
+        """Raise DeadlineExceeded if `stage` shouldn't be started."""
+        if self.is_abandoned():
+            raise DeadlineExceeded(stage, abandoned=True)
+        if self.remaining() <= 0:
+            raise DeadlineExceeded(stage)
+
+class GroupDeadline(Deadline):
+    """Deadline of work shared by several requests.
+
+    The work may go on while any member request still has time left and
+    hasn't been abandoned by its client.
+    """
+    members: List[Deadline]
+
+    def __init__(self, members: Iterable[Deadline] = ()):
+        super().__init__(0., self._all_abandoned)
+        self.members = list(members)
+
+    def add(self, member: Deadline):
+        self.members.append(member)
+
+    def remaining(self) -> float:
+        live = [m.remaining() for m in self.members if not m.is_abandoned()]
+        return max(live, default=0.)
+
+    def _all_abandoned(self) -> bool:
+        return all(m.is_abandoned() for m in self.members)
+
+class AdmissionController:
+    """Bounded in-flight limit with a short, bounded wait queue."""
+    max_in_flight: int
+    max_queued: int
+    queue_timeout: float
+    retry_after: int
+    in_flight: int
+    queued: int
+    counts: Dict[str,int]
+
+    def __init__(
+            self, max_in_flight: int, max_queued: int, queue_timeout: float,
+            retry_after: int = 1
+        ):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.queued = 0
+        self.counts = {'admitted': 0, 'shed': 0, 'expired': 0, 'abandoned': 0}
+        self._slots = asyncio.Semaphore(max_in_flight)
+
+    def _shed(self, reason: str) -> Overloaded:
+        self.counts['shed'] += 1
+        return Overloaded(f'server overloaded ({reason})', self.retry_after)
+
+    async def acquire(self, deadline: Deadline):
+        """Wait for an in-flight slot, or raise Overloaded.
+
+        Raises DeadlineExceeded instead if the deadline passes first, which
+        is the client's limit, not a sign of overload.
+        """
+        deadline.check('admission')
+        if self._slots.locked() and self.queued >= self.max_queued:
+            raise self._shed('queue full')
+        remaining = deadline.remaining()
+        self.queued += 1
+        try:
+            await asyncio.wait_for(
+                self._slots.acquire(), min(self.queue_timeout, remaining)
+            )
+        except asyncio.TimeoutError:
+            if remaining < self.queue_timeout:
+                raise DeadlineExceeded('admission')
+            raise self._shed('no slot in time')
+        finally:
+            self.queued -= 1
+        self.in_flight += 1
+        self.counts['admitted'] += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._slots.release()
+
+    def record_expired(self, e: DeadlineExceeded):
+        self.counts['abandoned' if e.abandoned else 'expired'] += 1
+
+    def stats(self) -> Dict[str,int]:
+        stats = dict(self.counts)
+        stats.update({
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'max_in_flight': self.max_in_flight,
+            'max_queued': self.max_queued,
+        })
+        return stats
@@ -0,0 +1,250 @@
+# analysis.py
+"""
+Local emulation of the index's text analysis
+
+`analyze` turns a query into the terms ES would search for, without asking
+ES: the standard tokenizer, then (for `stem` indices, see `recreate_index`)
+the `asciifolding`, `lowercase` and `porter_stem` filters of `myanalyzer`,
+or just `lowercase` for the standard analyzer.
+
+It only has to be exact in one direction: two queries with the same terms
+here must have the same terms in ES.  So wherever the emulation isn't sure
+it errs towards keeping text apart: words joined by punctuation stay one
+term, only plain a-z words are stemmed, and a query with characters it
+doesn't know how ES tokenizes (symbols, emoji, combining marks...) isn't
+analyzed at all (None).
+"""
+
+import re
+import string
+import unicodedata
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+# words joined by these (as in `don't`, `3.14`, `e.g.`, `a:b`) are one
+# term, the standard tokenizer keeps at least as much together
+JOINERS = ".:,;'\"‘’"
+token_pattern = re.compile(r'\w+(?:[' + re.escape(JOINERS) + r']\w+)*')
+# characters the tokenizer is known to only split words on
+separators = set(string.whitespace + string.punctuation + '‘’“”–—…')
+plain_word = re.compile(r'[a-z]+')
+
+def is_word_char(c: str) -> bool:
+    return c.isalnum() or c == '_'
+
+@lru_cache(maxsize=4096)
+def fold(c: str) -> str:
+    """asciifolding of a letter with diacritics (é -> e), others as is."""
+    if c < '\x80':
+        return c
+    decomposed = unicodedata.normalize('NFD', c)
+    if (decomposed[0] < '\x80'
+            and all(unicodedata.combining(d) for d in decomposed[1:])):
+        return decomposed[0]
+    return c
+
+def terms(text: str, stem: bool = True) -> List[str]:
+    """The terms of text, in order, as near to ES's as the emulation gets."""
+    terms_: List[str] = []
+    for token in token_pattern.findall(text):
+        if stem:
+            token = ''.join(fold(c) for c in token)
+        token = token.lower()
+        if stem and plain_word.fullmatch(token):
+            token = porter_stem(token)
+        terms_.append(token)
+    return terms_
+
+def analyze(text: str, stem: bool = True) -> Optional[Tuple[str,...]]:
+    """The sorted terms of text (None: unknown how ES would analyze it)."""
+    for c in text:
+        if not (is_word_char(c) or c in separators):
+            return None
+    return tuple(sorted(terms(text, stem)))
+
+#
+# The Porter stemmer, as in Lucene's PorterStemmer (Martin Porter's reference
+# implementation, with its `bli` and `logi` rules), on lowercase a-z words.
+#
+
+class _Stemmer:
+    b: str
+    # end of the word, end of the stem (as in the reference implementation)
+    k: int
+    j: int
+
+    def __init__(self, word: str):
+        self.b = word
+        self.k = len(word) - 1
+        self.j = 0
+
+    def cons(self, i: int) -> bool:
+        c = self.b[i]
+        if c in 'aeiou':
+            return False
+        if c == 'y':
+            return i == 0 or not self.cons(i - 1)
+        return True
+
+    def m(self) -> int:
+        """Number of consonant-vowel sequences in b[0..j]."""
+        n = 0
+        i = 0
+        while True:
+            if i > self.j:
+                return n
+            if not self.cons(i):
+                break
+            i += 1
+        i += 1
+        while True:
+            while True:
+                if i > self.j:
+                    return n
+                if self.cons(i):
+                    break
+                i += 1
+            i += 1
+            n += 1
+            while True:
+                if i > self.j:
+                    return n
+                if not self.cons(i):
+                    break
+                i += 1
+            i += 1
+
+    def vowel_in_stem(self) -> bool:
+        return any(not self.cons(i) for i in range(self.j + 1))
+
+    def double_c(self, j: int) -> bool:
+        return j >= 1 and self.b[j] == self.b[j - 1] and self.cons(j)
+
+    def cvc(self, i: int) -> bool:
+        return (i >= 2 and self.cons(i) and not self.cons(i - 1)
+                and self.cons(i - 2) and self.b[i] not in 'wxy')
+
+    def ends(self, s: str) -> bool:
+        if len(s) > self.k + 1 or not self.b[:self.k + 1].endswith(s):
+            return False
+        self.j = self.k - len(s)
+        return True
+
+    def set_to(self, s: str):
+        self.b = self.b[:self.j + 1] + s + self.b[self.k + 1:]
+        self.k = self.j + len(s)
+
+    def r(self, s: str):
+        if self.m() > 0:
+            self.set_to(s)
+
+    def step1ab(self):
+        if self.b[self.k] == 's':
+            if self.ends('sses'):
+                self.k -= 2
+            elif self.ends('ies'):
+                self.set_to('i')
+            elif self.b[self.k - 1] != 's':
+                self.k -= 1
+        if self.ends('eed'):
+            if self.m() > 0:
+                self.k -= 1
+        elif (self.ends('ed') or self.ends('ing')) and self.vowel_in_stem():
+            self.k = self.j
+            if self.ends('at'):
+                self.set_to('ate')
+            elif self.ends('bl'):
+                self.set_to('ble')
+            elif self.ends('iz'):
+                self.set_to('ize')
+            elif self.double_c(self.k):
+                self.k -= 1
+                if self.b[self.k] in 'lsz':
+                    self.k += 1
+            elif self.m() == 1 and self.cvc(self.k):
+                self.set_to('e')
+
+    def step1c(self):
+        if self.ends('y') and self.vowel_in_stem():
+            self.b = self.b[:self.k] + 'i' + self.b[self.k + 1:]
+
+    def replace_first(self, rules: List[Tuple[str,str]]):
+        for suffix, replacement in rules:
+            if self.ends(suffix):
+                self.r(replacement)
+                return
+
+    def step2(self):
+        self.replace_first(STEP2.get(self.b[self.k - 1], []))
+
+    def step3(self):
+        self.replace_first(STEP3.get(self.b[self.k], []))
+
+    def step4(self):
+        c = self.b[self.k - 1]
+        if c == 'o':
+            if not ((self.ends('ion') and self.j >= 0 and self.b[self.j] in 'st')
+                    or self.ends('ou')):
+                return
+        elif not any(self.ends(suffix) for suffix in STEP4.get(c, [])):
+            return
+        if self.m() > 1:
+            self.k = self.j
+
+    def step5(self):
+        self.j = self.k
+        if self.b[self.k] == 'e':
+            a = self.m()
+            if a > 1 or (a == 1 and not self.cvc(self.k - 1)):
+                self.k -= 1
+        if self.b[self.k] == 'l' and self.double_c(self.k) and self.m() > 1:
+            self.k -= 1
+
+    def stem(self) -> str:
+        if self.k > 1:
+            self.step1ab()
+            if self.k > 0:
+                self.step1c()
+                self.step2()
+                self.step3()
+                self.step4()
+                self.step5()
+        return self.b[:self.k + 1]
+
+# suffix rules of steps 2 to 4, by the letter they're looked up by
+STEP2 = {
+    'a': [('ational', 'ate'), ('tional', 'tion')],
+    'c': [('enci', 'ence'), ('anci', 'ance')],
+    'e': [('izer', 'ize')],
+    'l': [('bli', 'ble'), ('alli', 'al'), ('entli', 'ent'), ('eli', 'e'),
+          ('ousli', 'ous')],
+    'o': [('ization', 'ize'), ('ation', 'ate'), ('ator', 'ate')],
+    's': [('alism', 'al'), ('iveness', 'ive'), ('fulness', 'ful'),
+          ('ousness', 'ous')],
+    't': [('aliti', 'al'), ('iviti', 'ive'), ('biliti', 'ble')],
+    'g': [('logi', 'log')],
+}
+STEP3 = {
+    'e': [('icate', 'ic'), ('ative', ''), ('alize', 'al')],
+    'i': [('iciti', 'ic')],
+    'l': [('ical', 'ic'), ('ful', '')],
+    's': [('ness', '')],
+}
+STEP4 = {
+    'a': ['al'],
+    'c': ['ance', 'ence'],
+    'e': ['er'],
+    'i': ['ic'],
+    'l': ['able', 'ible'],
+    'n': ['ant', 'ement', 'ment', 'ent'],
+    's': ['ism'],
+    't': ['ate', 'iti'],
+    'u': ['ous'],
+    'v': ['ive'],
+    'z': ['ize'],
+}
+
+@lru_cache(maxsize=65536)
+def porter_stem(word: str) -> str:
+    """Porter stem of a lowercase a-z word."""
+    return _Stemmer(word).stem()
@@ -0,0 +1,167 @@
+# answer_store.py
+"""
+Persistent store of precomputed answers
+
+Answers are kept in a local SQLite file, keyed by the normalized question,
+the knowledge-base commit and the model they were computed with, so they
+survive restarts and deploys.  The answers for the current commit and model
+are held in memory for lookups.
+
+Whenever the knowledge base moves to a new commit (or another model is
+activated), a background job reads the QA log and precomputes answers for
+the most frequently asked questions, so the head of the traffic never
+reaches ES or the model.
+"""
+
+import asyncio
+import json
+import sqlite3
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from util import DEFAULT_KB, log, normalize_question
+
+Answers = List[Dict[str,Any]]
+# computes the answers to a question (None: don't store any)
+AnswerFunction = Callable[[str], Awaitable[Optional[Answers]]]
+
+def top_questions(
+        log_path: str, n: int, kb: Optional[str] = None
+    ) -> List[Tuple[str,str]]:
+    """The n most asked questions in the QA log (blocking).
+
+    With `kb`, only questions asked of that knowledge base alone count.
+    Returns (normalized, most recently asked text) pairs, most asked first.
+    """
+    counts: Counter = Counter()
+    texts: Dict[str,str] = {}
+    try:
+        with open(log_path, encoding='utf-8') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                    text = entry['question']['text']
+                    # entries from before there were several don't say
+                    kbs = entry.get('kbs', [DEFAULT_KB])
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    continue
+                if kb is not None and kbs != [kb]:
+                    continue
+                if not isinstance(text, str):
+                    continue
+                key = normalize_question(text)
+                counts[key] += 1
+                texts[key] = text
+    except FileNotFoundError:
+        return []
+    return [(key, texts[key]) for key, _ in counts.most_common(n)]
+
+class AnswerStore:
+    path: str
+    # knowledge base whose questions are warmed (None: all of them)
+    kb: Optional[str]
+    db: sqlite3.Connection
+    commit: Optional[str]
+    model: Optional[str]
+    answers: Dict[str,Answers]
+    counts: Dict[str,int]
+
+    def __init__(self, path: str, kb: Optional[str] = None):
+        self.path = path
+        self.kb = kb
+        self.db = sqlite3.connect(path)
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(answers)')]
+        if len(columns) > 0 and 'model' not in columns:
+            # written before answers were kept per model, so their model is unknown
+            self.db.execute('DROP TABLE answers')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS answers ('
+            ' question TEXT NOT NULL,'
+            ' kb_commit TEXT NOT NULL,'
+            ' model TEXT NOT NULL,'
+            ' answers TEXT NOT NULL,'
+            ' PRIMARY KEY (question, kb_commit, model))'
+        )
+        self.db.commit()
+        self.commit = None
+        self.model = None
+        self.answers = {}
+        self.counts = {'hits': 0, 'misses': 0, 'warmed': 0}
+        self._warm_task: Optional[asyncio.Future] = None
+
+    def set_commit(self, commit: Optional[str], model: str) -> bool:
+        """Switch to the answers for a knowledge-base commit and a model.
+
+        Returns whether either changed (and warming is worth starting).
+        """
+        if (commit, model) == (self.commit, self.model):
+            return False
+        self.commit = commit
+        self.model = model
+        self.answers = {}
+        if commit is not None:
+            rows = self.db.execute(
+                'SELECT question, answers FROM answers'
+                ' WHERE kb_commit = ? AND model = ?',
+                (commit, model)
+            )
+            self.answers = {question: json.loads(a) for question, a in rows}
+        log.info(f'answer store: {len(self.answers)} answers for {commit} ({model})')
+        return True
+
+    def get(self, question: str) -> Optional[Answers]:
+        answers = self.answers.get(normalize_question(question), None)
+        self.counts['hits' if answers is not None else 'misses'] += 1
+        return answers
+
+    def put(self, key: str, answers: Answers):
+        if self.commit is None or self.model is None:
+            return
+        self.db.execute(
+            'INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?)',
+            (key, self.commit, self.model, json.dumps(answers))
+        )
+        self.db.commit()
+        self.answers[key] = answers
+
+    def start_warming(self, answer: AnswerFunction, log_path: str, n: int):
+        """(Re)start precomputing answers to the n most asked questions."""
+        if self._warm_task is not None:
+            self._warm_task.cancel()
+        self._warm_task = asyncio.create_task(self.warm(answer, log_path, n))
+
+    async def warm(self, answer: AnswerFunction, log_path: str, n: int):
+        commit, model = self.commit, self.model
+        questions = await asyncio.get_running_loop().run_in_executor(
+            None, top_questions, log_path, n, self.kb
+        )
+        warmed = 0
+        for key, text in questions:
+            if key in self.answers:
+                continue
+            try:
+                answers = await answer(text)
+            except Exception as e:
+                log.error(f'answer store: failed warming {text!r}: {e}')
+                continue
+            if (self.commit, self.model) != (commit, model):
+                # the knowledge base (or model) moved on, a newer job takes over
+                return
+            if answers is not None:
+                self.put(key, answers)
+                warmed += 1
+        self.counts['warmed'] += warmed
+        # answers for older commits or other models won't be asked for again
+        self.db.execute(
+            'DELETE FROM answers WHERE kb_commit != ? OR model != ?',
+            (commit, model)
+        )
+        self.db.commit()
+        log.info(f'answer store: warmed {warmed} of top {len(questions)}')
+
+    def stats(self) -> Dict[str,Any]:
+        stats: Dict[str,Any] = dict(self.counts)
+        stats.update({
+            'commit': self.commit, 'model': self.model, 'stored': len(self.answers),
+        })
+        return stats
@@ -0,0 +1,144 @@
+# answers.py
+"""
+Answers as the API returns them, made from the model's spans
+
+Shared by the server and batch_qa.py, so both answer alike, and importable
+without the server's side effects (benchmark.py times them on their own).
+"""
+
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from util import answer_to_complete_sentence
+from canned_answer import no_answer
+from context_windows import Window, answer_start
+
+# what /question returns of each answer, by the `fields` option (None: all)
+ANSWER_FIELDS: Dict[str,Optional[List[str]]] = {
+    'full': None,
+    'compact': ['answer', 'rating', 'paragraph_rank', 'docId', 'offset',
+                'docIds', 'kb', 'start', 'end'],
+    'spans': ['kb', 'docId', 'start', 'end', 'rating'],
+}
+
+def get_quick_answer(answers: List[Dict[str,Any]]) -> str:
+    """Implement heuristic to choose an answer.
+
+    Right now, it's unclear which answer to choose.  Given that the empty span
+    is the best answer for a paragraph, then we can can ignore that paragraph.
+    Comparing the ratings returned from the model for different paragraphs is
+    problematic...
+    Here are the two current ideas:
+
+    1. Choose the first non-empty answer
+    2. Choose best rated non-empty answer
+
+    1. Means that we assume that the most relevant paragraph found by
+       ElasticSearch is most likely to contain the right answer, so we pick it.
+    2. Means that we take the best rated answer.
+
+    Option 1 has experimentally demonstrated better results (see the reports
+    on the blog qa), while 2 is the most commonly implemented heuristic.  As
+    of right now, ElasticSearch needs to be better configured to make option 1
+    work properly.  Option 2 may be a good option if the model can be trained
+    to better identify when a paragraph is irrelevant.
+
+    Better configuring ElasticSearch means incorporating boosts, stopwords,
+    and making the base text better.
+    More training of the model is a bit more interesting, but perhaps less
+    promising...
+    """
+    def filter_no_answers(candidates: List[Dict[str,Any]]) -> List[Dict[str,Any]]:
+        return list(filter(lambda answer: answer['answer'] != '', candidates))
+    def sort_by_rating(answers_: List[Dict[str,Any]]) -> List[Dict[str,Any]]:
+        return list(sorted(answers_, key=lambda a: a['rating'], reverse=True))
+    candidates = answers
+    candidates = filter_no_answers(candidates)
+    candidates = sort_by_rating(candidates)
+    if len(candidates) > 0:
+        return candidates[0]['answer']
+    else:
+        return no_answer()
+
+def make_answer(
+        answer: str, rating: float = 0., paragraph: str = "",
+        paragraph_rank: int = 0, docId: str = '', offset: int = 0,
+        docIds: Optional[List[str]] = None, kb: str = '',
+        start: Optional[int] = None, end: Optional[int] = None
+        ) -> Dict[str,Union[str,float,int,List[str],None]]:
+    return {
+        'answer': answer,
+        'rating': rating,
+        'paragraph': paragraph,
+        'paragraph_rank': paragraph_rank,
+        'docId': docId,
+        'offset': offset,
+        # every doc holding the paragraph (copies are answered once)
+        'docIds': docIds if docIds is not None else [docId],
+        # knowledge base the paragraph came from
+        'kb': kb,
+        # span the model found in the paragraph (answer is its sentence)
+        'start': start,
+        'end': end,
+    }
+
+def paragraph_answers(
+        paragraphs: List[Dict[str,Any]], windows: List[Window],
+        raw_answers: List[Dict[str,Any]]
+        ) -> List[Dict[str,Any]]:
+    """Answers of the model for each retrieved paragraph, in rank order.
+
+    `windows` are what the model read of each paragraph, its spans are
+    completed to sentences of the whole paragraph.
+    """
+    answers = []
+    for rank,(paragraph,window,answer) in enumerate(zip(paragraphs,windows,raw_answers)):
+        context = paragraph['text']
+        start = answer_start(answer, window)
+        end = window.start + answer['end'] if start is not None else None
+        answers.append(make_answer(
+            answer=answer_to_complete_sentence(answer['answer'],context,start),
+            rating=answer['score'],
+            paragraph=context,
+            paragraph_rank=rank,
+            docId=paragraph['docId'],
+            offset=paragraph['offset'],
+            docIds=paragraph['docIds'],
+            kb=paragraph['kb'],
+            start=start,
+            end=end,
+        ))
+    return answers
+
+def answer_span(answer: Dict[str,Any]) -> Tuple[Optional[int],Optional[int]]:
+    """Character span the model found within the doc (None if there's none).
+
+    Answers stored before spans were kept have none either.
+    """
+    if answer['answer'] == '' or answer.get('start', None) is None:
+        return None, None
+    return answer['offset'] + answer['start'], answer['offset'] + answer['end']
+
+def shape_answers(answers: List[Dict[str,Any]], fields: str) -> List[Dict[str,Any]]:
+    keys = ANSWER_FIELDS[fields]
+    if keys is None:
+        return answers
+    shaped = []
+    for answer in answers:
+        if fields == 'spans':
+            answer = dict(answer)
+            answer['start'], answer['end'] = answer_span(answer)
+        # answers stored before a field existed don't have it
+        shaped.append({k: answer.get(k, None) for k in keys})
+    return shaped
+
+def qa_log_entry(reply: Dict[str,Any], kbs: List[str]) -> Dict[str,Any]:
+    """What the QA log keeps of a reply: everything but the paragraphs."""
+    return {
+        'question': reply['question'],
+        'kbs': kbs,
+        'quick_answer': reply['quick_answer'],
+        'answers': [
+            {k:answer[k] for k in answer if k != 'paragraph'}
+            for answer in reply['answers']
+        ],
+    }
@@ -0,0 +1,311 @@
+# batch_qa.py
+"""
+Answer files of questions offline, in parallel
+
+    python batch_qa.py questions.jsonl -o answers.ndjson
+    python batch_qa.py qa_log.multi_json -o faq.ndjson --unique --workers 4
+
+Questions are read one JSON object per line, either request bodies
+(`{"question": "...", "kbs": [...]}`) or QA log entries (`{"question":
+{"text": ...}, "kbs": [...]}`).  They are retrieved and answered in worker
+processes, each with its own model and event loop, a chunk at a time (all
+the passages of a chunk go through the model in one batch), so the server
+doesn't have to be running.
+
+Input is read lazily and only a couple of chunks per worker are in flight, so
+memory doesn't depend on the size of the input.  Each result is a line of
+NDJSON with the question's `id` (from the input, or `file:line`).  The output
+is the checkpoint: run again with the same output and the questions already
+answered in it are skipped, so an interrupted run just resumes (failed ones
+are retried).  Throughput and the time per stage are reported at the end.
+"""
+
+import os
+# workers share the cores, the tokenizer mustn't start threads per process
+os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor
+from concurrent.futures import wait
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional
+from typing import Set
+
+from util import DEFAULT_KB, CONTEXT_WINDOWS
+from util import log, normalize_question
+from context_windows import Window, query_windows
+
+# answers per question, as the server retrieves
+TOPK = 5
+CHUNK_SIZE = 8
+# chunks in flight per worker
+CHUNKS_PER_WORKER = 2
+# fields of an answer in the results (`paragraph` too with --paragraphs)
+ANSWER_FIELDS = ['answer', 'rating', 'paragraph_rank', 'docId', 'offset', 'docIds', 'kb']
+STAGES = ['retrieval', 'inference', 'sentences']
+
+class Question(NamedTuple):
+    id: str
+    text: str
+    # None: as asked, or the default knowledge base
+    kbs: Optional[List[str]]
+
+def parse_question(entry: Any, default_id: str) -> Optional[Question]:
+    """The question in a request body or QA log entry (None: there isn't)."""
+    if not isinstance(entry, dict):
+        return None
+    question = entry.get('question', None)
+    _id = entry.get('id', None)
+    if isinstance(question, dict):
+        _id = _id or question.get('uuid', None)
+        question = question.get('text', None)
+    if not isinstance(question, str) or question.strip() == '':
+        return None
+    kbs = entry.get('kbs', entry.get('kb', None))
+    if isinstance(kbs, str):
+        kbs = [kbs]
+    return Question(str(_id or default_id), question, kbs)
+
+def read_questions(paths: Iterable[str]) -> Iterator[Question]:
+    for path in paths:
+        with open(path, encoding='utf-8') as file:
+            for lineno, line in enumerate(file, 1):
+                if line.strip() == '':
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    log.warning(f'{path}:{lineno}: not json')
+                    continue
+                question = parse_question(entry, f'{path}:{lineno}')
+                if question is None:
+                    log.warning(f'{path}:{lineno}: no question')
+                    continue
+                yield question
+
+def read_checkpoint(path: str) -> Set[str]:
+    """Ids answered in the output so far, which is cut back to whole lines."""
+    done: Set[str] = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, 'rb+') as file:
+        data = file.read()
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            # a line cut short by the interruption
+            file.truncate(end)
+    for line in data[:end].splitlines():
+        try:
+            result = json.loads(line)
+        except ValueError:
+            continue
+        if 'error' not in result:
+            done.add(result['id'])
+    return done
+
+def select(
+        questions: Iterable[Question], done: Set[str], unique: bool,
+        kbs: Optional[List[str]]
+    ) -> Iterator[Question]:
+    """Questions not answered yet, with kbs overridden, optionally deduped."""
+    seen: Set[Any] = set()
+    for question in questions:
+        if kbs is not None:
+            question = question._replace(kbs=kbs)
+        if unique:
+            key = (normalize_question(question.text), tuple(question.kbs or [DEFAULT_KB]))
+            if key in seen:
+                continue
+            seen.add(key)
+        if question.id not in done:
+            yield question
+
+def chunked(questions: Iterator[Question], size: int) -> Iterator[List[Question]]:
+    chunk: List[Question] = []
+    for question in questions:
+        chunk.append(question)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+#
+# Worker processes
+#
+
+# the model, loaded once per process on its first chunk
+_worker: Dict[str,Any] = {}
+
+def load_worker(model: Optional[str], threads: int) -> Dict[str,Any]:
+    if len(_worker) > 0:
+        return _worker
+    import torch # type: ignore
+    torch.set_num_threads(threads)
+    import transformer_query
+    from knowledge_base import knowledge_bases
+    # only the model answering is loaded
+    if model is not None:
+        pipeline = transformer_query.load_pipeline(model)
+    else:
+        pipeline = transformer_query.get_pipeline()
+    _worker.update(pipeline=pipeline, knowledge_bases=knowledge_bases)
+    return _worker
+
+def answer_chunk(
+        chunk: List[Question], model: Optional[str], threads: int,
+        paragraphs: bool
+    ) -> Dict[str,Any]:
+    """Answer a chunk of questions, in a worker process.
+
+    Returns the results and the seconds spent in each stage.
+    """
+    from util import loop
+    from knowledge_base import search
+    from transformer_query import run_pipeline_batch
+    from answers import get_quick_answer, paragraph_answers
+    worker = load_worker(model, threads)
+    knowledge_bases = worker['knowledge_bases']
+    timings = Counter()
+    results: Dict[str,Dict[str,Any]] = {}
+    hits: Dict[str,List[Dict[str,Any]]] = {}
+
+    start = time.perf_counter()
+    async def retrieve(question: Question):
+        try:
+            kbs = [knowledge_bases[name] for name in question.kbs or [DEFAULT_KB]]
+            hits[question.id] = await search(kbs, question.text, topk=TOPK)
+        except Exception as e:
+            results[question.id] = {'error': repr(e)}
+    loop.run_until_complete(asyncio.gather(*[retrieve(q) for q in chunk]))
+    timings['retrieval'] += time.perf_counter() - start
+
+    # every passage of the chunk in one batch
+    start = time.perf_counter()
+    windows: Dict[str,List[Window]] = {}
+    for q in chunk:
+        texts = [hit['text'] for hit in hits.get(q.id, [])]
+        windows[q.id] = (query_windows(q.text, texts) if CONTEXT_WINDOWS
+                         else [Window(text, 0) for text in texts])
+    questions = [q.text for q in chunk for _ in windows[q.id]]
+    contexts = [window.text for q in chunk for window in windows[q.id]]
+    raw_answers: List[Dict[str,Any]] = []
+    try:
+        raw_answers = loop.run_until_complete(
+            run_pipeline_batch(questions, contexts, worker['pipeline'])
+        )
+    except Exception as e:
+        for q in chunk:
+            results.setdefault(q.id, {'error': repr(e)})
+    timings['inference'] += time.perf_counter() - start
+
+    start = time.perf_counter()
+    fields = ANSWER_FIELDS + (['paragraph'] if paragraphs else [])
+    i = 0
+    for q in chunk:
+        q_hits = hits.get(q.id, [])
+        q_answers, i = raw_answers[i:i + len(q_hits)], i + len(q_hits)
+        if q.id in results:
+            continue
+        answers = paragraph_answers(q_hits, windows[q.id], q_answers)
+        results[q.id] = {
+            'answers': [{f: answer[f] for f in fields} for answer in answers],
+            'quick_answer': get_quick_answer(answers),
+        }
+    timings['sentences'] += time.perf_counter() - start
+
+    return {
+        'results': [
+            dict(id=q.id, question=q.text, kbs=q.kbs or [DEFAULT_KB], **results[q.id])
+            for q in chunk
+        ],
+        'timings': dict(timings),
+    }
+
+#
+# Driver
+#
+
+def run(args: argparse.Namespace) -> Dict[str,Any]:
+    done = read_checkpoint(args.output)
+    if len(done) > 0:
+        log.info(f'resuming: {len(done)} questions already answered')
+    kbs = args.kb.split(',') if args.kb is not None else None
+    questions = select(read_questions(args.inputs), done, args.unique, kbs)
+    chunks = chunked(questions, args.chunk_size)
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+    counts = Counter()
+    timings = Counter()
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool, \
+            open(args.output, 'a', encoding='utf-8') as output:
+        in_flight: Set[Future] = set()
+        def submit_next() -> bool:
+            chunk = next(chunks, None)
+            if chunk is None:
+                return False
+            in_flight.add(pool.submit(
+                answer_chunk, chunk, args.model, threads, args.paragraphs
+            ))
+            return True
+        for _ in range(args.workers * CHUNKS_PER_WORKER):
+            if not submit_next():
+                break
+        while len(in_flight) > 0:
+            finished, in_flight_ = wait(in_flight, return_when=FIRST_COMPLETED)
+            in_flight = set(in_flight_)
+            for future in finished:
+                reply = future.result()
+                for result in reply['results']:
+                    output.write(json.dumps(result) + '\n')
+                    counts['errors' if 'error' in result else 'answered'] += 1
+                output.flush()
+                timings.update(reply['timings'])
+                submit_next()
+            total = counts['answered'] + counts['errors']
+            elapsed = time.perf_counter() - start
+            log.info(f'{total} questions, {total / elapsed:.2f}/s')
+    elapsed = time.perf_counter() - start
+    total = counts['answered'] + counts['errors']
+    stage_total = max(sum(timings.values()), 1e-9)
+    return {
+        'answered': counts['answered'],
+        'errors': counts['errors'],
+        'skipped': len(done),
+        'elapsed_s': elapsed,
+        'questions_per_s': total / elapsed if elapsed > 0 else 0.,
+        'workers': args.workers,
+        # summed over the workers
+        'stages': {
+            stage: {
+                's': timings[stage],
+                'ms_per_question': 1000 * timings[stage] / max(total, 1),
+                'share': timings[stage] / stage_total,
+            } for stage in STAGES
+        },
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('inputs', nargs='+',
+                        help='question files (request bodies or QA log, one per line)')
+    parser.add_argument('-o', '--output', required=True,
+                        help='NDJSON results, also the checkpoint to resume from')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=None,
+                        help='torch threads per worker (default: cores / workers)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--kb', default=None,
+                        help='knowledge base(s) to ask, comma separated '
+                             '(default: as asked in the input)')
+    parser.add_argument('--model', default=None,
+                        help='QA model to use instead of MODEL_NAME')
+    parser.add_argument('--unique', action='store_true',
+                        help='answer each distinct question once')
+    parser.add_argument('--paragraphs', action='store_true',
+                        help='include the paragraphs in the results')
+    args = parser.parse_args()
+    print(json.dumps(run(args), indent=2))
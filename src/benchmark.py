@@ -0,0 +1,227 @@
+# benchmark.py
+"""
+Microbenchmarks for the stages of answering a question
+
+Every stage of the QA hot path is timed on fixed synthetic inputs, on CPU and
+without ES or the network (the model has to be in the local transformers
+cache).  Results are compared with a stored baseline and anything slower by
+more than the threshold is flagged.
+
+    python benchmark.py                 # run, compare with the baseline
+    python benchmark.py --save          # run, store as the new baseline
+    python benchmark.py -k sentence     # only benchmarks matching 'sentence'
+
+For each benchmark, `calls/s` and `us/call` come from the best of several
+timed repeats.  `alloc B/call` is the peak memory Python allocated during
+one call (tracemalloc), so it doesn't include torch's own tensor storage.
+"""
+
+import os
+# offline and on CPU, before transformers/torch are imported
+os.environ.setdefault('TRANSFORMERS_OFFLINE', '1')
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+
+import argparse
+import json
+import sys
+import timeit
+import tracemalloc
+from typing import Any, Callable, Dict, List, NamedTuple
+
+BASELINE_PATH = 'benchmark_baseline.json'
+# timed repeats, each at least 0.2s long (see timeit.Timer.autorange)
+REPEATS = 5
+# context lengths (in words) for the inference benchmarks
+CONTEXT_WORDS = [50, 150, 300]
+BATCH_SIZE = 5
+
+class Result(NamedTuple):
+    name: str
+    calls_per_s: float
+    us_per_call: float
+    alloc_bytes: int
+
+#
+# Synthetic inputs
+#
+
+sentence = ('Mono is a software company based in Osijek, Croatia, and it '
+            'builds web and mobile applications for clients worldwide. ')
+words = ' '.join([sentence] * 40).split()
+
+def make_paragraph(n_words: int) -> str:
+    text = ' '.join(words[:n_words])
+    # a paragraph break now and then, like the knowledge base has
+    return text.replace('worldwide. Mono', 'worldwide.\n\nMono', 2)
+
+question = 'where is the company based?'
+paragraph = make_paragraph(150)
+answer_text = 'Osijek, Croatia'
+
+def make_answers(n: int) -> List[Dict[str,Any]]:
+    return [{
+        'answer': sentence.strip() if i % 2 == 0 else '',
+        'rating': 0.1 * i,
+        'paragraph': paragraph,
+        'paragraph_rank': i,
+        'docId': f'doc_{i}.txt',
+        'offset': 0,
+        'docIds': [f'doc_{i}.txt'],
+        'start': paragraph.find(answer_text) if i % 2 == 0 else None,
+        'end': paragraph.find(answer_text) + len(answer_text) if i % 2 == 0 else None,
+    } for i in range(n)]
+
+def make_response() -> Dict[str,Any]:
+    return {
+        'question': {'text': question, 'uuid': '24f8619a-df94-4104-869f'},
+        'answers': make_answers(5),
+        'quick_answer': sentence.strip(),
+    }
+
+#
+# Measurement
+#
+
+def measure(name: str, f: Callable[[], Any]) -> Result:
+    timer = timeit.Timer(f)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=REPEATS, number=number)) / number
+    tracemalloc.start()
+    f()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return Result(name, 1 / best, 1e6 * best, peak)
+
+def get_benchmarks() -> Dict[str,Callable[[], Any]]:
+    """Name -> zero-argument callable, for every benchmarked stage."""
+    # imported here, so `--help` doesn't load the model.  Not the server,
+    # which opens the QA log and the answer stores when imported.
+    from aiohttp.web import json_response
+    from aiohttp.test_utils import make_mocked_request
+    from answers import get_quick_answer, shape_answers, qa_log_entry
+    from responses import dumps, fast_json_response
+    from util import answer_to_complete_sentence
+    from canned_answer import get_happy_employee
+    from analysis import analyze
+    from context_windows import query_windows
+    from transformer_query import get_pipeline
+    from util import MAX_SEQ_LEN, MAX_QUESTION_LEN
+    pipeline = get_pipeline()
+    tokenizer = pipeline.tokenizer
+
+    # don't put synthetic questions in the real QA log
+    qa_log = open(os.devnull, 'w')
+    plain = make_mocked_request('POST', '/question')
+    gzipped = make_mocked_request(
+        'POST', '/question', headers={'accept-encoding': 'gzip, deflate'}
+    )
+
+    benchmarks: Dict[str,Callable[[], Any]] = {
+        'answer_to_complete_sentence':
+            lambda: answer_to_complete_sentence(answer_text, paragraph),
+        'get_quick_answer':
+            lambda: get_quick_answer(make_answers(5)),
+        'get_happy_employee/match':
+            lambda: get_happy_employee('is jelena happy?'),
+        'get_happy_employee/no_match':
+            lambda: get_happy_employee(question),
+        'tokenize/question':
+            lambda: tokenizer.tokenize(question),
+        'json/response':
+            lambda: json.dumps(make_response()),
+        'json/json_response':
+            lambda: json_response(make_response()),
+        'json/dumps':
+            lambda: dumps(make_response()),
+        'json/fast_json_response':
+            lambda: fast_json_response(plain, make_response()),
+        'json/fast_json_response/gzip':
+            lambda: fast_json_response(gzipped, make_response()),
+        'shape_answers/spans':
+            lambda: shape_answers(make_answers(5), 'spans'),
+        'analyze/question':
+            lambda: analyze(question),
+        'context_windows/paragraph_300w':
+            lambda: query_windows(question, [make_paragraph(300)]),
+    }
+
+    def tokenize_paragraph(text: str) -> Callable[[], Any]:
+        return lambda: tokenizer.tokenize(text)
+
+    def single(text: str) -> Callable[[], Any]:
+        def run():
+            for _ in range(BATCH_SIZE):
+                pipeline({'question': question, 'context': text},
+                         handle_impossible_answer=True,
+                         max_seq_len=MAX_SEQ_LEN,
+                         max_question_len=MAX_QUESTION_LEN, topk=1)
+        return run
+
+    def batched(text: str) -> Callable[[], Any]:
+        batch = [{'question': question, 'context': text}] * BATCH_SIZE
+        return lambda: pipeline(batch, handle_impossible_answer=True,
+                                max_seq_len=MAX_SEQ_LEN,
+                                max_question_len=MAX_QUESTION_LEN, topk=1)
+
+    for n in CONTEXT_WORDS:
+        text = make_paragraph(n)
+        benchmarks[f'tokenize/paragraph_{n}w'] = tokenize_paragraph(text)
+        benchmarks[f'inference/single_x{BATCH_SIZE}_{n}w'] = single(text)
+        benchmarks[f'inference/batched_x{BATCH_SIZE}_{n}w'] = batched(text)
+
+    def log_qa():
+        to_log = qa_log_entry(make_response(), ['default'])
+        print(dumps(to_log).decode('utf-8'), file=qa_log, flush=True)
+    benchmarks['log_qa'] = log_qa
+    return benchmarks
+
+def compare(
+        results: List[Result], baseline: Dict[str,Dict[str,float]],
+        threshold: float
+    ) -> List[str]:
+    """Print results next to the baseline, return the regressed names."""
+    regressed: List[str] = []
+    print(f'{"benchmark":<36} {"calls/s":>11} {"us/call":>11} '
+          f'{"alloc B/call":>13} {"vs base":>8}')
+    for r in results:
+        base = baseline.get(r.name, None)
+        change = ''
+        if base is not None:
+            ratio = r.us_per_call / base['us_per_call'] - 1
+            change = f'{ratio:+.0%}'
+            if ratio > threshold:
+                regressed.append(r.name)
+                change += ' !'
+        print(f'{r.name:<36} {r.calls_per_s:>11.1f} {r.us_per_call:>11.1f} '
+              f'{r.alloc_bytes:>13} {change:>8}')
+    return regressed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-k', dest='pattern', default='',
+                        help='only run benchmarks whose name contains this')
+    parser.add_argument('--save', action='store_true',
+                        help=f'store the results in {BASELINE_PATH}')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='slowdown vs the baseline flagged as regression')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    args = parser.parse_args()
+
+    benchmarks = get_benchmarks()
+    results = [
+        measure(name, f) for name, f in benchmarks.items()
+        if args.pattern in name
+    ]
+    baseline: Dict[str,Dict[str,float]] = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    regressed = compare(results, baseline, args.threshold)
+    if args.save:
+        baseline.update({r.name: r._asdict() for r in results})
+        with open(args.baseline, 'w') as file:
+            json.dump(baseline, file, indent=2, sort_keys=True)
+        print(f'saved baseline: {args.baseline}')
+    elif len(regressed) > 0:
+        print(f'regressions (> {args.threshold:.0%} slower): {", ".join(regressed)}')
+        sys.exit(1)
@@ -0,0 +1,260 @@
+# bulk_import.py
+"""
+Bulk knowledge-base import via `git fast-import`
+
+Documents are streamed from a JSONL or tar source into a single fast-import
+process, which writes one commit to a scratch ref without touching the
+working tree.  Only moving the branch to that commit (and fast-forwarding the
+working tree) is done while holding the source locks.  Everything imported is
+then indexed with one bulk request.
+
+JSONL sources have one document per line:
+
+    {"docId": "about_us.txt", "text": "Mono is a company..."}
+
+Tar sources (optionally compressed) contribute every `*.txt` member, named by
+its basename.
+
+Run this script to import from the command line:
+
+    python bulk_import.py docs.jsonl
+    python bulk_import.py --replace docs.tar.gz
+"""
+
+import argparse
+import asyncio
+import json
+import re
+import subprocess
+from subprocess import PIPE, DEVNULL
+import tarfile
+import tempfile
+from pathlib import Path
+from typing import Iterator, Iterable, IO, List, Dict, Any, Optional, Tuple
+from typing import cast
+from uuid import uuid4
+
+from util import INDEX_NAME, SOURCE_DIR, named_locks, log, loop
+from util import source_docs_lock
+from create_index import ParagraphInfo, index_bulk, recreate_index
+from create_index import delete_passages, reset_duplicates, update_duplicates
+from corpus import CorpusLoader
+from git_crud import GitClient, GitFastImportError, DocId
+from git_crud import git_head_ref, git_ref_commit, git_update_ref
+from git_crud import git_delete_ref, git_read_tree, git_reset
+from git_crud import git_committer_ident
+
+# (docId, file contents) as it will be written into the tree
+RawDoc = Tuple[DocId, bytes]
+
+# content-type of an upload -> kind of source
+content_types: Dict[str,str] = {
+    'application/x-ndjson': 'jsonl',
+    'application/jsonl': 'jsonl',
+    'application/x-tar': 'tar',
+    'application/gzip': 'tar',
+    'application/x-gzip': 'tar',
+}
+
+# docIds become filenames directly in the source directory
+docid_r = re.compile(r'[^/\\\x00-\x1f"]+\.txt')
+
+class BulkImportError(RuntimeError):
+    """Raised when an import source is malformed."""
+    def __init__(self, message: str):
+        super().__init__(message)
+
+def check_docid(docId: Any) -> DocId:
+    if not isinstance(docId, str) or docid_r.fullmatch(docId) is None:
+        raise BulkImportError(f'invalid docId: {docId!r} (need a *.txt name)')
+    if docId.startswith('.'):
+        raise BulkImportError(f'invalid docId: {docId!r} (hidden file)')
+    return docId
+
+def iter_jsonl(file: IO[bytes]) -> Iterator[RawDoc]:
+    """Yield docs from a JSONL source, one line at a time."""
+    for lineno, line in enumerate(file, start=1):
+        if line.strip() == b'':
+            continue
+        try:
+            record = json.loads(line)
+            docId = check_docid(record['docId'])
+            text = record['text']
+        except (ValueError, KeyError, TypeError) as e:
+            raise BulkImportError(f'line {lineno}: {type(e).__name__} {e}')
+        if not isinstance(text, str):
+            raise BulkImportError(f'line {lineno}: "text" must be a string')
+        # same layout as `_create`, which `print`s the doc to the file
+        yield docId, (text + '\n').encode('utf-8')
+
+def iter_tar(file: IO[bytes]) -> Iterator[RawDoc]:
+    """Yield the `*.txt` members of a tar stream, one member at a time."""
+    with tarfile.open(fileobj=file, mode='r|*') as tar:
+        for member in tar:
+            if not member.isfile() or not member.name.endswith('.txt'):
+                continue
+            docId = check_docid(Path(member.name).name)
+            extracted = tar.extractfile(member)
+            if extracted is None:
+                continue
+            data = extracted.read()
+            try:
+                data.decode('utf-8')
+            except UnicodeDecodeError as e:
+                raise BulkImportError(f'{member.name}: {e}')
+            yield docId, data
+
+def iter_docs(file: IO[bytes], kind: str) -> Iterator[RawDoc]:
+    if kind == 'jsonl':
+        return iter_jsonl(file)
+    elif kind == 'tar':
+        return iter_tar(file)
+    raise BulkImportError(f'unknown source kind: {kind}')
+
+def fast_import(
+        git_dir: str, docs: Iterable[RawDoc], ref: str, parent: Optional[str],
+        committer: str, message: str, replace: bool = False
+    ) -> List[DocId]:
+    """Write docs as one commit on `ref` with a single `git fast-import`.
+
+    Blocking: run this in an executor.  Docs are written to the process as
+    they are produced, so memory use doesn't depend on the size of the
+    import.  Returns the (deduplicated) docIds written.
+    """
+    cmd = ('git','-C',git_dir,'fast-import','--quiet','--done')
+    docIds: Dict[DocId,None] = {}
+    with tempfile.TemporaryFile() as stderr:
+        git = subprocess.Popen(cmd, stdin=PIPE, stdout=DEVNULL, stderr=stderr)
+        stdin = cast(IO[bytes], git.stdin)
+        try:
+            msg = message.encode('utf-8')
+            stdin.write(f'commit {ref}\n'.encode('utf-8'))
+            stdin.write(f'committer {committer}\n'.encode('utf-8'))
+            stdin.write(b'data %d\n' % len(msg) + msg + b'\n')
+            if parent is not None:
+                stdin.write(f'from {parent}\n'.encode('utf-8'))
+            if replace:
+                stdin.write(b'deleteall\n')
+            for docId, data in docs:
+                stdin.write(f'M 100644 inline {docId}\n'.encode('utf-8'))
+                stdin.write(b'data %d\n' % len(data) + data + b'\n')
+                docIds[docId] = None
+            stdin.write(b'done\n')
+            stdin.close()
+        except BrokenPipeError:
+            # fast-import died, the return code and stderr will say why
+            pass
+        except BaseException:
+            git.kill()
+            git.wait()
+            raise
+        git.wait()
+        if git.returncode != 0:
+            stderr.seek(0)
+            err_str = stderr.read().decode('utf-8', errors='replace')
+            raise GitFastImportError(cmd, err_str)
+    return list(docIds)
+
+def read_docs(git_dir: str, docIds: Iterable[DocId]) -> Iterator[ParagraphInfo]:
+    """Lazily read imported docs back from the working tree for indexing."""
+    for docId in docIds:
+        with open(Path(git_dir) / docId, encoding='utf-8') as file:
+            yield ParagraphInfo(file.read(), docId)
+
+async def bulk_import(
+        git_client: GitClient, docs: Iterable[RawDoc], *,
+        index: str = INDEX_NAME, replace: bool = False,
+        message: Optional[str] = None, corpus: Optional[CorpusLoader] = None
+    ) -> Dict[str,Any]:
+    """Commit docs to the knowledge base in one go and bulk index them.
+
+    With `replace`, the resulting commit contains *only* the imported docs
+    and the index is rebuilt from scratch.  Otherwise docs are added to (or
+    overwrite docs in) the current tree and index.
+
+    If someone else committed while the import was being written, the ref
+    update fails with a `GitUpdateRefError` and nothing changes.
+
+    Given the knowledge base's `corpus`, the docs are read through it, so its
+    manifest (and the snapshot saved after the import) includes them.
+    """
+    await git_client.initialize()
+    git_dir = git_client.source_dir
+    branch = await git_head_ref(git_dir)
+    parent = await git_ref_commit(git_dir, branch)
+    committer = await git_committer_ident(git_dir)
+    scratch_ref = f'refs/bulk-import/{uuid4()}'
+    if message is None:
+        message = 'bulk import' + (' (replace)' if replace else '')
+    docIds = await asyncio.get_running_loop().run_in_executor(
+        None, fast_import,
+        git_dir, docs, scratch_ref, parent, committer, message, replace
+    )
+    try:
+        commit = await git_ref_commit(git_dir, scratch_ref)
+        if commit is None:
+            raise GitFastImportError(('fast-import',), f'{scratch_ref} missing')
+        # no commits of single docs meanwhile
+        async with git_client.committer.lock, source_docs_lock(git_dir):
+            await git_update_ref(git_dir, branch, commit, parent)
+            if parent is not None:
+                await git_read_tree(git_dir, parent, commit)
+            else:
+                await git_reset(git_dir)
+    finally:
+        await git_delete_ref(git_dir, scratch_ref)
+    log.info(f'bulk import: {len(docIds)} docs committed as {commit}')
+    hashes: Dict[str,List[str]] = {}
+    async with named_locks[index]:
+        paragraphs: Iterator[ParagraphInfo]
+        if corpus is not None:
+            imported = set(docIds)
+            stats = await corpus.snapshot()
+            if replace:
+                corpus.clear()
+            paragraphs = corpus.read([s for s in stats if s.name in imported])
+        else:
+            paragraphs = read_docs(git_dir, docIds)
+        if replace:
+            recreate_index(index)
+            indexed = await asyncio.get_running_loop().run_in_executor(
+                None, index_bulk, index, paragraphs, None, hashes
+            )
+            reset_duplicates(index, hashes)
+        else:
+            written: Dict[str,List[str]] = {}
+            indexed = await asyncio.get_running_loop().run_in_executor(
+                None, index_bulk, index, paragraphs, written, hashes
+            )
+            # overwritten docs may have had more passages than they have now
+            delete_passages(index, list(written), keep=written)
+            await asyncio.get_running_loop().run_in_executor(
+                None, update_duplicates, index, hashes, list(written)
+            )
+        if corpus is not None:
+            corpus.commit()
+    log.info(f'bulk import: indexed {indexed} docs into {index}')
+    return {'commit': commit, 'imported': len(docIds), 'indexed': indexed}
+
+def kind_for_path(path: str) -> str:
+    if path.endswith('.jsonl') or path.endswith('.ndjson'):
+        return 'jsonl'
+    return 'tar'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('source', help='.jsonl/.ndjson file or tar archive')
+    parser.add_argument('--source-dir', default=SOURCE_DIR)
+    parser.add_argument('--index', default=INDEX_NAME)
+    parser.add_argument('--replace', action='store_true',
+                        help='replace the whole knowledge base')
+    parser.add_argument('-m', '--message', default=None)
+    args = parser.parse_args()
+    git_client = GitClient(args.source_dir)
+    with open(args.source, 'rb') as file:
+        docs = iter_docs(file, kind_for_path(args.source))
+        result = loop.run_until_complete(bulk_import(
+            git_client, docs, index=args.index, replace=args.replace,
+            message=args.message
+        ))
+    print(json.dumps(result))
@@ -0,0 +1,83 @@
+# context_windows.py
+"""
+Query-focused windows of passages, for the model to read
+
+The answer to a question is nearly always in the sentence of a passage that
+shares the most (analyzed) terms with it, so instead of the whole passage the
+model can read just that sentence and `margin` sentences on each side.  Terms
+are weighed by how few of the passage's sentences have them, so `the` and
+`is` barely count.
+Attention costs grow with the square of the sequence length, and shorter
+contexts pack into batches with less padding.
+
+A window knows where it starts in its passage, so the spans the model finds
+in it can be mapped back (see `answer_to_complete_sentence`).  Sentences are
+split like `answer_to_complete_sentence` splits them.
+"""
+
+import math
+import re
+from collections import Counter
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from util import WINDOW_MARGIN, WINDOW_MIN_CHARS
+from analysis import terms
+
+sentence_split = re.compile(r'\.|\n\n')
+
+class Window(NamedTuple):
+    text: str
+    # offset of the text in its passage
+    start: int
+
+def sentence_spans(paragraph: str) -> List[Tuple[int,int]]:
+    """(start, end) of each sentence, ends included (the `.`)."""
+    spans: List[Tuple[int,int]] = []
+    start = 0
+    for match in sentence_split.finditer(paragraph):
+        spans.append((start, match.end()))
+        start = match.end()
+    if start < len(paragraph):
+        spans.append((start, len(paragraph)))
+    return spans
+
+def best_window(
+        query_terms: Set[str], paragraph: str, margin: int = WINDOW_MARGIN,
+        min_chars: int = WINDOW_MIN_CHARS
+    ) -> Window:
+    """The window of paragraph around the sentence best matching the query.
+
+    The whole paragraph if it's short, or no sentence shares a term with the
+    query (better let the model read it all then).
+    """
+    whole = Window(paragraph, 0)
+    if len(paragraph) < min_chars or len(query_terms) == 0:
+        return whole
+    spans = sentence_spans(paragraph)
+    if len(spans) == 0:
+        return whole
+    matched = [
+        query_terms.intersection(terms(paragraph[start:end]))
+        for start, end in spans
+    ]
+    # sentences each query term is in
+    df = Counter(term for sentence in matched for term in sentence)
+    weight = {term: math.log(1 + len(spans) / n) for term, n in df.items()}
+    scores = [sum(weight[term] for term in sentence) for sentence in matched]
+    best = max(range(len(spans)), key=lambda i: scores[i])
+    if scores[best] == 0:
+        return whole
+    start = spans[max(best - margin, 0)][0]
+    end = spans[min(best + margin, len(spans) - 1)][1]
+    return Window(paragraph[start:end], start)
+
+def query_windows(query: str, paragraphs: List[str]) -> List[Window]:
+    """The window of each paragraph for query."""
+    query_terms = set(terms(query))
+    return [best_window(query_terms, paragraph) for paragraph in paragraphs]
+
+def answer_start(answer: Dict[str,Any], window: Window) -> Optional[int]:
+    """Where the answer the model found in window starts in its paragraph."""
+    if answer['answer'] == '' or 'start' not in answer:
+        return None
+    return window.start + answer['start']
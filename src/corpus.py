@@ -0,0 +1,178 @@
+# corpus.py
+"""
+Change-aware loader for the paragraphs in a source directory
+
+The loader keeps a manifest of (mtime, size, md5) for every file it has
+handed out.  A reindex stats the directory (the only thing done while holding
+the `source_docs` lock), reads just the files whose stat changed on a thread
+pool, and skips those whose content hash turns out to be the same anyway.
+Paragraphs are yielded as they are read rather than collected into a list.
+
+A file that can't be decoded is treated like a removed one: its passages are
+deleted, and its stat is recorded (with an empty hash) so that it isn't read
+again until it changes.
+
+The manifest lives in memory; a new process either restores it from a
+snapshot (see snapshots.py) or reads every file on its first load.
+"""
+
+import asyncio
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from hashlib import md5
+from pathlib import Path
+from typing import Dict, List, Iterator, Iterable, NamedTuple, Optional, Deque
+
+from util import source_docs_lock, log
+
+# number of files read concurrently
+READ_WORKERS = 8
+# manifest hash of a file that couldn't be decoded
+UNREADABLE = ''
+
+class ParagraphInfo(NamedTuple):
+    text: str
+    filename: str
+
+class FileStat(NamedTuple):
+    name: str
+    mtime_ns: int
+    size: int
+
+class ManifestEntry(NamedTuple):
+    mtime_ns: int
+    size: int
+    hash: str
+
+class FileRead(NamedTuple):
+    stat: FileStat
+    text: Optional[str]
+    hash: str
+
+def scan(source_dir: str) -> List[FileStat]:
+    """Stat every *.txt file in source_dir (blocking)."""
+    stats: List[FileStat] = []
+    with os.scandir(source_dir) as entries:
+        for entry in entries:
+            if not entry.name.endswith('.txt') or not entry.is_file():
+                continue
+            st = entry.stat()
+            stats.append(FileStat(entry.name, st.st_mtime_ns, st.st_size))
+    return stats
+
+def read_file(path: Path, stat: FileStat) -> FileRead:
+    """Read and hash one file (blocking).
+
+    The hash is the md5 of the raw bytes, which is what
+    `create_index.get_hash` computes for the decoded text.  A file that isn't
+    valid utf-8 comes back with `text=None`.
+    """
+    data = path.read_bytes()
+    _hash = md5(data).hexdigest()
+    try:
+        return FileRead(stat, data.decode('utf-8'), _hash)
+    except UnicodeDecodeError as e:
+        log.error(f'encoding error in {path}, skipping: {e}')
+        return FileRead(stat, None, _hash)
+
+class CorpusLoader:
+    """Load paragraphs from source_dir, optionally only the changed ones."""
+    source_dir: str
+    manifest: Dict[str,ManifestEntry]
+    pool: ThreadPoolExecutor
+    workers: int
+    # files that couldn't be decoded since the last snapshot
+    unreadable: List[str]
+    _snapshot: List[FileStat]
+    _staged: Dict[str,ManifestEntry]
+
+    def __init__(self, source_dir: str, workers: int = READ_WORKERS):
+        self.source_dir = source_dir
+        self.manifest = {}
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.workers = workers
+        self.unreadable = []
+        self._snapshot = []
+        self._staged = {}
+
+    async def snapshot(self) -> List[FileStat]:
+        """Stat the directory, holding the `source_docs` lock meanwhile."""
+        async with source_docs_lock(self.source_dir):
+            self._snapshot = await asyncio.get_running_loop().run_in_executor(
+                self.pool, scan, self.source_dir
+            )
+        self._staged = {}
+        self.unreadable = []
+        return self._snapshot
+
+    def changed(self, stats: Iterable[FileStat]) -> List[FileStat]:
+        """Files whose mtime or size differ from the manifest."""
+        def is_changed(stat: FileStat) -> bool:
+            entry = self.manifest.get(stat.name, None)
+            return entry is None or \
+                (entry.mtime_ns, entry.size) != (stat.mtime_ns, stat.size)
+        return [stat for stat in stats if is_changed(stat)]
+
+    def removed(self, stats: Iterable[FileStat]) -> List[str]:
+        """Files in the manifest that are gone from the directory."""
+        names = set(stat.name for stat in stats)
+        return [name for name in self.manifest if name not in names]
+
+    def read(
+            self, stats: Iterable[FileStat], changed_only: bool = False
+        ) -> Iterator[ParagraphInfo]:
+        """Read files concurrently, yielding paragraphs in order.
+
+        With `changed_only`, files whose content hash matches the manifest
+        (e.g. touched but not edited) are not yielded.  Entries for what was
+        read are staged, and only go into the manifest on `commit`.
+        """
+        source_path = Path(self.source_dir)
+        pending: Deque[Future] = deque()
+        for stat in stats:
+            path = source_path / stat.name
+            pending.append(self.pool.submit(read_file, path, stat))
+            if len(pending) >= 2 * self.workers:
+                yield from self._take(pending.popleft(), changed_only)
+        while len(pending) > 0:
+            yield from self._take(pending.popleft(), changed_only)
+
+    def _take(self, future: Future, changed_only: bool) -> Iterator[ParagraphInfo]:
+        try:
+            result: FileRead = future.result()
+        except OSError as e:
+            # deleted or unreadable since the snapshot, next reindex will see
+            log.error(f'error reading paragraph: {e}')
+            return
+        stat = result.stat
+        if result.text is None:
+            self.unreadable.append(stat.name)
+            self._staged[stat.name] = ManifestEntry(stat.mtime_ns, stat.size, UNREADABLE)
+            return
+        previous = self.manifest.get(stat.name, None)
+        self._staged[stat.name] = ManifestEntry(stat.mtime_ns, stat.size, result.hash)
+        if changed_only and previous is not None and previous.hash == result.hash:
+            return
+        yield ParagraphInfo(result.text, stat.name)
+
+    def commit(self):
+        """Record what was read since the last snapshot as indexed."""
+        names = set(stat.name for stat in self._snapshot)
+        manifest = {
+            name: entry for name, entry in self.manifest.items()
+            if name in names
+        }
+        manifest.update(self._staged)
+        self.manifest = manifest
+        self._staged = {}
+
+    def load(self, manifest: Dict[str,ManifestEntry]):
+        """Start from a manifest saved earlier (see snapshots.py)."""
+        self.manifest = dict(manifest)
+        self._staged = {}
+
+    def clear(self):
+        """Forget everything, the next load reads every file."""
+        self.manifest = {}
+        self._staged = {}
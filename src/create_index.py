@@ -7,33 +7,134 @@ Run this script to create the index, and import the function
 """
 
 from pathlib import Path
-from typing import List, Optional, Dict, Any, NamedTuple
+from typing import List, Optional, Dict, Any, NamedTuple, Iterable, Iterator
+from typing import Tuple, DefaultDict, Set
+from collections import defaultdict
 from hashlib import md5
 import asyncio
 
 from elasticsearch import Elasticsearch # type: ignore
+import elasticsearch.helpers as helpers # type: ignore
 
 from util import Paragraph, INDEX_NAME, ANALYZER_NAME
-from util import named_locks, es, loop, SOURCE_DIR, log
-
-class ParagraphInfo(NamedTuple):
-    text: str
-    filename: str
-
-async def get_paragraphs() -> List[ParagraphInfo]:
-    """Turn return a list of strings - each .txt file from the directory"""
-    async with named_locks['source_docs']:
-        path = Path(SOURCE_DIR)
-        result: List[ParagraphInfo] = []
-        for filename in path.glob('*.txt'):
-            print(f'processing: {filename}')
-            #
-            # TODO: check for encoding errors
-            #
-            with open(filename) as file:
-                text = file.read()
-                result.append(ParagraphInfo(text,filename.name))
-        return result
+from util import named_locks, es, loop, SOURCE_DIR, PACKED_DIR, log
+from util import RETRIEVAL_CACHE_SIZE
+from corpus import CorpusLoader, ParagraphInfo
+from passages import Passage, split_passages
+from packed_store import PackedStore
+from tracing import span, traced_lock
+from retrieval_cache import RetrievalCache
+
+corpus = CorpusLoader(SOURCE_DIR)
+packed = PackedStore(PACKED_DIR, SOURCE_DIR)
+
+# Bumped on every write to an index, so anything derived from search results
+# can be keyed by (or invalidated on) the generation it was computed at.
+index_generations: DefaultDict[str,int] = defaultdict(int)
+# top hits by the analyzed query, see retrieval_cache.py
+retrieval_cache = RetrievalCache(RETRIEVAL_CACHE_SIZE)
+
+def bump_generation(index: str):
+    index_generations[index] += 1
+    retrieval_cache.invalidate(index)
+
+# Passages with the same text (by `hash`) held by more than one doc, as of
+# the last index pass: index -> hash -> docIds.  Search collapses them into
+# one hit either way.
+duplicate_groups: Dict[str,Dict[str,List[str]]] = {}
+
+class PassageHashes:
+    """The passage hashes of every doc of an index, and the docs of each."""
+    docs: Dict[str,Set[str]]
+    hashes: Dict[str,Set[str]]
+
+    def __init__(self):
+        self.docs = {}
+        self.hashes = {}
+
+    def set(self, docId: str, hashes: Iterable[str]) -> Set[str]:
+        """Replace the hashes of docId (none: it's gone), return those affected."""
+        old = self.hashes.pop(docId, set())
+        for h in old:
+            self.docs[h].discard(docId)
+            if len(self.docs[h]) == 0:
+                del self.docs[h]
+        new = set(hashes)
+        if len(new) > 0:
+            self.hashes[docId] = new
+        for h in new:
+            self.docs.setdefault(h, set()).add(docId)
+        return old | new
+
+# index -> its PassageHashes, known once an index pass ran in this process
+passage_hashes: Dict[str,PassageHashes] = {}
+
+def load_passage_hashes(index: str) -> PassageHashes:
+    """The passage hashes of index as they are in ES (blocking, scans it)."""
+    es.indices.refresh(index=index)
+    by_doc: Dict[str,Set[str]] = {}
+    for hit in helpers.scan(es, index=index, query={'_source': ['hash', 'docId']}):
+        source = hit['_source']
+        if 'hash' in source:
+            # docs indexed before passages existed have no docId
+            docId = source.get('docId', hit['_id'])
+            by_doc.setdefault(docId, set()).add(source['hash'])
+    table = PassageHashes()
+    for docId, hashes in by_doc.items():
+        table.set(docId, hashes)
+    return table
+
+def update_duplicates(
+        index: str, hashes: Dict[str,List[str]], docIds: Iterable[str]
+    ):
+    """Update `duplicate_groups` after docIds were (re)indexed or deleted.
+
+    `hashes` maps the hashes of the passages just indexed to their docIds
+    (see `index_bulk`), docs deleted have none.  The first time in a process
+    the hashes of the whole index are read from ES.  Blocking.
+    """
+    by_doc: Dict[str,Set[str]] = {}
+    for h, hash_docIds in hashes.items():
+        for docId in hash_docIds:
+            by_doc.setdefault(docId, set()).add(h)
+    table = passage_hashes.get(index, None)
+    # replaced whole, so readers never see it half updated
+    groups = dict(duplicate_groups.get(index, {}))
+    if table is None:
+        # ES has this pass already
+        table = passage_hashes[index] = load_passage_hashes(index)
+        groups = {}
+        affected = set(table.docs)
+    else:
+        affected = set()
+        for docId in docIds:
+            affected |= table.set(docId, by_doc.get(docId, ()))
+    for h in affected:
+        holders = table.docs.get(h, set())
+        if len(holders) > 1:
+            groups[h] = sorted(holders)
+        else:
+            groups.pop(h, None)
+    duplicate_groups[index] = groups
+
+def count_copies(groups: Dict[str,List[str]]) -> int:
+    """Docs holding a passage some other doc holds too, beyond the first."""
+    return sum(len(docIds) - 1 for docIds in groups.values())
+
+async def get_paragraphs(
+        changed_only: bool = False, corpus: CorpusLoader = corpus
+    ) -> Iterator[ParagraphInfo]:
+    """Return an iterator over the .txt files in the source directory.
+
+    The directory is snapshotted (under the `source_docs` lock) before
+    returning, the files themselves are read concurrently while iterating.
+    With `changed_only`, only files changed since the last `corpus.commit`
+    are produced.
+    """
+    stats = await corpus.snapshot()
+    if changed_only:
+        stats = corpus.changed(stats)
+    return corpus.read(stats, changed_only=changed_only)
 
 def get_hash(s: Paragraph) -> str:
     """
@@ -45,6 +146,22 @@ def get_hash(s: Paragraph) -> str:
     """
     return md5(bytes(s, encoding='utf-8')).hexdigest()
 
+# fields of a passage, `docId` and `offset` locate it in its source file
+passage_properties = {
+    'hash': {'type': 'keyword'},
+    'docId': {'type': 'keyword'},
+    'offset': {'type': 'integer'},
+    'length': {'type': 'integer'},
+    # the same in bytes of the file's UTF-8, to slice the packed store by
+    'byte_offset': {'type': 'integer'},
+    'byte_length': {'type': 'integer'},
+    'passage': {'type': 'integer'},
+}
+
+def uses_stemmer(index: str) -> bool:
+    """Whether index is (or would be) created with `myanalyzer`."""
+    return 'stem' in index
+
 # This used to lock, its only use case caused a deadlock...
 def create_index_with_stemmer(index: str):
     """Create index with name using custom text analysis."""
@@ -53,56 +170,289 @@ def create_index_with_stemmer(index: str):
         'tokenizer': 'standard',
         'filter': ['asciifolding','lowercase','porter_stem']
     }
+    properties = {'text': {'type': 'text', 'analyzer':'myanalyzer'}}
+    properties.update(passage_properties)
     body = {
         'settings': {'analysis': {'analyzer': {ANALYZER_NAME: myanalyzer}}},
-        'mappings': {'properties': {
-                'text': {'type': 'text', 'analyzer':'myanalyzer'},
-                'hash': {'type': 'keyword'}}}}
+        'mappings': {'properties': properties}}
     es.indices.create(index=index,body=body)
 
+def passage_action(index: str, passage: Passage) -> Dict[str,Any]:
+    """Bulk action indexing one passage."""
+    return {
+        '_index': index,
+        '_id': passage.id,
+        '_source': {
+            'text': passage.text,
+            'hash': get_hash(passage.text),
+            'docId': passage.docId,
+            'offset': passage.offset,
+            'length': len(passage.text),
+            'byte_offset': passage.byte_offset,
+            'byte_length': len(passage.text.encode('utf-8')),
+            'passage': passage.position,
+        },
+    }
+
 def index_one(index: str, paragraph: Paragraph, docId: str):
-    _id = docId
-    _hash = get_hash(paragraph)
-    body = {'text':paragraph, 'hash': _hash}
-    es.index(index=index, body=body, id=_id)
-
-async def index_all(index: str):
-    """Create a new index and index all paragraphs.
-    
+    """Index the passages of a single (new) doc."""
+    passages = split_passages(paragraph, docId)
+    helpers.bulk(es, [passage_action(index, p) for p in passages])
+    bump_generation(index)
+
+def index_bulk(
+        index: str, paragraphs: Iterable[ParagraphInfo],
+        written: Optional[Dict[str,List[str]]] = None,
+        hashes: Optional[Dict[str,List[str]]] = None
+    ) -> int:
+    """Index paragraphs with one streaming bulk request.
+
+    `paragraphs` is consumed lazily (the bulk helper sends it in chunks), so
+    it may be a generator over an arbitrarily large corpus.  Each paragraph
+    is split into passages (see `split_passages`).  If `written` is given, it
+    is filled with the ids of the passages indexed for each docId, and
+    `hashes` with the docIds holding each passage hash.
+    Returns the number of passages indexed.
+    """
+    def actions():
+        for paragraph,filename in paragraphs:
+            for passage in split_passages(paragraph, filename):
+                if written is not None:
+                    written.setdefault(passage.docId, []).append(passage.id)
+                action = passage_action(index, passage)
+                if hashes is not None:
+                    docIds = hashes.setdefault(action['_source']['hash'], [])
+                    docIds.append(passage.docId)
+                yield action
+    try:
+        success, _ = helpers.bulk(es, actions())
+    finally:
+        bump_generation(index)
+    return success
+
+# docIds per delete_by_query request (ES caps the size of a terms query)
+DELETE_CHUNK = 1000
+
+def delete_passages(
+        index: str, docIds: List[str],
+        keep: Optional[Dict[str,List[str]]] = None
+    ):
+    """Delete the passages of the given docs from the index.
+
+    `keep` maps docIds to the ids of passages to leave alone, which is how
+    the leftovers of a doc that was reindexed into fewer passages go away.
+    Docs indexed before passages existed have no `docId` field, but their
+    id is the docId, so they're matched by id as well.
+    """
+    if len(docIds) == 0:
+        return
+    # make recently indexed passages visible to the query
+    es.indices.refresh(index=index)
+    for i in range(0, len(docIds), DELETE_CHUNK):
+        chunk = docIds[i:i + DELETE_CHUNK]
+        of_docs = {'bool': {'should': [
+            {'terms': {'docId': chunk}},
+            {'ids': {'values': chunk}},
+        ], 'minimum_should_match': 1}}
+        query: Dict[str,Any] = {'bool': {'filter': of_docs}}
+        if keep is not None:
+            kept = [_id for docId in chunk for _id in keep.get(docId, [])]
+            if len(kept) > 0:
+                query['bool']['must_not'] = {'ids': {'values': kept}}
+        es.delete_by_query(index=index, body={'query': query}, conflicts='proceed')
+    bump_generation(index)
+
+def recreate_index(index: str):
+    """Delete the index (if it exists) and create it again, empty.
+
     If the name of the index contains the string `stem`, it will be created
     using the function `create_index_with_stemmer`.
     """
+    log.info(f'creating index named: {index}')
+    if es.indices.exists(index=index):
+        es.indices.delete(index=index)
+        log.info(f'deleted index: {index}')
+    if uses_stemmer(index):
+        create_index_with_stemmer(index)
+    else:
+        body = {'mappings': {'properties': passage_properties}}
+        es.indices.create(index=index, body=body)
+    bump_generation(index)
+    log.info(f'created index: {index}')
+
+async def index_all(index: str, corpus: CorpusLoader = corpus):
+    """Create a new index and index all paragraphs."""
     async with named_locks[index]:
-        log.info(f'creating index named: {index}')
-        if es.indices.exists(index=index):
-            es.indices.delete(index=index)
-            log.info(f'deleted index: {index}')
-        if 'stem' in index:
-            create_index_with_stemmer(index)
-        else:
-            es.indices.create(index=index)
-        log.info(f'created index: {index}')
-        data = await get_paragraphs()
-        for paragraph,filename in data:
-            index_one(index, paragraph, filename)
-        log.info(f'done indexing paragraphs')
+        recreate_index(index)
+        corpus.clear()
+        data = await get_paragraphs(corpus=corpus)
+        hashes: Dict[str,List[str]] = {}
+        await asyncio.get_running_loop().run_in_executor(None, index_bulk, index, data, None, hashes)
+        corpus.commit()
+        reset_duplicates(index, hashes)
+        groups = duplicate_groups[index]
+        log.info(f'done indexing paragraphs '
+                 f'({len(groups)} duplicated, {count_copies(groups)} copies)')
+
+def reset_duplicates(index: str, hashes: Dict[str,List[str]]):
+    """`update_duplicates` for an index that was just indexed from scratch."""
+    passage_hashes[index] = PassageHashes()
+    duplicate_groups[index] = {}
+    docIds = {docId for docIds in hashes.values() for docId in docIds}
+    update_duplicates(index, hashes, docIds)
+
+async def index_changed(
+        index: str, corpus: CorpusLoader = corpus
+    ) -> Tuple[int,int]:
+    """Bring the index up to date with the source directory.
+
+    Only paragraphs changed since the last index pass are read and indexed,
+    and paragraphs removed from the directory are deleted from the index.
+    Falls back to `index_all` if the index doesn't exist, or if nothing has
+    been loaded in this process yet (deletions can't be known without the
+    manifest).
+    Returns the number of (indexed, deleted) docs.
+    """
+    if len(corpus.manifest) == 0 or not es.indices.exists(index=index):
+        await index_all(index, corpus)
+        return len(corpus.manifest), 0
+    async with named_locks[index]:
+        stats = await corpus.snapshot()
+        removed = corpus.removed(stats)
+        data = corpus.read(corpus.changed(stats), changed_only=True)
+        written: Dict[str,List[str]] = {}
+        hashes: Dict[str,List[str]] = {}
+        indexed = await asyncio.get_running_loop().run_in_executor(
+            None, index_bulk, index, data, written, hashes
+        )
+        # docs that can no longer be read are gone as far as the index goes
+        removed += corpus.unreadable
+        # a changed doc may now have fewer passages than before
+        delete_passages(index, removed + list(written), keep=written)
+        corpus.commit()
+        await asyncio.get_running_loop().run_in_executor(
+            None, update_duplicates, index, hashes, removed + list(written)
+        )
+        log.info(f'reindexed {indexed} changed, deleted {len(removed)}')
+        return indexed, len(removed)
+
+# fields fetched from ES when the text can be sliced out of `packed`
+slice_fields = ['docId', 'offset', 'length', 'byte_offset', 'byte_length', 'hash']
+# most docIds listed for one collapsed passage
+MAX_COPIES = 100
+
+def text_from_packed(
+        source: Dict[str,Any], packed: PackedStore = packed
+    ) -> Optional[str]:
+    """Passage text sliced out of the packed store, if it's there and current.
+
+    The store may lag the index for a moment after a write, so the slice
+    only counts if it hashes like the indexed passage did.  Passages indexed
+    before byte offsets were recorded are sliced out of the whole doc.
+    """
+    if 'length' not in source or 'docId' not in source:
+        return None
+    if 'byte_offset' in source:
+        text = packed.get_slice(
+            source['docId'], source['byte_offset'], source['byte_length']
+        )
+    else:
+        doc = packed.get(source['docId'])
+        offset = source['offset']
+        text = doc[offset:offset + source['length']] if doc is not None else None
+    if text is None or get_hash(text) != source.get('hash', None):
+        return None
+    return text
+
+def fill_missing_texts(index: str, hits: List[Dict[str,Any]]):
+    """Fetch the texts of hits the packed store couldn't provide from ES."""
+    missing = [hit['_id'] for hit in hits if hit['text'] is None]
+    if len(missing) == 0:
+        return
+    log.debug(f'{len(missing)} passages not in the packed store')
+    docs = es.mget(index=index, body={'ids': missing}, _source=['text'])
+    texts = {doc['_id']: doc['_source']['text']
+             for doc in docs['docs'] if doc.get('found', False)}
+    for hit in hits:
+        if hit['text'] is None:
+            hit['text'] = texts.get(hit['_id'], '')
 
 async def get_paragraphs_for_query(
-        query: str, index: str, topk=3
+        query: str, index: str, topk=3, packed: PackedStore = packed
     ) -> List[Dict[str,Any]]:
     """Retrieve paragraphs from elasticsearch using query as search term.
 
     By default, uses the index `INDEX_NAME` and returns the top 3 results.
+    Passages with the same text are collapsed (on `hash`) into one result,
+    whose `docIds` lists every doc holding it.
+    When the packed store is built, ES only returns ids and offsets and the
+    text comes from the store (falling back to ES for passages it can't
+    provide).  The requests to ES run on the default executor, so searches
+    of different indices can run concurrently.
+    Results are cached by the analyzed query (see retrieval_cache.py), a
+    cached query only goes to ES for texts the packed store doesn't have.
     """
-    async with named_locks[index]:
-        body = {'query':{'match':{'text':query}}, 'size':topk}
+    key = retrieval_cache.key(
+        query, index, topk, index_generations[index], uses_stemmer(index)
+    )
+    cached = retrieval_cache.get(key) if key is not None else None
+    if cached is not None:
+        for hit in cached:
+            hit['text'] = text_from_packed(hit.pop('source'), packed)
+        if all(hit['text'] is not None for hit in cached):
+            return cached
+        async with traced_lock(named_locks[index], index):
+            with span('es mget', 'es', index=index):
+                await asyncio.get_running_loop().run_in_executor(None, fill_missing_texts, index, cached)
+        return cached
+    body: Dict[str,Any] = {
+        'query': {'match': {'text': query}},
+        'size': topk,
+        'collapse': {'field': 'hash', 'inner_hits': {
+            'name': 'copies', 'size': MAX_COPIES,
+            '_source': ['docId'], 'sort': [{'docId': 'asc'}],
+        }},
+    }
+    if packed.commit is not None:
+        body['_source'] = slice_fields
+    def get_docId(hit):
+        # docs indexed before passages existed have no docId/offset
+        return hit['_source'].get('docId', hit['_id'])
+    def get_hit(hit):
+        source = hit['_source']
+        copies = hit.get('inner_hits', {}).get('copies', {})
+        docIds = [get_docId(c) for c in copies.get('hits', {}).get('hits', [])]
+        return {
+            'text': source['text'] if 'text' in source else text_from_packed(source, packed),
+            '_id': hit['_id'],
+            'score': hit['_score'],
+            'docId': get_docId(hit),
+            'docIds': sorted(set(docIds)) or [get_docId(hit)],
+            'offset': source.get('offset', 0),
+        }
+    # what's cached of a hit: no text, but where to slice it from
+    def cached_hit(hit, result):
+        source = {f: hit['_source'][f] for f in slice_fields if f in hit['_source']}
+        return dict(result, text=None, source=source)
+    cache_entry: List[Dict[str,Any]] = []
+    def search() -> List[Dict[str,Any]]:
         reply = es.search(index=index, body=body)
         if reply['hits']['total']['value'] == 0:
             return []
-        else:
-            def get_hit(hit):
-                return {'text': hit['_source']['text'], '_id': hit['_id']}
-            return [get_hit(hit) for hit in reply['hits']['hits']]
+        hits = [get_hit(hit) for hit in reply['hits']['hits']]
+        cache_entry.extend(
+            cached_hit(hit, result)
+            for hit, result in zip(reply['hits']['hits'], hits)
+        )
+        fill_missing_texts(index, hits)
+        return hits
+    async with traced_lock(named_locks[index], index):
+        with span('es search', 'es', index=index, topk=topk):
+            hits = await asyncio.get_running_loop().run_in_executor(None, search)
+    # not if the index was written to meanwhile
+    if key is not None and key[1] == index_generations[index]:
+        retrieval_cache.put(key, cache_entry)
+    return hits
 
 if __name__ == '__main__':
     # directory containing the paragraphs for the site
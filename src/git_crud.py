@@ -1,20 +1,24 @@
 # index_crud.py
 
 import asyncio
-from asyncio import Lock, StreamReader
-from asyncio.subprocess import PIPE
+from asyncio import Lock, Future
+from asyncio.subprocess import PIPE, DEVNULL
 import re
+import json
+from hashlib import md5
 from typing import Optional, Coroutine, DefaultDict, Dict, Callable
-from typing import cast, Tuple, Iterable, Union, List, Any
+from typing import cast, Tuple, Iterable, Union, List, Any, AsyncIterator
+from typing import Deque, NamedTuple
 from pathlib import Path
-from collections import defaultdict
+from collections import defaultdict, deque
 import logging
 from uuid import uuid4
 import functools
 
-from aiohttp.web import Response, json_response
+from aiohttp.web import Request, Response, StreamResponse, json_response
 
 from util import log
+from tracing import span
 
 named_locks: DefaultDict[str,Lock] = defaultdict(Lock)
 # should be an initialized git repo!
@@ -51,35 +55,56 @@ class GitError(RuntimeError):
 
     @property
     def response(self) -> Response:
-        return Response(status=500, reason=repr(self))
+        # git's stderr is multiline, so it goes in the body, not the reason
+        return json_response({
+            'error_type': self.__class__.__name__,
+            'cmd_args': list(self.cmd_args),
+            'message': self.message,
+        }, status=500)
 
 class GitAddError(GitError): pass
 class GitResetError(GitError): pass
 class GitRmError(GitError): pass
 class GitCommitError(GitError): pass
+class GitUpdateRefError(GitError): pass
+class GitFastImportError(GitError): pass
 
-async def get_output(reader: Optional[StreamReader]) -> str:
-    if isinstance(reader, StreamReader):
-        output = await reader.read()
-        return output.decode('utf-8')
-    return ''
- 
-async def _git_dispatch(git_dir: str, args, GitErrorClass, *, log_error=True, reset=False):
+# seconds a git command may take before it's killed
+GIT_TIMEOUT = 60.
+GIT_PULL_TIMEOUT = 300.
+
+async def _git_dispatch(
+        git_dir: str, args, GitErrorClass, *, log_error=True, reset=False,
+        timeout: float = GIT_TIMEOUT
+    ) -> str:
+    """Run a git command in git_dir, return its output.
+
+    Both pipes are drained while the command runs (it would block on a full
+    pipe otherwise), and it's killed if it takes longer than `timeout`.
+    """
     git = await asyncio.create_subprocess_exec(
             'git','-C',git_dir, *args,
-            stdin=PIPE, stdout=PIPE, stderr=PIPE
+            stdin=DEVNULL, stdout=PIPE, stderr=PIPE
         )
-    await git.wait()
+    try:
+        out, err = await asyncio.wait_for(git.communicate(), timeout)
+    except asyncio.TimeoutError:
+        git.kill()
+        await git.wait()
+        raise GitErrorClass(args, f'timed out after {timeout}s', log_error=log_error)
+    except asyncio.CancelledError:
+        git.kill()
+        await git.wait()
+        raise
     if git.returncode != 0:
-        err_str = await get_output(git.stderr)
+        err_str = err.decode('utf-8', errors='replace')
         log.error(f'git error: {args}, {git.returncode}, code {err_str}')
         if reset:
             await git_reset(git_dir)
-        args = (err_str,log_error)
-        raise GitErrorClass(args)
-    else:
-        out_str = await get_output(git.stdout)
-        log.info(out_str)
+        raise GitErrorClass(args, err_str, log_error=log_error)
+    out_str = out.decode('utf-8')
+    log.info(out_str)
+    return out_str
 
 async def git_add(git_dir: str, docId: DocId):
     await _git_dispatch(git_dir, ('add',docId), GitAddError, reset=True)
@@ -103,9 +128,252 @@ async def git_init(git_dir: str):
 
 # TODO make this a little better (remote name and branch...)
 async def git_pull(git_dir: str):
-    await _git_dispatch(git_dir, ('pull','origin','master'), GitError)
+    args = ('pull','origin','master')
+    await _git_dispatch(git_dir, args, GitError, timeout=GIT_PULL_TIMEOUT)
     log.info(f'git SUCCESS: [init]')
 
+async def git_head_ref(git_dir: str) -> str:
+    """Name of the branch HEAD points at (works on an unborn branch too)."""
+    out = await _git_dispatch(git_dir, ('symbolic-ref','-q','HEAD'), GitError)
+    return out.strip()
+
+async def git_ref_commit(git_dir: str, ref: str) -> Optional[str]:
+    """Commit a ref points at, or None if the ref doesn't exist (yet)."""
+    args = ('for-each-ref','--format=%(objectname)',ref)
+    out = await _git_dispatch(git_dir, args, GitError)
+    lines = out.split()
+    return lines[0] if len(lines) > 0 else None
+
+async def git_update_ref(git_dir: str, ref: str, new: str, old: Optional[str]):
+    """Atomically move ref to new, failing if it no longer points at old."""
+    old_ = old if old is not None else '0'*40
+    await _git_dispatch(git_dir, ('update-ref',ref,new,old_), GitUpdateRefError)
+    log.info(f'git SUCCESS: [update-ref] {ref} {new}')
+
+async def git_delete_ref(git_dir: str, ref: str):
+    await _git_dispatch(git_dir, ('update-ref','-d',ref), GitUpdateRefError)
+    log.info(f'git SUCCESS: [update-ref -d] {ref}')
+
+async def git_read_tree(git_dir: str, old: str, new: str):
+    """Fast-forward the index and working tree from commit old to new."""
+    await _git_dispatch(git_dir, ('read-tree','-m','-u',old,new), GitError)
+    log.info(f'git SUCCESS: [read-tree] {old}..{new}')
+
+async def git_diff_names(git_dir: str, old: str, new: str) -> List[str]:
+    """Paths that differ between commits old and new (added, changed or
+    removed)."""
+    args = ('diff','--name-only','--no-renames','-z',old,new)
+    out = await _git_dispatch(git_dir, args, GitError)
+    return [name for name in out.split('\0') if name != '']
+
+async def git_committer_ident(git_dir: str) -> str:
+    out = await _git_dispatch(git_dir, ('var','GIT_COMMITTER_IDENT'), GitError)
+    return out.strip()
+
+class Change(NamedTuple):
+    """One writer's change to the working tree, to be committed."""
+    add: List[str]
+    remove: List[str]
+    message: str
+
+async def git_commit_changes(git_dir: str, changes: List[Change]):
+    """Stage the paths of changes and commit them together.
+
+    On failure they are unstaged again, so the index is as it was.
+    """
+    add = [name for change in changes for name in change.add]
+    remove = [name for change in changes for name in change.remove]
+    if len(changes) == 1:
+        message = changes[0].message
+    else:
+        message = f'{len(changes)} changes\n\n'
+        message += '\n'.join(change.message for change in changes)
+    try:
+        if len(add) > 0:
+            await _git_dispatch(git_dir, ('add','--',*add), GitAddError)
+        if len(remove) > 0:
+            args = ('rm','-q','--cached','--ignore-unmatch','--',*remove)
+            await _git_dispatch(git_dir, args, GitRmError)
+        await _git_dispatch(git_dir, ('commit','-q','-m',message), GitCommitError)
+    except GitError:
+        await git_unstage(git_dir, add + remove)
+        raise
+    log.info(f'git SUCCESS: [commit] {len(changes)} changes')
+
+async def git_unstage(git_dir: str, names: List[str]):
+    try:
+        await _git_dispatch(git_dir, ('reset','-q','--',*names), GitResetError)
+    except GitError:
+        # e.g. nothing committed yet, nothing was staged either then
+        pass
+
+async def git_restore(git_dir: str, names: List[str]):
+    """Put (unstaged) names in the working tree back as they're committed."""
+    out = await _git_dispatch(git_dir, ('ls-files','-z','--',*names), GitError)
+    tracked = [name for name in out.split('\0') if name != '']
+    if len(tracked) > 0:
+        await _git_dispatch(git_dir, ('checkout','-q','--',*tracked), GitError)
+    for name in set(names) - set(tracked):
+        path = Path(git_dir) / name
+        if path.exists():
+            path.unlink()
+    log.info(f'git SUCCESS: [restore] {names}')
+
+class Committer:
+    """Commits the changes of concurrent writers, grouped.
+
+    Writers change the working tree (under their docs' locks) and hand the
+    change over with `commit`.  Changes handed over while a commit is being
+    made all go into the next one, so the repo lock is taken once per group,
+    not once per writer.  If a group fails, its changes are retried one by
+    one, and only a change that fails alone is rolled back.
+    """
+    git_dir: str
+    lock: Lock
+    pending: List[Tuple[Change,Future]]
+
+    def __init__(self, git_dir: str, lock: Lock):
+        self.git_dir = git_dir
+        self.lock = lock
+        self.pending = []
+        self.counts = {'changes': 0, 'commits': 0, 'failed': 0}
+        self._task: Optional[asyncio.Task] = None
+
+    async def commit(self, change: Change):
+        """Commit change, raises why it failed (a GitError) if it was rolled back."""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((change, future))
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._work())
+        # the commit goes ahead even if the writer is cancelled
+        try:
+            await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # but the writer keeps its docs' locks until it's committed (or
+            # rolled back), so no other writer touches them meanwhile
+            while not future.done():
+                try:
+                    await asyncio.shield(future)
+                except (asyncio.CancelledError, Exception):
+                    pass
+            raise
+
+    async def _work(self):
+        batch: List[Tuple[Change,Future]] = []
+        error: Optional[BaseException] = None
+        try:
+            while len(self.pending) > 0:
+                batch, self.pending = self.pending, []
+                async with self.lock:
+                    await self._commit(batch)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._task = None
+            # writers wait holding their docs' locks, none may be left waiting
+            unresolved = [future for _, future in batch + self.pending
+                          if not future.done()]
+            self.pending = []
+            for future in unresolved:
+                if isinstance(error, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(
+                        error or RuntimeError('commit worker stopped')
+                    )
+
+    async def _commit(self, batch: List[Tuple[Change,Future]]):
+        changes = [change for change, _ in batch]
+        try:
+            await git_commit_changes(self.git_dir, changes)
+        except Exception as e:
+            # not only GitErrors: git may fail to start at all
+            if len(batch) > 1:
+                log.warning(f'group of {len(batch)} changes failed, '
+                            f'committing them one by one')
+                for item in batch:
+                    await self._commit([item])
+                return
+            change, future = batch[0]
+            self.counts['failed'] += 1
+            try:
+                await git_restore(self.git_dir, change.add + change.remove)
+            except Exception as restore_error:
+                log.error(f'rollback failed: {restore_error!r}')
+            if not future.done():
+                future.set_exception(e)
+            return
+        self.counts['changes'] += len(batch)
+        self.counts['commits'] += 1
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    def stats(self) -> Dict[str,Any]:
+        stats: Dict[str,Any] = dict(self.counts)
+        stats['pending'] = len(self.pending)
+        return stats
+
+class DocLocks:
+    """Locks by docId, so writers of different docs don't wait on each other.
+
+    A docId's lock only exists while it's held or waited for.
+    """
+    locks: Dict[DocId,Lock]
+    users: Dict[DocId,int]
+
+    def __init__(self):
+        self.locks = {}
+        self.users = {}
+
+    def hold(self, docIds: Iterable[DocId]) -> 'HeldDocLocks':
+        return HeldDocLocks(self, docIds)
+
+    def _get(self, docId: DocId) -> Lock:
+        if docId not in self.locks:
+            self.locks[docId] = Lock()
+            self.users[docId] = 0
+        self.users[docId] += 1
+        return self.locks[docId]
+
+    def _put(self, docId: DocId):
+        self.users[docId] -= 1
+        if self.users[docId] == 0:
+            del self.locks[docId]
+            del self.users[docId]
+
+class HeldDocLocks:
+    """`async with` the locks of several docs."""
+    def __init__(self, table: DocLocks, docIds: Iterable[DocId]):
+        self.table = table
+        # always taken in the same order, so writers can't deadlock
+        self.docIds = sorted(set(docIds))
+        self.held: List[DocId] = []
+
+    async def __aenter__(self):
+        try:
+            for docId in self.docIds:
+                lock = self.table._get(docId)
+                try:
+                    await lock.acquire()
+                except BaseException:
+                    self.table._put(docId)
+                    raise
+                self.held.append(docId)
+        except BaseException:
+            self._release()
+            raise
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._release()
+
+    def _release(self):
+        for docId in reversed(self.held):
+            self.table.locks[docId].release()
+            self.table._put(docId)
+        self.held = []
+
 def get_new_path(git_dir: str, doc: Doc, name: Optional[DocId]) -> Optional[Path]:
     """Get a path for creating a new paragraph in the source.
 
@@ -122,33 +390,34 @@ def get_new_path(git_dir: str, doc: Doc, name: Optional[DocId]) -> Optional[Path
             path = Path(git_dir) / name_candidate[:i]
             if not path.exists():
                 return path
+            i += 1
     return None
 
-async def _create(git_dir: str, doc: Doc, name: Optional[DocId]) -> Response:
+async def _create(client: 'GitClient', doc: Doc, name: Optional[DocId]) -> Response:
     """Add paragraph to git_dir, and reindex"""
+    git_dir = client.source_dir
     path = get_new_path(git_dir, doc, name)
     if path is None:
         reason = "could not create file (try passing a name)"
         log.error(reason)
         return Response(status=500, reason=reason)
     path = cast(Path, path)
-    if path.exists():
-        reason = f'{name} already exists'
-        log.error(reason)
-        return Response(status=409, reason=reason)
-    with open(path,'w') as file:
-        print(doc,file=file)
-    ## TODO: windows compatibility
-    try:
-        await git_add(git_dir, path.name)
-        await git_commit(git_dir, f'created: {path.name}')
-        reason = f'{path.name} created successfully'
-        return Response(status=200, reason=reason)
-    except GitError as e:
-        # rollback
-        log.error(f'GitError: {e}')
-        path.unlink()
-        return e.response
+    async with client.doc_locks.hold([path.name]):
+        if path.exists():
+            reason = f'{name} already exists'
+            log.error(reason)
+            return Response(status=409, reason=reason)
+        with open(path,'w') as file:
+            print(doc,file=file)
+        ## TODO: windows compatibility
+        try:
+            # the committer removes the file again if this fails
+            await client.commit(Change([path.name], [], f'created: {path.name}'))
+            reason = f'{path.name} created successfully'
+            return Response(status=200, reason=reason)
+        except GitError as e:
+            log.error(f'GitError: {e}')
+            return e.response
 
 def check_path(git_dir: str, docId: DocId, should_exist: bool) -> Union[Response,Path]:
     path = Path(git_dir) / docId
@@ -166,53 +435,150 @@ def check_path(git_dir: str, docId: DocId, should_exist: bool) -> Union[Response
         return Response(status=404, reason=reason)
     return None
 
-async def _delete(git_dir: str, docId: Union[List[DocId],DocId]) -> Response:
+async def _delete(client: 'GitClient', docId: Union[List[DocId],DocId]) -> Response:
     """Delete paragraph from git_dir, and reindex"""
     if isinstance(docId,list):
-        return await _delete_multi(git_dir, docId)
+        return await _delete_multi(client, docId)
     docId = cast(DocId, docId)
-    path = check_path(git_dir, docId, should_exist=True)
-    if isinstance(path, Response):
-        return path
-    try:
-        await git_rm(git_dir, docId)
-        await git_commit(git_dir, f'removed: {docId}')
-        reason = f'{docId} created successfully'
-        return Response(status=200, reason=reason)
-    except GitRmError as e:
-        reason = f'error removing {docId} from index (check index integrity)'
-        log.error(reason)
-        return e.response
-    except GitError as e:
-        return e.response
-
-async def _delete_multi(git_dir: str, docIds: List[DocId]) -> Response:
-    """Delete paragraph from git_dir, and reindex"""
-    errors = []
-    for docId in docIds:
-        response = await _delete(git_dir, docId)
-        if response.status != 200:
-            errors.append(response.reason)
+    async with client.doc_locks.hold([docId]):
+        path = check_path(client.source_dir, docId, should_exist=True)
+        if isinstance(path, Response):
+            return path
+        path.unlink()
+        try:
+            await client.commit(Change([], [docId], f'removed: {docId}'))
+            reason = f'{docId} deleted successfully'
+            return Response(status=200, reason=reason)
+        except GitRmError as e:
+            reason = f'error removing {docId} from index (check index integrity)'
+            log.error(reason)
+            return e.response
+        except GitError as e:
+            return e.response
+
+def response_error(response: Response) -> Any:
+    """The error of a failed response: its JSON body (GitErrors), else its reason."""
+    if response.content_type == 'application/json' and response.text:
+        return json.loads(response.text)
+    return response.reason
+
+async def _delete_multi(client: 'GitClient', docIds: List[DocId]) -> Response:
+    """Delete paragraph from git_dir, and reindex
+
+    The docs are deleted concurrently, so they're committed together.
+    """
+    responses = await asyncio.gather(*[_delete(client, docId) for docId in docIds])
+    errors = [response_error(r) for r in responses if r.status != 200]
     return json_response({'errors':errors})
 
-async def _read(git_dir: str, docId: Union[DocId,List[DocId]]) -> Response:
-    """Retrieve docId (including wildcards)"""
-    paths: List[Path] = []
+# how many files `iter_read` has in flight on the thread pool at once
+READ_CONCURRENCY = 8
+
+def list_docs(
+        git_dir: str, docIds: List[DocId], cursor: Optional[DocId] = None
+    ) -> List[Path]:
+    """Sorted paths of the .txt docs matching docIds (including wildcards).
+
+    Only names after `cursor` are returned, which is what makes the cursor
+    of a page just the docId of its last doc.  Blocking (globs the directory).
+    """
     git_path = Path(git_dir)
-    if isinstance(docId, DocId):
-        docIds = [cast(DocId,docId)]
-    else:
-        docIds = cast(List[DocId],docId)
+    paths: Dict[str,Path] = {}
     for docId in docIds:
-        paths.extend(list(git_path.glob(docId)))
-    paths = list(filter(lambda path: path.name.endswith('.txt'), paths))
-    docs: List[Dict[str,str]] = []
+        for path in git_path.glob(docId):
+            if path.name.endswith('.txt'):
+                paths[path.name] = path
+    names = sorted(paths)
+    if cursor is not None:
+        names = [name for name in names if name > cursor]
+    return [paths[name] for name in names]
+
+def read_doc(path: Path, meta: bool = False) -> Dict[str,Any]:
+    """Read one doc from disk (blocking).
+
+    With `meta`, return its size and md5 instead of the text: the md5 of the
+    file's content, read as is (no newline translation), so it changes
+    exactly when the file does.
+    """
+    with open(path, encoding='utf-8', newline='') as file:
+        text = file.read()
+    if meta:
+        data = text.encode('utf-8')
+        return {'docId': path.name, 'size': len(data),
+                'hash': md5(data).hexdigest()}
+    return {'docId': path.name, 'text': text}
+
+async def iter_read(
+        paths: Iterable[Path], meta: bool = False
+    ) -> AsyncIterator[Dict[str,Any]]:
+    """Read docs on the thread pool and yield them in order as they arrive.
+
+    At most READ_CONCURRENCY reads are outstanding, so memory is bounded no
+    matter how many paths are given.
+    """
+    pending: Deque[Any] = deque()
     for path in paths:
-        with open(path) as file:
-            docs.append({'docId':path.name, 'text': file.read()})
-    data = {'docs': docs }
+        pending.append(asyncio.get_running_loop().run_in_executor(
+            None, read_doc, path, meta
+        ))
+        if len(pending) >= READ_CONCURRENCY:
+            yield await pending.popleft()
+    while len(pending) > 0:
+        yield await pending.popleft()
+
+def as_list(docId: Union[DocId,List[DocId]]) -> List[DocId]:
+    if isinstance(docId, DocId):
+        return [cast(DocId,docId)]
+    return cast(List[DocId],docId)
+
+async def _read(
+        git_dir: str, docId: Union[DocId,List[DocId]], *,
+        limit: Optional[int] = None, cursor: Optional[DocId] = None,
+        meta: bool = False
+    ) -> Response:
+    """Retrieve docId (including wildcards), a page at a time.
+
+    Without a `limit` every match is returned.  Otherwise at most `limit`
+    docs are returned, along with the `cursor` to pass for the next page
+    (`null` on the last page).
+    """
+    paths = await asyncio.get_running_loop().run_in_executor(
+        None, list_docs, git_dir, as_list(docId), cursor
+    )
+    next_cursor: Optional[DocId] = None
+    if limit is not None and len(paths) > limit:
+        paths = paths[:limit]
+        next_cursor = paths[-1].name
+    docs = [doc async for doc in iter_read(paths, meta)]
+    data = {'docs': docs, 'cursor': next_cursor}
     return json_response(data)
 
+async def _read_stream(
+        git_dir: str, request: Request, docId: Union[DocId,List[DocId]], *,
+        limit: Optional[int] = None, cursor: Optional[DocId] = None,
+        meta: bool = False
+    ) -> StreamResponse:
+    """Like `_read`, but write the docs out as NDJSON while they are read.
+
+    With a `limit`, the last line is `{"cursor": ...}` (as in `_read`).
+    """
+    paths = await asyncio.get_running_loop().run_in_executor(
+        None, list_docs, git_dir, as_list(docId), cursor
+    )
+    next_cursor: Optional[DocId] = None
+    if limit is not None and len(paths) > limit:
+        paths = paths[:limit]
+        next_cursor = paths[-1].name
+    response = StreamResponse()
+    response.content_type = 'application/x-ndjson'
+    await response.prepare(request)
+    async for doc in iter_read(paths, meta):
+        await response.write((json.dumps(doc) + '\n').encode('utf-8'))
+    if limit is not None:
+        await response.write((json.dumps({'cursor': next_cursor}) + '\n').encode('utf-8'))
+    await response.write_eof()
+    return response
+
 def get_path_sequence(git_dir: str, docId: DocId, n: int) -> List[Path]:
     # Cheap, but hackey
     # get new path - sequence...
@@ -232,8 +598,15 @@ def get_path_sequence(git_dir: str, docId: DocId, n: int) -> List[Path]:
         raise RuntimeError('failed to get new path sequence')
     return paths
 
-async def _update(git_dir: str, docId: DocId, docs: Union[Doc,List[Doc]]) -> Response:
+async def _update(client: 'GitClient', docId: DocId, docs: Union[Doc,List[Doc]]) -> Response:
     """Update paragraph in git_dir, and reindex"""
+    async with client.doc_locks.hold([docId]):
+        return await _update_locked(client, docId, docs)
+
+async def _update_locked(
+        client: 'GitClient', docId: DocId, docs: Union[Doc,List[Doc]]
+    ) -> Response:
+    git_dir = client.source_dir
     path_or_response = check_path(git_dir, docId, should_exist=True)
     if isinstance(path_or_response, Response):
         return path_or_response
@@ -255,16 +628,16 @@ async def _update(git_dir: str, docId: DocId, docs: Union[Doc,List[Doc]]) -> Res
         for path, doc in zip(paths, docs):
             with open(path, 'w') as file:
                 print(doc, file=file)
-        # update git index
         path_names: List[str] = [path.name for path in paths]
-        for path_name in path_names:
-            await git_add(git_dir, path_name)
         # many vs one...
         # If more than one, then the original needs to be removed
+        removed: List[str] = []
         if len(paths) > 1:
-            await git_rm(git_dir, docId)
+            (Path(git_dir) / docId).unlink()
+            removed.append(docId)
         msg = f'updated {docId} to {path_names[0]} ..  {len(path_names)-1}'
-        await git_commit(git_dir, msg)
+        # the committer puts the files back as they were if this fails
+        await client.commit(Change(path_names, removed, msg))
         reason = f'update success: {docId}'
         log.info(reason)
         data = {'docIds': path_names}
@@ -278,7 +651,9 @@ AsyncMethod = Callable[..., Coroutine[Any,Any,Response] ]
 def check_initialized(f: AsyncMethod) -> AsyncMethod:
     @functools.wraps(f)
     async def wrapped(self, *args, **kwargs):
-        await self.initialize()
+        # not to wait on the lock (held by commits) once initialized
+        if not self.initialized:
+            await self.initialize()
         return await f(self, *args, **kwargs)
     return wrapped
 
@@ -301,6 +676,9 @@ class GitClient:
     remote: Optional[str] = None
     lock: Optional[Lock] = None
     initialized: bool
+    # writers of a doc wait on each other, commits (and pulls) on `lock`
+    doc_locks: DocLocks
+    committer: Committer
 
     def __init__(
             self, source_dir: str, remote: Optional[str] = None,
@@ -310,6 +688,9 @@ class GitClient:
         self.remote = remote
         self.lock = lock
         self.initialized = False
+        self.doc_locks = DocLocks()
+        commit_lock = lock if lock is not None else named_locks[f'commit:{source_dir}']
+        self.committer = Committer(source_dir, commit_lock)
 
     @acquire_lock
     async def initialize(self, *args):
@@ -327,23 +708,39 @@ class GitClient:
 
     @check_initialized
     async def create(self, *args) -> Response:
-        return await _create(self.source_dir, *args)
+        return await _create(self, *args)
+
+    @check_initialized
+    async def read(self, *args, **kwargs) -> Response:
+        return await _read(self.source_dir, *args, **kwargs)
 
     @check_initialized
-    async def read(self, *args) -> Response:
-        return await _read(self.source_dir, *args)
+    async def read_stream(self, *args, **kwargs) -> StreamResponse:
+        return await _read_stream(self.source_dir, *args, **kwargs)
 
     @check_initialized
     async def update(self, *args) -> Response:
-        return await _update(self.source_dir, *args)
+        return await _update(self, *args)
 
     @check_initialized
     async def delete(self, *args) -> Response:
-        return await _delete(self.source_dir, *args)
+        return await _delete(self, *args)
 
     @check_initialized
     async def pull(self, *args) -> Response:
-        return await git_pull(self.source_dir, *args)
+        async with self.committer.lock:
+            return await git_pull(self.source_dir, *args)
+
+    async def commit(self, change: Change):
+        """Commit a change made to the working tree (see `Committer`)."""
+        with span('git commit', 'git', add=change.add, remove=change.remove):
+            await self.committer.commit(change)
+
+    @check_initialized
+    async def head_commit(self) -> Optional[str]:
+        """Commit checked out in the source dir (None before the first)."""
+        branch = await git_head_ref(self.source_dir)
+        return await git_ref_commit(self.source_dir, branch)
 
 async def test():
     import json
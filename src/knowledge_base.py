@@ -0,0 +1,105 @@
+# knowledge_base.py
+"""
+Named knowledge bases served side by side
+
+Each knowledge base has its own git source dir, ES index, locks, corpus
+manifest, packed store and answer store, so a reindex of one only ever
+waits on (and blocks) its own.  The default one is configured in util.py,
+others are read from KB_CONFIG_PATH if it exists:
+
+    {
+        "team-a": {"source_dir": "./team-a-knowledge-base"},
+        "team-b": {"source_dir": "./team-b-kb", "index": "team-b-txt-stem"}
+    }
+
+Index names containing `stem` get the stemming analyzer (see
+`recreate_index`), which the default `<name>-txt-stem` does.
+
+A question can target several knowledge bases: they are searched
+concurrently and the hits merged by score.
+"""
+
+import asyncio
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+from util import DEFAULT_KB, KB_CONFIG_PATH, SOURCE_DIR, INDEX_NAME
+from util import PACKED_DIR, ANSWER_STORE_PATH, named_locks, kb_path, log
+from git_crud import GitClient
+from corpus import CorpusLoader
+from packed_store import PackedStore
+from answer_store import AnswerStore
+import create_index
+from create_index import get_paragraphs_for_query
+
+class KnowledgeBase:
+    name: str
+    source_dir: str
+    index: str
+    git: GitClient
+    corpus: CorpusLoader
+    packed: PackedStore
+    answers: AnswerStore
+
+    def __init__(
+            self, name: str, source_dir: str, index: str,
+            corpus: Optional[CorpusLoader] = None,
+            packed: Optional[PackedStore] = None
+        ):
+        self.name = name
+        self.source_dir = source_dir
+        self.index = index
+        self.git = GitClient(source_dir, lock=named_locks[source_dir])
+        self.corpus = corpus or CorpusLoader(source_dir)
+        self.packed = packed or PackedStore(kb_path(PACKED_DIR, name), source_dir)
+        self.answers = AnswerStore(kb_path(ANSWER_STORE_PATH, name), kb=name)
+
+    def __repr__(self) -> str:
+        return f'<KnowledgeBase:{self.name} ({self.source_dir}, {self.index})>'
+
+def load_knowledge_bases(config_path: str) -> Dict[str,KnowledgeBase]:
+    """The default knowledge base, and those listed in config_path."""
+    kbs = {DEFAULT_KB: KnowledgeBase(
+        DEFAULT_KB, SOURCE_DIR, INDEX_NAME,
+        corpus=create_index.corpus, packed=create_index.packed
+    )}
+    if not os.path.exists(config_path):
+        return kbs
+    with open(config_path) as file:
+        config: Dict[str,Dict[str,str]] = json.load(file)
+    for name, kb_config in config.items():
+        if name in kbs:
+            raise ValueError(f'{config_path}: {name} is configured in util.py')
+        kbs[name] = KnowledgeBase(
+            name, kb_config['source_dir'],
+            kb_config.get('index', f'{name}-txt-stem')
+        )
+    sources = [kb.source_dir for kb in kbs.values()]
+    indices = [kb.index for kb in kbs.values()]
+    if len(set(sources)) < len(sources) or len(set(indices)) < len(indices):
+        raise ValueError(f'{config_path}: source dirs and indices must differ')
+    log.info(f'knowledge bases: {", ".join(kbs)}')
+    return kbs
+
+knowledge_bases = load_knowledge_bases(KB_CONFIG_PATH)
+
+async def search(
+        kbs: List[KnowledgeBase], query: str, topk: int
+    ) -> List[Dict[str,Any]]:
+    """Top hits for query over all of kbs, each tagged with its `kb`.
+
+    Every knowledge base is asked for its own top `topk` concurrently, and
+    the best `topk` of all of them are kept.
+    """
+    results = await asyncio.gather(*[
+        get_paragraphs_for_query(query, kb.index, topk=topk, packed=kb.packed)
+        for kb in kbs
+    ])
+    hits = [
+        dict(hit, kb=kb.name)
+        for kb, kb_hits in zip(kbs, results) for hit in kb_hits
+    ]
+    if len(kbs) > 1:
+        hits.sort(key=lambda hit: hit['score'], reverse=True)
+    return hits[:topk]
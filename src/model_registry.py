@@ -0,0 +1,198 @@
+# model_registry.py
+"""
+Registry of loaded QA models, with hot swapping and shadow traffic
+
+Models are loaded next to the active one (off the event loop), and `/question`
+is switched to another one by replacing the registry's `active` name.  Each
+request looks up the active pipeline once, so requests in progress finish on
+the model they started with and none are dropped.
+
+A loaded candidate can also *shadow* the active model: a fraction of the
+questions is answered again by the candidate, on its own thread after the
+response has been sent, and the latency and agreement of both are recorded.
+
+Candidates need to accept sequences of MAX_SEQ_LEN tokens, since passages are
+cut to that size at index time.
+"""
+
+import asyncio
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Deque, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from transformers import QuestionAnsweringPipeline # type: ignore
+
+from util import MODEL_NAME, log, normalize_question
+from transformer_query import get_pipeline, load_pipeline, run_pipeline_batch
+
+# shadow questions waiting for, or running on, the shadow thread
+MAX_SHADOW_PENDING = 8
+# comparisons kept for the stats
+SHADOW_SAMPLES = 1000
+
+class LoadedModel(NamedTuple):
+    name: str
+    pipeline: QuestionAnsweringPipeline
+    loaded_at: float
+
+class ShadowSample(NamedTuple):
+    primary_s: float
+    candidate_s: float
+    # fraction of passages where both models gave the same answer
+    span_agreement: float
+    # whether the best answers of both models are the same
+    top_agreement: bool
+
+def best_answer(answers: List[Dict[str,Any]]) -> str:
+    """Best rated non-empty answer, like `get_quick_answer` picks it."""
+    candidates = [a for a in answers if a['answer'] != '']
+    if len(candidates) == 0:
+        return ''
+    return max(candidates, key=lambda a: a['score'])['answer']
+
+def percentile(values: List[float], p: float) -> float:
+    if len(values) == 0:
+        return 0.
+    values = sorted(values)
+    return values[min(int(p * len(values)), len(values) - 1)]
+
+class ModelRegistry:
+    models: Dict[str,LoadedModel]
+    active: str
+    shadow: Optional[str]
+    shadow_fraction: float
+    samples: Deque[ShadowSample]
+    counts: Dict[str,int]
+
+    def __init__(self, name: str, pipeline: QuestionAnsweringPipeline):
+        self.models = {name: LoadedModel(name, pipeline, time.time())}
+        self.active = name
+        self.shadow = None
+        self.shadow_fraction = 0.
+        self.samples = deque(maxlen=SHADOW_SAMPLES)
+        self.counts = {'shadowed': 0, 'skipped': 0, 'failed': 0}
+        self._shadow_pending = 0
+        self._shadow_pool = ThreadPoolExecutor(max_workers=1)
+        # the loop only keeps weak references to tasks
+        self._shadow_tasks: Set[asyncio.Task] = set()
+
+    def get(self) -> Tuple[str,QuestionAnsweringPipeline]:
+        """Name and pipeline of the active model."""
+        model = self.models[self.active]
+        return model.name, model.pipeline
+
+    async def load(self, name: str):
+        """Load a model alongside the others."""
+        if name in self.models:
+            return
+        log.info(f'loading model: {name}')
+        loaded = await asyncio.get_running_loop().run_in_executor(None, load_pipeline, name)
+        self.models[name] = LoadedModel(name, loaded, time.time())
+        log.info(f'loaded model: {name}')
+
+    def activate(self, name: str):
+        """Send all new questions to a loaded model."""
+        if name not in self.models:
+            raise KeyError(f'model not loaded: {name}')
+        previous, self.active = self.active, name
+        if self.shadow == name:
+            self.set_shadow(None)
+        log.info(f'active model: {previous} -> {name}')
+
+    def unload(self, name: str):
+        if name == self.active:
+            raise RuntimeError(f'cannot unload the active model: {name}')
+        if self.shadow == name:
+            self.set_shadow(None)
+        del self.models[name]
+        log.info(f'unloaded model: {name}')
+
+    def set_shadow(self, name: Optional[str], fraction: float = 0.):
+        """Shadow `fraction` of the questions to a loaded model (None: stop)."""
+        if name is not None and name not in self.models:
+            raise KeyError(f'model not loaded: {name}')
+        if name == self.active:
+            raise RuntimeError(f'cannot shadow the active model: {name}')
+        self.shadow = name
+        self.shadow_fraction = min(max(fraction, 0.), 1.) if name else 0.
+        self.samples.clear()
+        log.info(f'shadow model: {name} ({self.shadow_fraction:.0%})')
+
+    def maybe_shadow(
+            self, question: str, contexts: List[str],
+            answers: List[Dict[str,Any]], primary_s: float
+        ):
+        """Maybe compare the candidate with the active model's answers.
+
+        `answers` are the raw pipeline outputs for `contexts`, which took
+        `primary_s` seconds.  Returns immediately, the candidate runs in a
+        background task.
+        """
+        if self.shadow is None or len(contexts) == 0:
+            return
+        if random.random() >= self.shadow_fraction:
+            return
+        if self._shadow_pending >= MAX_SHADOW_PENDING:
+            self.counts['skipped'] += 1
+            return
+        candidate = self.models[self.shadow]
+        self._shadow_pending += 1
+        task = asyncio.create_task(
+            self._shadow(candidate, question, contexts, answers, primary_s)
+        )
+        self._shadow_tasks.add(task)
+        task.add_done_callback(self._shadow_tasks.discard)
+
+    async def _shadow(
+            self, candidate: LoadedModel, question: str, contexts: List[str],
+            answers: List[Dict[str,Any]], primary_s: float
+        ):
+        try:
+            start = time.perf_counter()
+            shadow_answers = await run_pipeline_batch(
+                question, contexts, candidate.pipeline, self._shadow_pool
+            )
+            candidate_s = time.perf_counter() - start
+            agree = [
+                normalize_question(a['answer']) == normalize_question(b['answer'])
+                for a, b in zip(answers, shadow_answers)
+            ]
+            top = normalize_question(best_answer(answers)) == \
+                normalize_question(best_answer(shadow_answers))
+            if self.shadow == candidate.name:
+                self.samples.append(ShadowSample(
+                    primary_s, candidate_s, sum(agree) / len(agree), top
+                ))
+                self.counts['shadowed'] += 1
+        except Exception as e:
+            self.counts['failed'] += 1
+            log.error(f'shadow {candidate.name} failed: {e}')
+        finally:
+            self._shadow_pending -= 1
+
+    def stats(self) -> Dict[str,Any]:
+        samples = list(self.samples)
+        def ms(values: List[float]) -> Dict[str,float]:
+            mean = sum(values) / len(values) if len(values) > 0 else 0.
+            return {'mean_ms': 1000 * mean,
+                    'p50_ms': 1000 * percentile(values, .5),
+                    'p95_ms': 1000 * percentile(values, .95)}
+        n = max(len(samples), 1)
+        return {
+            'active': self.active,
+            'loaded': sorted(self.models),
+            'shadow': self.shadow,
+            'shadow_fraction': self.shadow_fraction,
+            'counts': dict(self.counts),
+            'comparison': {
+                'samples': len(samples),
+                'primary': ms([s.primary_s for s in samples]),
+                'candidate': ms([s.candidate_s for s in samples]),
+                'span_agreement': sum(s.span_agreement for s in samples) / n,
+                'top_agreement': sum(s.top_agreement for s in samples) / n,
+            },
+        }
+
+registry = ModelRegistry(MODEL_NAME, get_pipeline())
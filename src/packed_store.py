@@ -0,0 +1,275 @@
+# packed_store.py
+"""
+Packed, memory-mapped copy of the knowledge base
+
+All docs of a commit are stored in one contiguous UTF-8 blob, with an
+array-backed table of (byte offset, byte length, md5) per docId.  The blob is
+memory-mapped read-only, so every worker process shares one page-cache copy,
+and search only needs ids and byte offsets from ES: just the passage is
+sliced out of the blob and decoded.
+
+Each build is a directory named after the commit it was built from; `CURRENT`
+names the one in use and is replaced atomically, which readers notice.  A
+build for a new commit only reads the docs that changed since the current
+one from git, the rest is copied straight out of the old blob.
+"""
+
+import asyncio
+import mmap
+import os
+import shutil
+import subprocess
+import time
+from array import array
+from hashlib import md5
+from pathlib import Path
+from typing import Dict, IO, List, Optional, Set, cast
+from uuid import uuid4
+
+from util import log
+
+# seconds between checks whether readers should switch to a newer build
+REFRESH_S = 1.
+
+def git_lines(git_dir: str, *args: str) -> List[str]:
+    """NUL separated output of a git command (blocking)."""
+    out = subprocess.run(
+        ('git','-C',git_dir) + args, check=True,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    ).stdout.decode('utf-8')
+    return [line for line in out.split('\0') if line != '']
+
+class BlobReader:
+    """Read many blobs of a commit through one `git cat-file --batch`."""
+    def __init__(self, git_dir: str):
+        self.git = subprocess.Popen(
+            ('git','-C',git_dir,'cat-file','--batch'),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+
+    def read(self, commit: str, name: str) -> bytes:
+        stdin = cast(IO[bytes], self.git.stdin)
+        stdout = cast(IO[bytes], self.git.stdout)
+        stdin.write(f'{commit}:{name}\n'.encode('utf-8'))
+        stdin.flush()
+        header = stdout.readline().split()
+        if len(header) != 3:
+            raise KeyError(f'{commit}:{name} missing')
+        data = stdout.read(int(header[2]))
+        stdout.read(1)
+        return data
+
+    def close(self):
+        cast(IO[bytes], self.git.stdin).close()
+        self.git.wait()
+
+class Generation:
+    """One build of the store, opened read-only."""
+    commit: str
+    index: Dict[str,int]
+    offsets: array
+    lengths: array
+    hashes: bytes
+
+    def __init__(self, path: Path):
+        self.commit = (path / 'commit').read_text().strip()
+        ids = (path / 'ids').read_text(encoding='utf-8').split('\n')
+        self.index = {docId: i for i, docId in enumerate(ids) if docId != ''}
+        self.offsets = array('Q')
+        self.lengths = array('Q')
+        with open(path / 'offsets', 'rb') as file:
+            self.offsets.frombytes(file.read())
+        with open(path / 'lengths', 'rb') as file:
+            self.lengths.frombytes(file.read())
+        self.hashes = (path / 'hashes').read_bytes()
+        self._file = open(path / 'blob', 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        # mmap can't map an empty file
+        self.blob: Optional[mmap.mmap] = None
+        if size > 0:
+            self.blob = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def raw(self, docId: str) -> Optional[memoryview]:
+        """Bytes of a doc, without copying them out of the map."""
+        i = self.index.get(docId, None)
+        if i is None or self.blob is None:
+            return None if i is None else memoryview(b'')
+        start = self.offsets[i]
+        return memoryview(self.blob)[start:start + self.lengths[i]]
+
+    def raw_slice(self, docId: str, offset: int, length: int) -> Optional[bytes]:
+        """`length` bytes of a doc from byte `offset` (clipped to the doc)."""
+        i = self.index.get(docId, None)
+        if i is None:
+            return None
+        if self.blob is None:
+            return b''
+        size = self.lengths[i]
+        start = self.offsets[i] + min(offset, size)
+        return self.blob[start:self.offsets[i] + min(offset + length, size)]
+
+    def hash(self, docId: str) -> Optional[str]:
+        i = self.index.get(docId, None)
+        if i is None:
+            return None
+        return self.hashes[16 * i:16 * (i + 1)].hex()
+
+    def close(self):
+        if self.blob is not None:
+            try:
+                self.blob.close()
+            except BufferError:
+                # a memoryview is still around, the map goes with it
+                pass
+        self._file.close()
+
+class PackedStore:
+    path: Path
+    source_dir: str
+    generation: Optional[Generation]
+
+    def __init__(self, path: str, source_dir: str):
+        self.path = Path(path)
+        self.source_dir = source_dir
+        self.generation = None
+        self._current_mtime = 0
+        self._checked = 0.
+        self._lock = asyncio.Lock()
+
+    #
+    # reading
+    #
+
+    def _refresh(self):
+        """Switch to the build named in CURRENT, if it changed."""
+        now = time.monotonic()
+        if self.generation is not None and now - self._checked < REFRESH_S:
+            return
+        self._checked = now
+        current = self.path / 'CURRENT'
+        try:
+            mtime = current.stat().st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._current_mtime and self.generation is not None:
+            return
+        name = current.read_text().strip()
+        try:
+            generation = Generation(self.path / name)
+        except OSError as e:
+            log.error(f'packed store: cannot open {name}: {e}')
+            return
+        old, self.generation = self.generation, generation
+        self._current_mtime = mtime
+        if old is not None:
+            old.close()
+
+    @property
+    def commit(self) -> Optional[str]:
+        self._refresh()
+        return self.generation.commit if self.generation else None
+
+    def get(self, docId: str) -> Optional[str]:
+        """Text of a doc, None if it isn't in the store."""
+        self._refresh()
+        if self.generation is None:
+            return None
+        raw = self.generation.raw(docId)
+        return None if raw is None else str(raw, 'utf-8')
+
+    def get_slice(self, docId: str, offset: int, length: int) -> Optional[str]:
+        """`length` bytes of a doc from byte `offset`, decoded.
+
+        Only the slice is decoded, None if it doesn't fall on character
+        boundaries (the doc changed since the offsets were taken).
+        """
+        self._refresh()
+        if self.generation is None:
+            return None
+        raw = self.generation.raw_slice(docId, offset, length)
+        if raw is None:
+            return None
+        try:
+            return raw.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+
+    #
+    # building
+    #
+
+    async def update(self, commit: Optional[str]):
+        """Build the store for commit (incrementally) unless it's current."""
+        if commit is None:
+            return
+        async with self._lock:
+            if self.commit == commit:
+                return
+            start = time.perf_counter()
+            n_read = await asyncio.get_running_loop().run_in_executor(None, self.build, commit)
+            self._checked = 0.
+            self._refresh()
+            took = time.perf_counter() - start
+            log.info(f'packed store: {commit} built, {n_read} docs read ({took:.2f}s)')
+
+    def build(self, commit: str) -> int:
+        """Write the build for commit and make it current (blocking).
+
+        Returns the number of docs read from git.
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        old = self.generation
+        names = sorted(
+            name for name in git_lines(
+                self.source_dir, 'ls-tree', '-z', '--name-only', commit
+            ) if name.endswith('.txt')
+        )
+        changed: Set[str]
+        if old is not None:
+            changed = set(git_lines(
+                self.source_dir, 'diff', '--name-only', '--no-renames', '-z',
+                old.commit, commit
+            ))
+        else:
+            changed = set(names)
+        tmp = self.path / f'.{commit}.{uuid4().hex[:6]}'
+        tmp.mkdir()
+        offsets, lengths = array('Q'), array('Q')
+        hashes = bytearray()
+        n_read = 0
+        reader = BlobReader(self.source_dir)
+        try:
+            with open(tmp / 'blob', 'wb') as blob:
+                for name in names:
+                    raw = old.raw(name) if old is not None else None
+                    if raw is not None and name not in changed:
+                        data = bytes(raw)
+                    else:
+                        data = reader.read(commit, name)
+                        n_read += 1
+                    offsets.append(blob.tell())
+                    lengths.append(len(data))
+                    hashes += md5(data).digest()
+                    blob.write(data)
+        finally:
+            reader.close()
+        with open(tmp / 'offsets', 'wb') as file:
+            offsets.tofile(file)
+        with open(tmp / 'lengths', 'wb') as file:
+            lengths.tofile(file)
+        (tmp / 'hashes').write_bytes(bytes(hashes))
+        (tmp / 'ids').write_text('\n'.join(names), encoding='utf-8')
+        (tmp / 'commit').write_text(commit)
+        final = self.path / commit
+        if final.exists():
+            shutil.rmtree(final)
+        os.replace(tmp, final)
+        current_tmp = self.path / '.CURRENT'
+        current_tmp.write_text(commit)
+        os.replace(current_tmp, self.path / 'CURRENT')
+        # readers that still have an old build mapped keep it until they
+        # refresh (unlinked files stay readable while mapped)
+        for entry in self.path.iterdir():
+            if entry.is_dir() and entry.name != commit and not entry.name.startswith('.'):
+                shutil.rmtree(entry, ignore_errors=True)
+        return n_read
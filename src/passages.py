@@ -0,0 +1,92 @@
+# passages.py
+"""
+Split docs into model-sized passages at index time
+
+A passage has at most PASSAGE_TOKENS tokens, which leaves room for the
+question and special tokens in a MAX_SEQ_LEN sequence.  The QA pipeline then
+never needs to window a paragraph itself, so every retrieved passage costs
+exactly one forward pass.
+
+Each passage is indexed as its own ES doc, recording the docId of the file it
+came from and its character offset in that file, and its byte offset in the
+file's UTF-8 (so the packed store can decode just the passage).
+"""
+
+import re
+from typing import List, Tuple, NamedTuple, Any, Optional
+
+from util import MODEL_NAME, MAX_SEQ_LEN, MAX_QUESTION_LEN, PASSAGE_OVERLAP
+from util import log
+
+# [CLS] question [SEP] passage [SEP]
+PASSAGE_TOKENS = MAX_SEQ_LEN - MAX_QUESTION_LEN - 3
+
+class Passage(NamedTuple):
+    text: str
+    docId: str
+    offset: int
+    # position of the passage in its doc
+    position: int
+    byte_offset: int = 0
+
+    @property
+    def id(self) -> str:
+        """ES id of the passage, the first one keeps the docId itself."""
+        if self.position == 0:
+            return self.docId
+        return f'{self.docId}#{self.position}'
+
+_tokenizer: Optional[Any] = None
+
+def get_tokenizer() -> Any:
+    """Tokenizer of the QA model, loaded on first use.
+
+    transformers is imported here too, so that importing this module (for
+    `Passage`) stays cheap.
+    """
+    global _tokenizer
+    if _tokenizer is None:
+        from transformers import AutoTokenizer # type: ignore
+        _tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+    return _tokenizer
+
+def token_spans(text: str) -> List[Tuple[int,int]]:
+    """Character spans of the model's tokens in text.
+
+    Slow tokenizers can't report offsets, in which case words and punctuation
+    are used instead.  That undercounts rare words split into several word
+    pieces, so a passage may still (rarely) be windowed by the pipeline.
+    """
+    tokenizer = get_tokenizer()
+    try:
+        encoding = tokenizer(
+            text, add_special_tokens=False, return_offsets_mapping=True
+        )
+        return [tuple(span) for span in encoding['offset_mapping']]
+    except (NotImplementedError, TypeError, KeyError) as e:
+        log.debug(f'no token offsets ({e}), approximating with words')
+        return [m.span() for m in re.finditer(r'\w+|[^\w\s]', text)]
+
+def split_passages(
+        text: str, docId: str, max_tokens: int = PASSAGE_TOKENS,
+        overlap: int = PASSAGE_OVERLAP
+    ) -> List[Passage]:
+    """Split text into windows of at most max_tokens overlapping tokens."""
+    if overlap >= max_tokens:
+        raise ValueError(f'overlap ({overlap}) must be < max_tokens ({max_tokens})')
+    spans = token_spans(text)
+    if len(spans) <= max_tokens:
+        return [Passage(text, docId, 0, 0)]
+    passages: List[Passage] = []
+    stride = max_tokens - overlap
+    # passages start further and further in, bytes are counted as they go
+    char, byte = 0, 0
+    for first in range(0, len(spans), stride):
+        window = spans[first:first + max_tokens]
+        start, end = window[0][0], window[-1][1]
+        byte += len(text[char:start].encode('utf-8'))
+        char = start
+        passages.append(Passage(text[start:end], docId, start, len(passages), byte))
+        if first + max_tokens >= len(spans):
+            break
+    return passages
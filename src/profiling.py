@@ -0,0 +1,295 @@
+# profiling.py
+"""
+Sampled profiling of live requests
+
+While a profiled request is in flight, a sampler thread records the Python
+stack of every thread every `interval` seconds (a statistical profiler, so
+the model's inference thread and the executor threads are seen too, not
+just the event loop).  Samples are attributed to every request profiled at
+that moment, so under concurrency a profile also shows its neighbours' work.
+
+Each profile is written to `<directory>/<time>-<uuid>.json`, with the hot
+lines and functions and the folded stacks (`a;b;c <samples>`, for flame
+graph tools); only the latest `keep` are kept.  All profiles are also added
+to an aggregate report, which breaks the time down by where it's spent
+(torch, the tokenizer, regex, json...).
+"""
+
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from util import log
+
+# hot lines and functions listed in reports
+REPORT_TOP = 30
+# allocation sites listed in reports (when tracemalloc is on)
+ALLOCATIONS_TOP = 20
+# frames of a stack sample whose leaf is one of these are idle, not work
+IDLE = {
+    ('selectors.py', 'select'),
+    ('threading.py', 'wait'),
+    ('queue.py', 'get'),
+    ('thread.py', '_worker'),
+}
+# (category, substring of the file path) of a sample's leaf frame, in order
+CATEGORIES = [
+    ('tokenizer', 'tokeniz'),
+    ('torch', '/torch/'),
+    ('transformers', '/transformers/'),
+    ('regex', '/re.py'),
+    ('regex', '/re/'),
+    ('regex', '/sre_'),
+    ('json', '/json/'),
+    ('json', 'orjson'),
+    ('elasticsearch', '/elasticsearch/'),
+    ('elasticsearch', '/urllib3/'),
+    ('aiohttp', '/aiohttp/'),
+    ('asyncio', '/asyncio/'),
+]
+src_dir = os.path.dirname(os.path.abspath(__file__))
+
+def short_path(filename: str) -> str:
+    if filename.startswith(src_dir):
+        return os.path.basename(filename)
+    _, sep, rest = filename.rpartition('-packages/')
+    if sep != '':
+        return rest
+    return '/'.join(filename.split('/')[-2:])
+
+def category(filename: str) -> str:
+    for name, pattern in CATEGORIES:
+        if pattern in filename:
+            return name
+    return 'app' if filename.startswith(src_dir) else 'other'
+
+# one sampled stack: (function per frame, root first), leaf line, category
+Sample = Tuple[Tuple[str,...], str, str]
+
+class Profile:
+    uuid: str
+    path: str
+    started: float
+    duration: float
+    samples: int
+    lines: Counter
+    functions: Counter
+    categories: Counter
+    stacks: Counter
+
+    def __init__(self, uuid: str, path: str):
+        self.uuid = uuid
+        self.path = path
+        self.started = time.time()
+        self.duration = 0.
+        self.samples = 0
+        self.lines = Counter()
+        self.functions = Counter()
+        self.categories = Counter()
+        self.stacks = Counter()
+
+    def add(self, samples: List[Sample]):
+        self.samples += 1
+        for functions, line, cat in samples:
+            self.lines[line] += 1
+            self.categories[cat] += 1
+            # recursion counts a function once per sample
+            self.functions.update(set(functions))
+            self.stacks[';'.join(functions)] += 1
+
+    def merge(self, other: 'Profile'):
+        self.samples += other.samples
+        self.duration += other.duration
+        self.lines.update(other.lines)
+        self.functions.update(other.functions)
+        self.categories.update(other.categories)
+        self.stacks.update(other.stacks)
+
+    def report(self, top: int = REPORT_TOP) -> Dict[str,Any]:
+        """Hot lines (self) and functions (inclusive), by share of samples."""
+        total = max(sum(self.categories.values()), 1)
+        def ranked(counter: Counter) -> List[Dict[str,Any]]:
+            return [{'frame': frame, 'samples': n, 'share': n / total}
+                    for frame, n in counter.most_common(top)]
+        return {
+            'uuid': self.uuid,
+            'path': self.path,
+            'duration_s': self.duration,
+            'samples': self.samples,
+            'categories': {cat: n / total for cat, n in self.categories.most_common()},
+            'self': ranked(self.lines),
+            'cumulative': ranked(self.functions),
+        }
+
+    def folded(self) -> List[str]:
+        """Stacks as `a;b;c <samples>` lines, for flame graph tools."""
+        return [f'{stack} {n}' for stack, n in self.stacks.most_common()]
+
+class Profiler:
+    directory: Path
+    interval: float
+    keep: int
+    token: Optional[str]
+    # fraction of /question requests profiled (0: only on request)
+    fraction: float
+    active: Dict[str,Profile]
+    aggregate: Profile
+    profiled: int
+
+    def __init__(
+            self, directory: str, interval: float, keep: int,
+            token: Optional[str] = None
+        ):
+        self.directory = Path(directory)
+        self.interval = interval
+        self.keep = keep
+        self.token = token
+        self.fraction = 0.
+        self.active = {}
+        self.aggregate = Profile('aggregate', '*')
+        self.profiled = 0
+        self._lock = threading.Lock()
+        self._sampler: Optional[threading.Thread] = None
+
+    def wants(self, path: str, headers: Any) -> bool:
+        """Whether to profile a request."""
+        if self.token is not None and headers.get('x-profile', None) == self.token:
+            return True
+        return path == '/question' and random.random() < self.fraction
+
+    def start(self, fraction: float, allocations: bool = False):
+        self.fraction = min(max(fraction, 0.), 1.)
+        if allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        log.info(f'profiling {self.fraction:.0%} of questions '
+                 f'(allocations: {tracemalloc.is_tracing()})')
+
+    def stop(self):
+        self.fraction = 0.
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        log.info('profiling stopped')
+
+    def reset(self):
+        with self._lock:
+            self.aggregate = Profile('aggregate', '*')
+            self.profiled = 0
+
+    def begin(self, uuid: str, path: str) -> Profile:
+        profile = Profile(uuid, path)
+        with self._lock:
+            self.active[uuid] = profile
+            if self._sampler is None:
+                self._sampler = threading.Thread(
+                    target=self._sample_loop, name='profiler', daemon=True
+                )
+                self._sampler.start()
+        return profile
+
+    def end(self, profile: Profile):
+        profile.duration = time.time() - profile.started
+        with self._lock:
+            self.active.pop(profile.uuid, None)
+            self.aggregate.merge(profile)
+            self.profiled += 1
+            # the sampler may still be adding to it, so it's written as of now
+            data = profile.report()
+            data['folded'] = profile.folded()
+        future = asyncio.get_running_loop().run_in_executor(
+            None, self.write, profile.uuid, profile.started, data
+        )
+        future.add_done_callback(self._written)
+
+    def _written(self, future: 'asyncio.Future[None]'):
+        if not future.cancelled() and future.exception() is not None:
+            log.error(f'profile not written: {future.exception()!r}')
+
+    def _sample_loop(self):
+        me = threading.get_ident()
+        while True:
+            with self._lock:
+                if len(self.active) == 0:
+                    self._sampler = None
+                    return
+                profiles = list(self.active.values())
+            samples = self._sample(me)
+            with self._lock:
+                for profile in profiles:
+                    profile.add(samples)
+            time.sleep(self.interval)
+
+    def _sample(self, me: int) -> List[Sample]:
+        samples: List[Sample] = []
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me:
+                continue
+            code = frame.f_code
+            leaf = (os.path.basename(code.co_filename), code.co_name)
+            if leaf in IDLE:
+                continue
+            line = f'{code.co_name} ({short_path(code.co_filename)}:{frame.f_lineno})'
+            cat = category(code.co_filename)
+            functions: List[str] = []
+            f: Any = frame
+            while f is not None:
+                c = f.f_code
+                functions.append(f'{c.co_name} ({short_path(c.co_filename)}:{c.co_firstlineno})')
+                f = f.f_back
+            samples.append((tuple(reversed(functions)), line, cat))
+        return samples
+
+    def write(self, uuid: str, started: float, data: Dict[str,Any]):
+        """Write a profile's report, drop the oldest beyond `keep` (blocking)."""
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime(started))
+            path = self.directory / f'{stamp}-{uuid}.json'
+            with open(path, 'w') as file:
+                json.dump(data, file)
+            profiles = sorted(self.directory.glob('*.json'))
+            for old in profiles[:-self.keep]:
+                old.unlink()
+        except OSError as e:
+            log.error(f'profile {uuid} not written: {e}')
+
+    def recent(self, n: int = 10) -> List[str]:
+        if not self.directory.exists():
+            return []
+        return [p.name for p in sorted(self.directory.glob('*.json'))[-n:]]
+
+    def report(self) -> Dict[str,Any]:
+        with self._lock:
+            report = self.aggregate.report()
+            report['folded'] = self.aggregate.folded()
+        report.update({
+            'fraction': self.fraction,
+            'profiled': self.profiled,
+            'active': len(self.active),
+            'interval_ms': 1000 * self.interval,
+            'recent': self.recent(),
+        })
+        del report['uuid']
+        del report['path']
+        if tracemalloc.is_tracing():
+            report['allocations'] = allocations()
+        return report
+
+def allocations(top: int = ALLOCATIONS_TOP) -> List[Dict[str,Any]]:
+    """Biggest live allocations by line, since tracemalloc was started."""
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ])
+    return [{
+        'where': str(stat.traceback[0]),
+        'size_kb': stat.size / 1024,
+        'count': stat.count,
+    } for stat in snapshot.statistics('lineno')[:top]]
@@ -0,0 +1,171 @@
+# reindex_jobs.py
+"""
+Debounced background reindexing
+
+Webhooks and writes to the knowledge base don't reindex while the client
+waits: they submit a job and get its id back.  A single worker waits until
+no new job has come in for `debounce` seconds (or the oldest one has waited
+`max_delay`), then runs one pass for everything pending: a pull if any of
+the jobs asked for one, then a single incremental index pass.  A burst of
+pushes thus costs one reindex, not a queue of overlapping ones.
+
+Jobs are kept (the last `history` of them) so their state can be looked up.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from uuid import uuid4
+
+from util import log
+
+# sets the stage every job of the running pass reports
+Progress = Callable[[str], None]
+# runs one pass, pulling first if asked to, and returns its result
+ReindexFunction = Callable[[bool, Progress], Awaitable[Dict[str,Any]]]
+
+class Job:
+    id: str
+    reason: str
+    pull: bool
+    # queued, running, done or failed
+    state: str
+    # what the running pass is doing (pulling, indexing...)
+    stage: Optional[str]
+    # number of jobs handled by the same pass
+    coalesced: int
+    submitted_at: float
+    started_at: Optional[float]
+    finished_at: Optional[float]
+    result: Optional[Dict[str,Any]]
+    error: Optional[str]
+
+    def __init__(self, reason: str, pull: bool):
+        self.id = str(uuid4())
+        self.reason = reason
+        self.pull = pull
+        self.state = 'queued'
+        self.stage = None
+        self.coalesced = 0
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+
+    @property
+    def finished(self) -> bool:
+        return self.state in ('done', 'failed')
+
+    def to_dict(self) -> Dict[str,Any]:
+        waited = (self.started_at or time.time()) - self.submitted_at
+        duration = None
+        if self.started_at is not None:
+            duration = (self.finished_at or time.time()) - self.started_at
+        return {
+            'job': self.id,
+            'reason': self.reason,
+            'state': self.state,
+            'stage': self.stage,
+            'coalesced': self.coalesced,
+            'submitted_at': self.submitted_at,
+            'queued_s': waited,
+            'duration_s': duration,
+            'result': self.result,
+            'error': self.error,
+        }
+
+class ReindexQueue:
+    reindex: ReindexFunction
+    debounce: float
+    max_delay: float
+    history: int
+    jobs: 'OrderedDict[str,Job]'
+    pending: List[Job]
+    counts: Dict[str,int]
+
+    def __init__(
+            self, reindex: ReindexFunction, debounce: float, max_delay: float,
+            history: int = 1000
+        ):
+        self.reindex = reindex
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.history = history
+        self.jobs = OrderedDict()
+        self.pending = []
+        self.counts = {'submitted': 0, 'passes': 0, 'failed': 0}
+        self._last_submit = 0.
+        self._wakeup = asyncio.Event()
+        self._worker: Optional[asyncio.Future] = None
+
+    def submit(self, reason: str, pull: bool = False) -> Job:
+        """Queue a reindex, it runs with the next pass."""
+        job = Job(reason, pull)
+        self.jobs[job.id] = job
+        while len(self.jobs) > self.history:
+            self.jobs.popitem(last=False)
+        self.pending.append(job)
+        self.counts['submitted'] += 1
+        self._last_submit = time.monotonic()
+        self._wakeup.set()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.ensure_future(self._work())
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id, None)
+
+    async def _work(self):
+        while True:
+            await self._wakeup.wait()
+            first = time.monotonic()
+            # wait for the burst to end, but not forever
+            while True:
+                now = time.monotonic()
+                wait = min(self._last_submit + self.debounce,
+                           first + self.max_delay) - now
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self._wakeup.clear()
+            jobs, self.pending = self.pending, []
+            await self._run(jobs)
+
+    async def _run(self, jobs: List[Job]):
+        pull = any(job.pull for job in jobs)
+        started = time.time()
+        for job in jobs:
+            job.state = 'running'
+            job.started_at = started
+            job.coalesced = len(jobs)
+        def progress(stage: str):
+            for job in jobs:
+                job.stage = stage
+        self.counts['passes'] += 1
+        log.info(f'reindex: {len(jobs)} jobs, pull: {pull}')
+        try:
+            result = await self.reindex(pull, progress)
+        except Exception as e:
+            self.counts['failed'] += 1
+            log.error(f'reindex failed: {e!r}')
+            for job in jobs:
+                job.state = 'failed'
+                job.error = str(e) or repr(e)
+        else:
+            for job in jobs:
+                job.state = 'done'
+                job.result = result
+        finished = time.time()
+        for job in jobs:
+            job.finished_at = finished
+        log.info(f'reindex: pass took {finished - started:.2f}s')
+
+    def stats(self) -> Dict[str,Any]:
+        stats: Dict[str,Any] = dict(self.counts)
+        stats.update({
+            'pending': len(self.pending),
+            'running': sum(job.state == 'running' for job in self.jobs.values()),
+        })
+        return stats
@@ -0,0 +1,94 @@
+# responses.py
+"""
+Fast JSON responses, compressed when the client accepts it
+
+Bodies are encoded with orjson when it's installed (the stdlib encoder
+otherwise), and bodies of at least COMPRESS_MIN_BYTES are compressed with
+brotli (if installed) or gzip, whichever the client's `accept-encoding`
+allows.
+"""
+
+import gzip
+import json
+from typing import Any, Dict, Optional
+
+from aiohttp.web import Request, Response
+
+try:
+    import orjson # type: ignore
+except ImportError:
+    orjson = None
+try:
+    import brotli # type: ignore
+except ImportError:
+    brotli = None
+
+# smaller bodies aren't worth the CPU (and may grow when compressed)
+COMPRESS_MIN_BYTES = 1024
+# cheap settings: answers are compressed on the event loop
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+def _default(obj: Any) -> Any:
+    # numpy scalars (model scores) that orjson doesn't take as is
+    if hasattr(obj, 'item'):
+        return obj.item()
+    raise TypeError(f'not JSON serializable: {type(obj).__name__}')
+
+def dumps(obj: Any) -> bytes:
+    """UTF-8 JSON encoding of obj."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default)
+    return json.dumps(
+        obj, default=_default, ensure_ascii=False, separators=(',',':')
+    ).encode('utf-8')
+
+def accepted_encodings(header: str) -> Dict[str,float]:
+    """Encodings of an `accept-encoding` header, with their q-values."""
+    encodings: Dict[str,float] = {}
+    for part in header.split(','):
+        name, _, params = part.partition(';')
+        name = name.strip().lower()
+        if name == '':
+            continue
+        q = 1.
+        params = params.strip().replace(' ', '')
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.
+        encodings[name] = q
+    return encodings
+
+def choose_encoding(header: str) -> Optional[str]:
+    """Best encoding we can produce that the client accepts (None: none)."""
+    accepted = accepted_encodings(header)
+    supported = ('br', 'gzip') if brotli is not None else ('gzip',)
+    for name in supported:
+        if accepted.get(name, accepted.get('*', 0.)) > 0:
+            return name
+    return None
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+def fast_json_response(
+        request: Request, data: Any, status: int = 200,
+        headers: Optional[Dict[str,str]] = None
+    ) -> Response:
+    """Like `json_response`, but faster, and compressed if worth it."""
+    body = dumps(data)
+    headers = dict(headers or {})
+    if len(body) >= COMPRESS_MIN_BYTES:
+        encoding = choose_encoding(request.headers.get('accept-encoding',''))
+        if encoding is not None:
+            body = compress(body, encoding)
+            headers['Content-Encoding'] = encoding
+        headers['Vary'] = 'Accept-Encoding'
+    return Response(
+        body=body, status=status, headers=headers,
+        content_type='application/json'
+    )
@@ -0,0 +1,79 @@
+# retrieval_cache.py
+"""
+Cache of search results, by the analyzed terms of the query
+
+Questions worded differently often search for exactly the same terms once
+analyzed (case, punctuation, word order, stemming: see analysis.py), so the
+top hits of a query are kept under (index, generation, topk, sorted terms)
+and reused without asking ES.  Only the hits' ids, scores and locations
+are kept; the texts are sliced out of the packed store again.
+
+Every write to an index bumps its generation (see `bump_generation`), so
+cached results are never served across a write, and it drops the index's
+entries.  Least recently used entries go beyond `size`.
+"""
+
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from analysis import analyze
+
+# (index, generation, topk, terms)
+Key = Tuple[str, int, int, Tuple[str,...]]
+
+class RetrievalCache:
+    size: int
+    entries: 'OrderedDict[Key,List[Dict[str,Any]]]'
+
+    def __init__(self, size: int):
+        self.size = size
+        self.entries = OrderedDict()
+        self.counts = {
+            'hits': 0, 'misses': 0, 'uncacheable': 0,
+            'evicted': 0, 'invalidated': 0,
+        }
+
+    def key(
+            self, query: str, index: str, topk: int, generation: int,
+            stem: bool
+        ) -> Optional[Key]:
+        """The key of a search (None: it can't be cached)."""
+        terms = analyze(query, stem=stem)
+        if terms is None:
+            self.counts['uncacheable'] += 1
+            return None
+        return (index, generation, topk, terms)
+
+    def get(self, key: Key) -> Optional[List[Dict[str,Any]]]:
+        """Copies of the cached hits, least recently used last."""
+        hits = self.entries.get(key, None)
+        if hits is None:
+            self.counts['misses'] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.counts['hits'] += 1
+        return [dict(hit) for hit in hits]
+
+    def put(self, key: Key, hits: List[Dict[str,Any]]):
+        self.entries[key] = [dict(hit) for hit in hits]
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.counts['evicted'] += 1
+
+    def invalidate(self, index: str):
+        """Drop the entries of index (after it was written to)."""
+        stale = [key for key in self.entries if key[0] == index]
+        for key in stale:
+            del self.entries[key]
+        self.counts['invalidated'] += len(stale)
+
+    def stats(self) -> Dict[str,Any]:
+        stats: Dict[str,Any] = dict(self.counts)
+        lookups = self.counts['hits'] + self.counts['misses']
+        stats.update({
+            'entries': len(self.entries),
+            'size': self.size,
+            'hit_rate': self.counts['hits'] / lookups if lookups else 0.,
+        })
+        return stats
@@ -3,28 +3,53 @@
 """
 
 from uuid import uuid4
-from typing import Dict, Any, List, Iterable, Union, cast
+from typing import Dict, Any, List, Iterable, Union, Optional, Callable, Tuple
+from typing import cast
 from json.decoder import JSONDecodeError
+from tempfile import SpooledTemporaryFile
 import atexit
 import json
+import time
 from pprint import pprint
 
 from aiohttp import web
-from aiohttp.web import Request, Response, json_response
+from aiohttp.web import Request, Response, StreamResponse, json_response
 from aiohttp.web import HTTPInternalServerError
 from aiohttp.web_middlewares import _Handler
 from markdown import markdown # type: ignore
 import elasticsearch.helpers as helpers # type: ignore
 
-from util import answer_to_complete_sentence, INDEX_NAME, SOURCE_DIR
-from util import named_locks, log, es
-from transformer_query import pipeline
-from create_index import get_paragraphs_for_query, index_all, index_one
-from canned_answer import no_answer, quick_answer_for_error, get_happy_employee
-from git_crud import GitClient
+from util import DEFAULT_KB
+from util import log, es, loop, normalize_question
+from util import MAX_IN_FLIGHT, MAX_QUEUED, QUEUE_TIMEOUT, RETRY_AFTER
+from util import REQUEST_TIMEOUT, MAX_REQUEST_TIMEOUT
+from util import QA_LOG_PATH, WARM_TOP_N, CONTEXT_WINDOWS
+from util import REINDEX_DEBOUNCE, REINDEX_MAX_DELAY
+from util import PROFILE_DIR, PROFILE_INTERVAL, PROFILE_KEEP, PROFILE_TOKEN
+from util import ADMIN_TOKEN
+from util import TRACE_PATH, TRACE_SLOW_S, TRACE_SAMPLE, TRACE_MAX_BYTES
+from transformer_query import run_pipeline_batch
+from context_windows import Window, query_windows
+from answers import get_quick_answer, make_answer, paragraph_answers
+from answers import ANSWER_FIELDS, shape_answers, qa_log_entry
+from model_registry import registry
+from create_index import index_changed, index_generations, duplicate_groups
+from create_index import count_copies
+from create_index import retrieval_cache
+from canned_answer import quick_answer_for_error, get_happy_employee
+from git_crud import GitError
+from bulk_import import bulk_import, iter_docs, content_types
+from admission import AdmissionController, Deadline, DeadlineExceeded, Overloaded
+from singleflight import SingleFlight
+from answer_store import Answers
+from knowledge_base import KnowledgeBase, knowledge_bases, search
+import snapshots
+from profiling import Profiler
+from tracing import Tracer, span
+from reindex_jobs import ReindexQueue, Job
+from responses import fast_json_response, dumps
 
 
-git_client = GitClient(SOURCE_DIR, lock=named_locks[SOURCE_DIR])
 routes = web.RouteTableDef()
 
 #
@@ -35,7 +60,7 @@ routes = web.RouteTableDef()
 readme_path = '../README.md'
 css_path = './github.css'
 
-qa_log = open('qa_log.multi_json','a')
+qa_log = open(QA_LOG_PATH,'a')
 atexit.register(lambda : qa_log.close())
 
 with open(readme_path) as file:
@@ -135,6 +160,9 @@ async def exception_to_json_middleware(
     except to_json_exceptions as e:
         log.error(f'to_json_exceptions: {e}')
         return web.json_response(exception_to_dict(e))
+    except web.HTTPException:
+        # aiohttp's own replies (404 for unknown routes...) aren't errors
+        raise
     except Exception as e:
         log.error(f'other_error: {e}')
         return web.json_response({'whoops!':str(e)},status=500)
@@ -162,29 +190,73 @@ async def attach_uuid_middleware(
     request['uuid'] = str(uuid4())
     return await handler(request)
 
+tracer = Tracer(TRACE_PATH, TRACE_SLOW_S, TRACE_SAMPLE, TRACE_MAX_BYTES)
+
+@web.middleware
+async def trace_middleware(
+        request: web.Request, 
+        handler: _Handler
+        ) -> web.StreamResponse:
+    """Trace every request, keep the slow and failed ones (see tracing.py)."""
+    trace = tracer.begin(request['uuid'], f'{request.method} {request.path}')
+    error = True
+    try:
+        response = await handler(request)
+        error = response.status >= 500
+        return response
+    except web.HTTPException as e:
+        # e.g. a 404 for an unknown route
+        error = e.status >= 500
+        raise
+    finally:
+        tracer.end(trace, error)
+
+def traced(middleware: Any) -> Any:
+    """middleware, timed as a span of the request's trace."""
+    name = f'middleware {middleware.__name__}'
+    @web.middleware
+    async def traced_middleware(
+            request: web.Request,
+            handler: _Handler
+            ) -> web.StreamResponse:
+        with span(name, 'middleware'):
+            return await middleware(request, handler)
+    return traced_middleware
+
+profiler = Profiler(PROFILE_DIR, PROFILE_INTERVAL, PROFILE_KEEP, PROFILE_TOKEN)
+
+@web.middleware
+async def profile_middleware(
+        request: web.Request, 
+        handler: _Handler
+        ) -> web.StreamResponse:
+    """Profile sampled requests (see profiling.py)."""
+    if not profiler.wants(request.path, request.headers):
+        return await handler(request)
+    profile = profiler.begin(request['uuid'], request.path)
+    try:
+        response = await handler(request)
+    finally:
+        profiler.end(profile)
+    if not response.prepared:
+        response.headers['x-profile'] = request['uuid']
+    return response
+
 @web.middleware
 async def log_qa_middleware(
         request: web.Request, 
         handler: _Handler
         ) -> web.StreamResponse:
     response = await handler(request)
-    response = cast(web.Response, response)
-    if request.method != 'POST' or request.path != '/question':
+    # the full reply, whatever the client asked to get of it (or None if
+    # nothing was answered: shed, timed out...)
+    reply = request.get('qa_reply', None)
+    if reply is None:
         return response
-    #import pdb
-    #pdb.set_trace()
-    text = response.text
-    if isinstance(text, str):
-        reply = json.loads(text)
-        to_log = {}
-        to_log['question'] = reply['question']
-        to_log['quick_answer'] = reply['quick_answer']
-        to_log['answers'] = [
-                {k:answer[k] for k in answer if k != 'paragraph'}
-                for answer in reply['answers']
-            ]
-        # TODO: in real life, we probably shouldn't flush this
-        print(json.dumps(to_log),file=qa_log,flush=True)
+    to_log = qa_log_entry(reply, request.get('qa_kbs', [DEFAULT_KB]))
+    # TODO: in real life, we probably shouldn't flush this
+    with span('log qa'):
+        print(dumps(to_log).decode('utf-8'),file=qa_log,flush=True)
     return response
 
 #
@@ -193,59 +265,18 @@ async def log_qa_middleware(
 # all the question-answer related stuff.
 #
 
-def get_quick_answer(answers: List[Dict[str,Any]]) -> str:
-    """Implement heuristic to choose an answer.
-
-    Right now, it's unclear which answer to choose.  Given that the empty span
-    is the best answer for a paragraph, then we can can ignore that paragraph.
-    Comparing the ratings returned from the model for different paragraphs is
-    problematic...
-    Here are the two current ideas:
-
-    1. Choose the first non-empty answer
-    2. Choose best rated non-empty answer
-
-    1. Means that we assume that the most relevant paragraph found by
-       ElasticSearch is most likely to contain the right answer, so we pick it.
-    2. Means that we take the best rated answer.
-
-    Option 1 has experimentally demonstrated better results (see the reports
-    on the blog qa), while 2 is the most commonly implemented heuristic.  As
-    of right now, ElasticSearch needs to be better configured to make option 1
-    work properly.  Option 2 may be a good option if the model can be trained
-    to better identify when a paragraph is irrelevant.
-
-    Better configuring ElasticSearch means incorporating boosts, stopwords,
-    and making the base text better.
-    More training of the model is a bit more interesting, but perhaps less
-    promising...
+async def get_answers(
+        query: str, kbs: Optional[List[KnowledgeBase]] = None,
+        deadline: Optional[Deadline] = None
+    ) -> List[Dict[str,Any]]:
+    """Consult ES and the model to return potential answers.
+
+    The knowledge bases in `kbs` (default: the default one) are searched
+    concurrently, and the best passages of all of them are answered in a
+    single batch.  If a deadline is given, it is checked before retrieval
+    and before inference.  With CONTEXT_WINDOWS, the model reads only a
+    window of each passage around the sentence best matching the query.
     """
-    def filter_no_answers(candidates: List[Dict[str,Any]]) -> List[Dict[str,Any]]:
-        return list(filter(lambda answer: answer['answer'] != '', candidates))
-    def sort_by_rating(answers_: List[Dict[str,Any]]) -> List[Dict[str,Any]]:
-        return list(sorted(answers_, key=lambda a: a['rating'], reverse=True))
-    candidates = answers
-    candidates = filter_no_answers(candidates)
-    candidates = sort_by_rating(candidates)
-    if len(candidates) > 0:
-        return candidates[0]['answer']
-    else:
-        return no_answer()
-
-def make_answer(
-        answer: str, rating: float = 0., paragraph: str = "",
-        paragraph_rank: int = 0, docId: str = ''
-        ) -> Dict[str,Union[str,float,int]]:
-    return {
-        'answer': answer,
-        'rating': rating,
-        'paragraph': paragraph,
-        'paragraph_rank': paragraph_rank,
-        'docId': docId,
-    }
-
-async def get_answers(query: str) -> List[Dict[str,Any]]:
-    """Consult ES and the model to return potential answers."""
     result: List[Dict[str,Any]] = []
     answers = []
     # 
@@ -258,21 +289,126 @@ async def get_answers(query: str) -> List[Dict[str,Any]]:
     if happy_employee is not None:
         return [make_answer(happy_employee)]
     #
-    paragraphs = await get_paragraphs_for_query(query, INDEX_NAME, topk=5)
-    for rank,paragraph in enumerate(paragraphs):
-        context = paragraph['text']
-        answer = pipeline({'question': query, 'context': context},
-                           handle_impossible_answer=True,
-                           topk=1)
-        answers.append(make_answer(
-            answer=answer_to_complete_sentence(answer['answer'],context),
-            rating=answer['score'],
-            paragraph=context,
-            paragraph_rank=rank,
-            docId=paragraph['_id'],
-        ))
+    if kbs is None:
+        kbs = [knowledge_bases[DEFAULT_KB]]
+    if deadline is not None:
+        deadline.check('retrieval')
+    with span('retrieval', kbs=[kb.name for kb in kbs]):
+        paragraphs = await search(kbs, query, topk=5)
+    # all passages are answered by one model, even if another is activated
+    _, pipeline = registry.get()
+    texts = [paragraph['text'] for paragraph in paragraphs]
+    if CONTEXT_WINDOWS:
+        with span('windows'):
+            windows = query_windows(query, texts)
+    else:
+        windows = [Window(text, 0) for text in texts]
+    contexts = [window.text for window in windows]
+    if deadline is not None:
+        deadline.check('inference')
+    start = time.perf_counter()
+    with span('inference', 'model', passages=len(contexts)):
+        raw_answers = await run_pipeline_batch(query, contexts, pipeline)
+    inference_s = time.perf_counter() - start
+    with span('sentences'):
+        answers = paragraph_answers(paragraphs, windows, raw_answers)
+    registry.maybe_shadow(query, contexts, raw_answers, inference_s)
     return answers
 
+admission = AdmissionController(
+    MAX_IN_FLIGHT, MAX_QUEUED, QUEUE_TIMEOUT, retry_after=RETRY_AFTER
+)
+questions_in_flight = SingleFlight()
+
+async def answer_for_store(
+        question: str, kb: KnowledgeBase
+    ) -> Optional[Answers]:
+    """Answers worth precomputing (the canned jokes are random, so not)."""
+    if get_happy_employee(question) is not None:
+        return None
+    return await get_answers(question, [kb])
+
+async def knowledge_base_changed(kb: KnowledgeBase):
+    """Bring derived data of a knowledge base up to its current commit.
+
+    The packed store is rebuilt (incrementally), and the answer store is
+    pointed at the commit and the active model, and warmed if either moved.
+    """
+    commit = await kb.git.head_commit()
+    await kb.packed.update(commit)
+    if kb.answers.set_commit(commit, registry.active):
+        def answer(question: str):
+            return answer_for_store(question, kb)
+        kb.answers.start_warming(answer, QA_LOG_PATH, WARM_TOP_N)
+
+def get_kb(request: Request, body: Optional[Dict[str,Any]] = None) -> KnowledgeBase:
+    """Knowledge base named by `kb` in the body or query string."""
+    return get_kbs(request, body, many=False)[0]
+
+def get_kbs(
+        request: Request, body: Optional[Dict[str,Any]] = None,
+        many: bool = True
+    ) -> List[KnowledgeBase]:
+    """Knowledge bases named by `kb` in the body or query string.
+
+    `kb` is a name, or (with `many`) a list of names, comma separated in
+    the query string.  Defaults to the default knowledge base.
+    """
+    names = (body or {}).get('kb', request.query.get('kb', DEFAULT_KB))
+    if isinstance(names, str):
+        names = names.split(',') if many else [names]
+    if not isinstance(names, list) or len(names) == 0 or \
+            (not many and len(names) > 1):
+        raise APIError(request, '"kb" must name a knowledge base')
+    unknown = [name for name in names if name not in knowledge_bases]
+    if len(unknown) > 0:
+        raise APIError(request, f'unknown knowledge base: {", ".join(map(str, unknown))}')
+    # in the given order, each once
+    return [knowledge_bases[name] for name in dict.fromkeys(names)]
+
+def get_fields(request: Request, body: Dict[str,Any]) -> str:
+    """The `fields` option, from the json body or the query string."""
+    fields = body.get('fields', request.query.get('fields', 'full'))
+    if body.get('compact', False) is True:
+        fields = 'compact'
+    if fields not in ANSWER_FIELDS:
+        options = ', '.join(f"'{f}'" for f in ANSWER_FIELDS)
+        raise APIError(request, f'"fields" must be one of {options}')
+    return fields
+
+def qa_response(
+        request: Request, response: Dict[str,Any],
+        answers: List[Dict[str,Any]], fields: str
+    ) -> Response:
+    """Reply with the answers, shaped by `fields`.
+
+    The full reply is kept on the request for `log_qa_middleware`.  It gets
+    its own list: `answers` may be shared with other requests (singleflight,
+    answer store).
+    """
+    response['answers'] = list(answers)
+    response['quick_answer'] = get_quick_answer(answers)
+    request['qa_reply'] = response
+    reply = dict(response)
+    with span('encode', fields=fields):
+        reply['answers'] = shape_answers(answers, fields)
+        return fast_json_response(request, reply)
+
+def get_deadline(request: Request) -> Deadline:
+    """Deadline from the `x-request-timeout` header (seconds) or default."""
+    timeout = REQUEST_TIMEOUT
+    header = request.headers.get('x-request-timeout',None)
+    if header is not None:
+        try:
+            timeout = float(header)
+        except ValueError:
+            raise APIError(request, '"x-request-timeout" must be a number')
+        timeout = min(max(timeout, 0.), MAX_REQUEST_TIMEOUT)
+    def is_abandoned() -> bool:
+        transport = request.transport
+        return transport is None or transport.is_closing()
+    return Deadline(timeout, is_abandoned)
+
 @routes.post('/question')
 async def answer_question(request: Request) -> Response:
     """Implement QA API."""
@@ -289,28 +425,228 @@ async def answer_question(request: Request) -> Response:
         question = body['question']
     except KeyError:
         raise APIError(request,'<question: str> required in json body')
+    fields = get_fields(request, body)
+    kbs = get_kbs(request, body)
+    request['qa_kbs'] = [kb.name for kb in kbs]
     response: Dict[str,Any] = {'question': {'text': question, 'uuid': uuid}}
+    # only questions for a single knowledge base are precomputed
+    stored = kbs[0].answers.get(question) if len(kbs) == 1 else None
+    if stored is not None:
+        return qa_response(request, response, stored, fields)
+    deadline = get_deadline(request)
+    # identical questions asked while one is being answered share its answers,
+    # unless the index or the active model changed meanwhile
+    key = (normalize_question(question), registry.active,
+           tuple((kb.name, index_generations[kb.index]) for kb in kbs))
+    def work(group_deadline: Deadline):
+        return get_answers(question, kbs, group_deadline)
+    # joining work in progress costs no model time, so isn't admission checked
+    admitted = not questions_in_flight.in_flight(key)
+    if admitted:
+        try:
+            with span('admission'):
+                await admission.acquire(deadline)
+        except Overloaded as e:
+            log.warning(f'shed {uuid}: {e}')
+            headers = {'Retry-After': str(e.retry_after)}
+            return json_response(exception_to_dict(e), status=503, headers=headers)
+        except DeadlineExceeded as e:
+            admission.record_expired(e)
+            log.warning(f'expired {uuid}: {e}')
+            return json_response(exception_to_dict(e), status=504)
+    # the slot is held until the work is done, even if this request stops
+    # waiting for it first
+    release = admission.release if admitted else None
     try:
-        response['answers'] = await get_answers(question)
+        with span('answer', joined=not admitted):
+            answers = await questions_in_flight.do(key, work, deadline, release)
+    except DeadlineExceeded as e:
+        admission.record_expired(e)
+        log.warning(f'expired {uuid}: {e}')
+        return json_response(exception_to_dict(e), status=504)
     except Exception as e:
         raise AnswerError(e, question)
-    response['quick_answer'] = get_quick_answer(response['answers'])
-    return json_response(response)
+    return qa_response(request, response, answers, fields)
+
+@routes.get('/stats')
+async def get_stats(request: Request) -> Response:
+    """Counters for monitoring the server."""
+    return json_response({
+        'admission': admission.stats(),
+        'singleflight': questions_in_flight.stats(),
+        'models': registry.stats(),
+        'answer_store': {
+            name: kb.answers.stats() for name, kb in knowledge_bases.items()
+        },
+        'reindex': {
+            name: jobs.stats() for name, jobs in reindex_jobs.items()
+        },
+        'commits': {
+            name: kb.git.committer.stats() for name, kb in knowledge_bases.items()
+        },
+        'retrieval_cache': retrieval_cache.stats(),
+        'tracing': tracer.stats(),
+        'duplicates': {
+            index: {'groups': len(groups), 'copies': count_copies(groups)}
+            for index, groups in duplicate_groups.items()
+        },
+    })
+
+@routes.get('/models')
+async def get_models(request: Request) -> Response:
+    """Loaded models, the active and shadow ones, and the comparison."""
+    return json_response(registry.stats())
+
+@routes.post('/models')
+async def manage_models(request: Request) -> Response:
+    """Dispatch load, activate, shadow and unload requests.
+
+    `shadow` takes a `fraction` of questions to shadow (a `name` of null
+    stops shadowing).
+    """
+    denied = check_admin_token(request)
+    if denied is not None:
+        return denied
+    body = await request.json()
+    command = body.get('command',None)
+    name = body.get('name',None)
+    if command == 'load':
+        await registry.load(name)
+    elif command == 'activate':
+        registry.activate(name)
+        # stored answers are the previous model's
+        for kb in knowledge_bases.values():
+            await knowledge_base_changed(kb)
+    elif command == 'shadow':
+        registry.set_shadow(name, float(body.get('fraction',0.1)))
+    elif command == 'unload':
+        registry.unload(name)
+    else:
+        msg = "require a 'command' of 'load', 'activate', 'shadow' or 'unload'"
+        raise APIError(request, msg)
+    return json_response(registry.stats())
+
+@routes.get('/admin/profiling')
+async def get_profiling(request: Request) -> Response:
+    """Hot functions (and allocations) of the profiled requests so far."""
+    denied = check_profile_token(request)
+    if denied is not None:
+        return denied
+    return json_response(profiler.report())
+
+@routes.post('/admin/profiling')
+async def manage_profiling(request: Request) -> Response:
+    """Dispatch start, stop and reset requests.
+
+    `start` takes the `fraction` of questions to profile, and whether to
+    trace `allocations` too.
+    """
+    denied = check_profile_token(request)
+    if denied is not None:
+        return denied
+    body = await request.json()
+    command = body.get('command',None)
+    if command == 'start':
+        profiler.start(float(body.get('fraction',0.01)),
+                       bool(body.get('allocations',False)))
+    elif command == 'stop':
+        profiler.stop()
+    elif command == 'reset':
+        profiler.reset()
+    else:
+        msg = "require a 'command' of 'start', 'stop' or 'reset'"
+        raise APIError(request, msg)
+    return json_response(profiler.report())
+
+def check_profile_token(request: Request) -> Optional[Response]:
+    """404 if no profiling token is set, 403 unless the request has it."""
+    if PROFILE_TOKEN is None:
+        msg = 'profiling is disabled, set QA_PROFILE_TOKEN to enable it'
+        return json_response({'error': msg}, status=404)
+    if request.headers.get('x-profile',None) != PROFILE_TOKEN:
+        return json_response({'error': '"x-profile" token required'}, status=403)
+    return None
+
+def check_admin_token(request: Request) -> Optional[Response]:
+    """404 if no admin token is set, 403 unless the request has it."""
+    if ADMIN_TOKEN is None:
+        msg = 'managing models is disabled, set QA_ADMIN_TOKEN to enable it'
+        return json_response({'error': msg}, status=404)
+    if request.headers.get('x-admin-token',None) != ADMIN_TOKEN:
+        return json_response({'error': '"x-admin-token" token required'}, status=403)
+    return None
 
 #
 # CRUD and webhook
 #
 
+async def reindex(
+        kb: KnowledgeBase, pull: bool, progress: Callable[[str],None]
+    ) -> Dict[str,Any]:
+    """One background pass: pull, index what changed, update derived data."""
+    if pull:
+        progress('pulling')
+        await kb.git.pull()
+        log.info(f'{kb.name}: pull complete')
+    progress('indexing')
+    # taken before indexing: whatever is committed meanwhile may be missed
+    # by this pass, so the snapshot mustn't claim it
+    commit = await kb.git.head_commit()
+    indexed, deleted = await index_changed(kb.index, kb.corpus)
+    log.info(f'{kb.name}: reindex complete')
+    progress('snapshotting')
+    await snapshots.save(kb, commit)
+    progress('refreshing')
+    await knowledge_base_changed(kb)
+    return {'indexed': indexed, 'deleted': deleted}
+
+def make_reindex_queue(kb: KnowledgeBase) -> ReindexQueue:
+    def reindex_kb(pull: bool, progress: Callable[[str],None]):
+        return reindex(kb, pull, progress)
+    return ReindexQueue(reindex_kb, REINDEX_DEBOUNCE, REINDEX_MAX_DELAY)
+
+# one queue (and worker) per knowledge base, they don't wait on each other
+reindex_jobs: Dict[str,ReindexQueue] = {
+    name: make_reindex_queue(kb) for name, kb in knowledge_bases.items()
+}
+
+def job_accepted(job: Job, git_response: Optional[Response] = None) -> Response:
+    """202 with the job, and whatever json the git operation replied."""
+    body = job.to_dict()
+    reason = None
+    if git_response is not None:
+        reason = git_response.reason
+        if git_response.content_type == 'application/json':
+            body.update(json.loads(cast(bytes, git_response.body)))
+    return json_response(body, status=202, reason=reason)
+
+async def reindex_after(
+        kb: KnowledgeBase, git_response: Response, reason: str
+    ) -> Response:
+    """Queue a reindex if the git operation went through."""
+    if git_response.status != 200:
+        return git_response
+    return job_accepted(reindex_jobs[kb.name].submit(reason), git_response)
+
+@routes.get('/jobs/{job_id}')
+async def get_job(request: Request) -> Response:
+    """State, progress, duration and error of a reindex job."""
+    for name, jobs in reindex_jobs.items():
+        job = jobs.get(request.match_info['job_id'])
+        if job is not None:
+            return json_response(dict(job.to_dict(), kb=name))
+    return json_response({'error': 'no such job'}, status=404)
+
 @routes.post('/webhook')
 async def handle_webhook(request: Request) -> Response:
     body = await request.json()
     log.info('handling webhook')
     #pprint(body)
     if body.get('event_name',None) == 'push':
-        await git_client.pull()
-        log.info('pull complete')
-        await index_all(INDEX_NAME)
-        log.info('index all complete')
+        # each knowledge base's hook points at `/webhook?kb=<name>`
+        kb = get_kb(request)
+        job = reindex_jobs[kb.name].submit('webhook: push', pull=True)
+        return job_accepted(job)
     return Response(status=200)
 
 @routes.post('/index')
@@ -318,22 +654,68 @@ async def create_update(request: Request) -> Response:
     """Dispatch create and update requests"""
     body = await request.json()
     command = body.get('command',None)
+    kb = get_kb(request, body)
     if command == 'create':
         docId = body['docId']
         text = body['text']
-        git_response = await git_client.create(text,docId)
-        index_one(INDEX_NAME, text, docId)
-        return git_response
+        git_response = await kb.git.create(text,docId)
+        return await reindex_after(kb, git_response, f'create: {docId}')
     elif command == 'update':
         docId = body['docId']
         docs = body['docs']
-        git_response = await git_client.update(docId, docs)
-        await index_all(INDEX_NAME)
-        return git_response
+        git_response = await kb.git.update(docId, docs)
+        return await reindex_after(kb, git_response, f'update: {docId}')
     else:
         msg = "require a 'command' with value 'create' or 'update'"
         raise APIError(request, msg)
 
+def get_flag(request: Request, name: str) -> bool:
+    """Boolean query-string parameter (`?name=true`)."""
+    return request.query.get(name,'false').lower() in ('1','true')
+
+def get_limit(request: Request) -> Optional[int]:
+    """Optional positive integer `limit` query-string parameter."""
+    q_limit = request.query.get('limit',None)
+    if q_limit is None:
+        return None
+    try:
+        limit = int(q_limit)
+    except ValueError:
+        limit = 0
+    if limit <= 0:
+        raise APIError(request, '"limit" must be a positive integer')
+    return limit
+
+# uploads bigger than this are spooled to disk rather than kept in memory
+BULK_SPOOL_SIZE = 8 * 2**20
+
+@routes.post('/index/bulk')
+async def bulk_create(request: Request) -> Response:
+    """Import a JSONL or tar upload as one commit and one bulk index.
+
+    Pass `?replace=true` to replace the whole knowledge base with the upload.
+    """
+    kind = content_types.get(request.content_type, None)
+    if kind is None:
+        types = ', '.join(content_types)
+        raise APIError(request, f'content-type must be one of: {types}')
+    replace = get_flag(request, 'replace')
+    kb = get_kb(request)
+    with SpooledTemporaryFile(max_size=BULK_SPOOL_SIZE) as upload:
+        async for chunk in request.content.iter_chunked(2**16):
+            upload.write(chunk)
+        upload.seek(0)
+        try:
+            result = await bulk_import(
+                kb.git, iter_docs(upload, kind),
+                index=kb.index, replace=replace, corpus=kb.corpus
+            )
+        except GitError as e:
+            return e.response
+    await snapshots.save(kb, result['commit'])
+    await knowledge_base_changed(kb)
+    return json_response(result)
+
 def get_docids_from_request(request: Request) -> List[str]:
     """Dispatch create and update requests"""
     query = request.query
@@ -344,34 +726,65 @@ def get_docids_from_request(request: Request) -> List[str]:
     return q_docId.split(',')
 
 @routes.get('/index')
-async def read(request: Request) -> Response:
-    """Read the doc given in the docstring"""
+async def read(request: Request) -> StreamResponse:
+    """Read the docs given in the query string.
+
+    Optional query-string parameters:
+
+    * `limit` and `cursor` page through the matches, each page's reply
+      contains the `cursor` for the next one
+    * `meta=true` returns docId, size and hash instead of the text
+    * `stream=true` (or `accept: application/x-ndjson`) streams one doc per
+      line as they are read, with a `limit` the last line has the `cursor`
+    """
     docIds = get_docids_from_request(request)
-    return await git_client.read(docIds)
+    kb = get_kb(request)
+    kwargs: Dict[str,Any] = {
+        'limit': get_limit(request),
+        'cursor': request.query.get('cursor',None),
+        'meta': get_flag(request, 'meta'),
+    }
+    if get_flag(request, 'stream') or \
+            'application/x-ndjson' in request.headers.get('accept',''):
+        return await kb.git.read_stream(request, docIds, **kwargs)
+    return await kb.git.read(docIds, **kwargs)
 
 @routes.delete('/index')
 async def delete(request: Request) -> Response:
     """Dispatch create and update requests"""
     docIds = get_docids_from_request(request)
-    git_response = await git_client.delete(docIds)
-    #es.delete(index=INDEX_NAME,id=docIds)
-    helpers.bulk(es,[
-        {'_op_type': 'delete', '_index': INDEX_NAME, '_id': docId, }
-        for docId in docIds
-        ])
-    return git_response
+    kb = get_kb(request)
+    git_response = await kb.git.delete(docIds)
+    return await reindex_after(kb, git_response, f'delete: {",".join(docIds)}')
 
 #
 # Server Boilerplate
 #
 
+# the trace starts as early as it can (it's named after the uuid), so the
+# other middlewares get a span each
 middlewares = [
-    exception_to_json_middleware,
-    answer_exception_middleware,
     attach_uuid_middleware,
-    log_qa_middleware,
+    trace_middleware,
+    traced(exception_to_json_middleware),
+    traced(answer_exception_middleware),
+    traced(profile_middleware),
+    traced(log_qa_middleware),
 ]
 app = web.Application(middlewares=middlewares)
 app.add_routes(routes)
 
-web.run_app(app,host='0.0.0.0',port=8080)
+async def on_startup(app: web.Application):
+    for kb in knowledge_bases.values():
+        head = await kb.git.head_commit()
+        indexed_at = await snapshots.restore(kb, head)
+        # nothing restored (no snapshot or index) reads everything
+        if indexed_at != head:
+            reindex_jobs[kb.name].submit(f'startup: {indexed_at} -> {head}')
+        await knowledge_base_changed(kb)
+
+app.on_startup.append(on_startup)
+
+if __name__ == '__main__':
+    # on the loop module level objects (locks, queues...) were made for
+    web.run_app(app,host='0.0.0.0',port=8080,loop=loop)
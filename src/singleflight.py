@@ -0,0 +1,84 @@
+# singleflight.py
+"""
+Coalesce identical concurrent work
+
+The first caller for a key starts the work, callers arriving with the same
+key while it runs wait for the same result instead of repeating it.  The
+work runs in its own task with a `GroupDeadline` made of every waiter's
+deadline, so it carries on for as long as someone is still waiting, and a
+waiter whose own deadline passes gives up without cancelling it for others.
+Whatever was reserved for the work (an admission slot) is given back when
+the work is done, not when the caller that started it stops waiting.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from admission import Deadline, DeadlineExceeded, GroupDeadline
+
+class Flight:
+    """Work in progress for one key."""
+    task: 'asyncio.Future[Any]'
+    deadline: GroupDeadline
+
+    def __init__(self, task: 'asyncio.Future[Any]', deadline: GroupDeadline):
+        self.task = task
+        self.deadline = deadline
+
+class SingleFlight:
+    flights: Dict[Hashable,Flight]
+    counts: Dict[str,int]
+
+    def __init__(self):
+        self.flights = {}
+        self.counts = {'started': 0, 'coalesced': 0}
+
+    def in_flight(self, key: Hashable) -> bool:
+        return key in self.flights
+
+    async def do(
+            self, key: Hashable, work: Callable[[Deadline], Awaitable[Any]],
+            deadline: Deadline, release: Optional[Callable[[], None]] = None
+        ) -> Any:
+        """Return work(deadline)'s result, sharing it with identical calls.
+
+        `release` is called when the work is done if this call started it,
+        right away if it joined work in progress.
+        Raises DeadlineExceeded if `deadline` passes before the result is in.
+        """
+        flight = self.flights.get(key, None)
+        if flight is None:
+            group = GroupDeadline([deadline])
+            task = asyncio.ensure_future(work(group))
+            flight = Flight(task, group)
+            self.flights[key] = flight
+            task.add_done_callback(lambda t: self._done(key, flight, release))
+            self.counts['started'] += 1
+        else:
+            flight.deadline.add(deadline)
+            self.counts['coalesced'] += 1
+            if release is not None:
+                release()
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(flight.task), max(deadline.remaining(), 0.)
+            )
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded('answer')
+
+    def _done(
+            self, key: Hashable, flight: Flight,
+            release: Optional[Callable[[], None]]
+        ):
+        if self.flights.get(key, None) is flight:
+            del self.flights[key]
+        if release is not None:
+            release()
+        # nobody may be left waiting, don't warn about unretrieved errors
+        if not flight.task.cancelled():
+            flight.task.exception()
+
+    def stats(self) -> Dict[str,int]:
+        stats = dict(self.counts)
+        stats['in_flight'] = len(self.flights)
+        return stats
@@ -0,0 +1,151 @@
+# snapshots.py
+"""
+Snapshots of a knowledge base's derived state, by commit
+
+After each index pass, the state derived from the source dir (the corpus
+manifest with every file's hash, and the duplicate groups) is written to
+`<SNAPSHOT_DIR>/<commit>.json`, and the commit is recorded in the `_meta`
+of the index mapping, so ES itself says which commit its contents reflect.
+
+A new process reads the index's commit and restores the manifest from that
+commit's snapshot, so it doesn't read or index anything it doesn't have to.
+Files that changed between that commit and HEAD (per `git diff`) are left
+out of the manifest, so the next `index_changed` indexes just those.  If
+the snapshot is missing (e.g. a new replica sharing the index), the
+manifest is derived from the working tree and the same diff.
+
+The packed store (packed_store.py) and the answer store are kept per commit
+on disk already.
+"""
+
+import asyncio
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from util import SNAPSHOT_DIR, SNAPSHOT_KEEP, es, kb_path, log
+from git_crud import GitError, git_diff_names
+from corpus import ManifestEntry
+from create_index import duplicate_groups, passage_hashes
+from knowledge_base import KnowledgeBase
+
+SNAPSHOT_VERSION = 1
+# manifest entry of a file that's gone, so `CorpusLoader.removed` sees it
+GONE = ManifestEntry(0, -1, '')
+
+def index_commit(index: str) -> Optional[str]:
+    """Commit the index's contents reflect (None: unknown or no index)."""
+    if not es.indices.exists(index=index):
+        return None
+    mappings = es.indices.get_mapping(index=index)
+    # keyed by the concrete index name, which an alias wouldn't be
+    mapping = next(iter(mappings.values()))['mappings']
+    return mapping.get('_meta', {}).get('commit', None)
+
+def set_index_commit(index: str, commit: str):
+    es.indices.put_mapping(index=index, body={'_meta': {'commit': commit}})
+
+def snapshot_path(kb: KnowledgeBase, commit: str) -> Path:
+    return Path(kb_path(SNAPSHOT_DIR, kb.name)) / f'{commit}.json'
+
+def write_snapshot(kb: KnowledgeBase, commit: str):
+    """Write the snapshot of kb at commit, drop the old ones (blocking)."""
+    path = snapshot_path(kb, commit)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = {
+        'version': SNAPSHOT_VERSION,
+        'kb': kb.name,
+        'index': kb.index,
+        'commit': commit,
+        'created_at': time.time(),
+        'manifest': {
+            name: list(entry) for name, entry in kb.corpus.manifest.items()
+        },
+        'duplicates': duplicate_groups.get(kb.index, {}),
+    }
+    tmp = path.with_suffix('.tmp')
+    with open(tmp, 'w', encoding='utf-8') as file:
+        json.dump(data, file)
+    os.replace(tmp, path)
+    snapshots = sorted(path.parent.glob('*.json'), key=lambda p: p.stat().st_mtime)
+    for old in snapshots[:-SNAPSHOT_KEEP]:
+        old.unlink()
+
+def read_snapshot(kb: KnowledgeBase, commit: str) -> Optional[Dict[str,Any]]:
+    """The snapshot of kb at commit, if there's a usable one (blocking)."""
+    path = snapshot_path(kb, commit)
+    try:
+        with open(path, encoding='utf-8') as file:
+            data = json.load(file)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        log.error(f'snapshot {path} unreadable: {e}')
+        return None
+    if data.get('version', None) != SNAPSHOT_VERSION or data['index'] != kb.index:
+        return None
+    return data
+
+async def save(kb: KnowledgeBase, commit: Optional[str]):
+    """Record that kb's index reflects (at least) commit."""
+    if commit is None:
+        return
+    await asyncio.get_running_loop().run_in_executor(None, write_snapshot, kb, commit)
+    await asyncio.get_running_loop().run_in_executor(
+        None, set_index_commit, kb.index, commit
+    )
+    log.info(f'{kb.name}: snapshot at {commit}')
+
+async def restore(kb: KnowledgeBase, head: Optional[str]) -> Optional[str]:
+    """Restore kb's manifest from the commit its index is at.
+
+    Returns that commit, or None if nothing could be restored (no index,
+    or its commit isn't known to git), in which case the next index pass
+    reads everything.  If it isn't `head`, an `index_changed` brings the
+    index up to date with just the changed files.
+    """
+    if head is None:
+        return None
+    commit = await asyncio.get_running_loop().run_in_executor(
+        None, index_commit, kb.index
+    )
+    if commit is None:
+        return None
+    changed: List[str] = []
+    if commit != head:
+        try:
+            names = await git_diff_names(kb.source_dir, commit, head)
+        except GitError:
+            log.warning(f'{kb.name}: index at unknown commit {commit}')
+            return None
+        # docs are the .txt files at the top of the source dir
+        changed = [n for n in names if n.endswith('.txt') and '/' not in n]
+    snapshot = await asyncio.get_running_loop().run_in_executor(None, read_snapshot, kb, commit)
+    stats = await kb.corpus.snapshot()
+    present = set(stat.name for stat in stats)
+    saved: Optional[Dict[str,List[Any]]] = None
+    if snapshot is not None:
+        saved = snapshot['manifest']
+        duplicate_groups[kb.index] = snapshot['duplicates']
+        # the next index pass reads them from ES again
+        passage_hashes.pop(kb.index, None)
+    manifest: Dict[str,ManifestEntry] = {}
+    # unchanged since the index was built: current stat, hash as indexed
+    # (a file not in the snapshot was never indexed)
+    skip = set(changed)
+    for stat in stats:
+        if stat.name in skip or (saved is not None and stat.name not in saved):
+            continue
+        _hash = saved[stat.name][2] if saved is not None else ''
+        manifest[stat.name] = ManifestEntry(stat.mtime_ns, stat.size, _hash)
+    # indexed, but gone since
+    for name in list(saved or []) + changed:
+        if name not in present:
+            manifest[name] = GONE
+    kb.corpus.load(manifest)
+    source = 'snapshot' if snapshot is not None else 'working tree'
+    log.info(f'{kb.name}: index at {commit}, manifest from {source}, '
+             f'{len(changed)} files changed since')
+    return commit
@@ -0,0 +1,209 @@
+# test_analysis.py
+"""
+Tests of the local emulation of the index's text analysis
+
+    python -m unittest test_analysis
+
+The stemmer is checked against words of Porter's reference vocabulary (and
+the examples of his paper) with the stems of the reference implementation.
+The parity tests ask ES's `_analyze` for the terms of the same texts, they
+are skipped when ES isn't reachable.
+"""
+
+import unittest
+from typing import Any, Dict, List, Set, Tuple
+
+from analysis import analyze, porter_stem
+
+# (word, stem): the start of Porter's voc.txt, as in output.txt
+VOCABULARY = [
+    ('a', 'a'), ('aaron', 'aaron'), ('abaissiez', 'abaissiez'),
+    ('abandon', 'abandon'), ('abandoned', 'abandon'), ('abase', 'abas'),
+    ('abash', 'abash'), ('abate', 'abat'), ('abated', 'abat'),
+    ('abatement', 'abat'), ('abatements', 'abat'), ('abates', 'abat'),
+    ('abbess', 'abbess'), ('abbey', 'abbei'), ('abbeys', 'abbei'),
+    ('abbot', 'abbot'), ('abbots', 'abbot'), ('abbreviated', 'abbrevi'),
+    ('abed', 'ab'), ('abel', 'abel'), ('aberga', 'aberga'),
+    ('abergavenny', 'abergavenni'), ('abet', 'abet'), ('abetting', 'abet'),
+    ('abhominable', 'abhomin'), ('abhor', 'abhor'), ('abhorr', 'abhorr'),
+    ('abhorred', 'abhor'), ('abhorring', 'abhor'), ('abhors', 'abhor'),
+    ('abhorson', 'abhorson'), ('abide', 'abid'), ('abides', 'abid'),
+    ('abilities', 'abil'), ('ability', 'abil'), ('abject', 'abject'),
+    ('abjectly', 'abjectli'), ('abjects', 'abject'), ('abjur', 'abjur'),
+    ('abjure', 'abjur'), ('able', 'abl'), ('abler', 'abler'),
+    ('aboard', 'aboard'), ('abode', 'abod'), ('aboded', 'abod'),
+    ('abodements', 'abod'), ('aboding', 'abod'), ('abominable', 'abomin'),
+    ('abominably', 'abomin'), ('abominations', 'abomin'),
+    ('abortive', 'abort'), ('abortives', 'abort'), ('abound', 'abound'),
+    ('abounding', 'abound'), ('about', 'about'), ('above', 'abov'),
+    ('abr', 'abr'), ('abraham', 'abraham'), ('abram', 'abram'),
+    ('abreast', 'abreast'), ('abridg', 'abridg'), ('abridge', 'abridg'),
+    ('abridged', 'abridg'), ('abridgment', 'abridg'), ('abroach', 'abroach'),
+    ('abroad', 'abroad'), ('abrogate', 'abrog'), ('abrook', 'abrook'),
+    ('abrupt', 'abrupt'), ('abruption', 'abrupt'), ('abruptly', 'abruptli'),
+    ('absence', 'absenc'), ('absent', 'absent'), ('absey', 'absei'),
+    ('absolute', 'absolut'), ('absolutely', 'absolut'), ('absolv', 'absolv'),
+    ('absolver', 'absolv'), ('abstains', 'abstain'),
+    ('abstemious', 'abstemi'), ('abstinence', 'abstin'),
+    ('abstract', 'abstract'), ('absurd', 'absurd'), ('abundance', 'abund'),
+    ('abundant', 'abund'), ('abundantly', 'abundantli'), ('abus', 'abu'),
+    ('abuse', 'abus'), ('abused', 'abus'), ('abuser', 'abus'),
+    ('abuses', 'abus'), ('abusing', 'abus'), ('abutting', 'abut'),
+    ('aby', 'abi'), ('abysm', 'abysm'), ('ac', 'ac'), ('academe', 'academ'),
+    ('academes', 'academ'), ('accent', 'accent'), ('accents', 'accent'),
+    ('accept', 'accept'), ('acceptable', 'accept'), ('acceptance', 'accept'),
+    ('accepted', 'accept'), ('accepts', 'accept'), ('access', 'access'),
+    ('accessary', 'accessari'), ('accessible', 'access'),
+    ('accidence', 'accid'), ('accident', 'accid'), ('accidental', 'accident'),
+    ('accidentally', 'accident'), ('accidents', 'accid'), ('accite', 'accit'),
+    ('accited', 'accit'), ('accites', 'accit'), ('acclamations', 'acclam'),
+    ('accommodate', 'accommod'), ('accommodated', 'accommod'),
+    ('accommodation', 'accommod'), ('accommodations', 'accommod'),
+    ('accommodo', 'accommodo'), ('accompanied', 'accompani'),
+    ('accompany', 'accompani'), ('accompanying', 'accompani'),
+    ('accomplices', 'accomplic'), ('accomplish', 'accomplish'),
+    ('accomplished', 'accomplish'), ('accomplishing', 'accomplish'),
+    ('accomplishment', 'accomplish'), ('accompt', 'accompt'),
+    ('accord', 'accord'), ('accordant', 'accord'), ('accorded', 'accord'),
+    ('accordeth', 'accordeth'), ('according', 'accord'),
+    ('accordingly', 'accordingli'), ('accords', 'accord'),
+    ('accost', 'accost'), ('accosted', 'accost'), ('account', 'account'),
+    ('accountant', 'account'), ('accounted', 'account'),
+    ('accounts', 'account'), ('accoutred', 'accoutr'),
+    ('accoutrement', 'accoutr'), ('accoutrements', 'accoutr'),
+    ('accrue', 'accru'),
+
+]
+# (word, stem): the examples of "An algorithm for suffix stripping"
+PAPER = [
+    ('caresses', 'caress'), ('ponies', 'poni'), ('ties', 'ti'),
+    ('caress', 'caress'), ('cats', 'cat'), ('feed', 'feed'),
+    ('agreed', 'agre'), ('plastered', 'plaster'), ('bled', 'bled'),
+    ('motoring', 'motor'), ('sing', 'sing'), ('conflated', 'conflat'),
+    ('troubled', 'troubl'), ('sized', 'size'), ('hopping', 'hop'),
+    ('tanned', 'tan'), ('falling', 'fall'), ('hissing', 'hiss'),
+    ('fizzed', 'fizz'), ('failing', 'fail'), ('filing', 'file'),
+    ('happy', 'happi'), ('sky', 'sky'), ('relational', 'relat'),
+    ('conditional', 'condit'), ('rational', 'ration'), ('valenci', 'valenc'),
+    ('hesitanci', 'hesit'), ('digitizer', 'digit'),
+    ('conformabli', 'conform'), ('radicalli', 'radic'),
+    ('differentli', 'differ'), ('vileli', 'vile'), ('analogousli', 'analog'),
+    ('vietnamization', 'vietnam'), ('predication', 'predic'),
+    ('operator', 'oper'), ('feudalism', 'feudal'), ('decisiveness', 'decis'),
+    ('hopefulness', 'hope'), ('callousness', 'callous'),
+    ('formaliti', 'formal'), ('sensitiviti', 'sensit'),
+    ('sensibiliti', 'sensibl'), ('triplicate', 'triplic'),
+    ('formative', 'form'), ('formalize', 'formal'), ('electriciti', 'electr'),
+    ('electrical', 'electr'), ('hopeful', 'hope'), ('goodness', 'good'),
+    ('revival', 'reviv'), ('allowance', 'allow'), ('inference', 'infer'),
+    ('airliner', 'airlin'), ('gyroscopic', 'gyroscop'),
+    ('adjustable', 'adjust'), ('defensible', 'defens'), ('irritant', 'irrit'),
+    ('replacement', 'replac'), ('adjustment', 'adjust'),
+    ('dependent', 'depend'), ('adoption', 'adopt'), ('homologou', 'homolog'),
+    ('communism', 'commun'), ('activate', 'activ'), ('angulariti', 'angular'),
+    ('homologous', 'homolog'), ('effective', 'effect'),
+    ('bowdlerize', 'bowdler'), ('probate', 'probat'), ('rate', 'rate'),
+    ('cease', 'ceas'), ('controll', 'control'), ('roll', 'roll'),
+    ('generalizations', 'gener'), ('oscillators', 'oscil'),
+]
+
+class TestPorterStem(unittest.TestCase):
+    def test_vocabulary(self):
+        for word, stem in VOCABULARY + PAPER:
+            with self.subTest(word=word):
+                self.assertEqual(porter_stem(word), stem)
+
+class TestAnalyze(unittest.TestCase):
+    def test_sorted_terms(self):
+        self.assertEqual(analyze('How do I reset my password?'),
+                         ('do', 'how', 'i', 'my', 'password', 'reset'))
+
+    def test_same_terms(self):
+        self.assertEqual(analyze('Resetting passwords'),
+                         analyze('password, reset!'))
+        for texts in SAME_TERMS:
+            with self.subTest(texts=texts):
+                self.assertEqual(len({analyze(text) for text in texts}), 1)
+
+    def test_folding(self):
+        self.assertEqual(analyze('Café résumé'), analyze('cafe resume'))
+        self.assertEqual(analyze('Café', stem=False), ('café',))
+
+    def test_joined_words_stay_one_term(self):
+        self.assertEqual(analyze("don't"), ("don't",))
+        self.assertEqual(analyze('3.14'), ('3.14',))
+        self.assertEqual(analyze('e.g.'), ('e.g',))
+        self.assertNotEqual(analyze('a,b'), analyze('a b'))
+
+    def test_unknown_characters(self):
+        for text in ['a \u00b1 b', 'thanks \U0001f642', 'cafe\u0301']:
+            with self.subTest(text=text):
+                self.assertIsNone(analyze(text))
+
+    def test_unstemmed(self):
+        self.assertEqual(analyze('Resetting Passwords', stem=False),
+                         ('passwords', 'resetting'))
+
+# analyzed exactly as ES does
+EXACT = [
+    'How do I reset my password?',
+    "Where are the employees' holidays?",
+    'Café, résumé and naïve façade',
+    'e-mail set-up: step 1 (of 3)',
+    'UPPER lower MiXeD',
+]
+# the emulation may keep apart what ES doesn't, but never the other way
+# round: texts with the same terms here must have the same terms in ES
+SAME_TERMS = [
+    ['How do I reset my password?', 'how DO i reset MY password',
+     'password reset, how do I... my'],
+    ["Don't the employees' holidays count?",
+     "don't the employees holidays count", "COUNT: don't the employees' holidays"],
+    ['Café résumé', 'cafe resume', 'CAFÉ RÉSUMÉ'],
+    ['the U.S. office', 'the u.s office'],
+    ['version 3.14 notes', 'notes, version 3.14'],
+]
+
+class TestElasticsearchParity(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        try:
+            from util import es
+            available = es.ping()
+        except Exception:
+            available = False
+        if not available:
+            raise unittest.SkipTest('elasticsearch is not reachable')
+        cls.es = es
+
+    def es_terms(self, text: str, stem: bool = True) -> List[str]:
+        # `myanalyzer` (see `recreate_index`) or the standard analyzer
+        if stem:
+            body = {'tokenizer': 'standard',
+                    'filter': ['asciifolding', 'lowercase', 'porter_stem']}
+        else:
+            body = {'analyzer': 'standard'}
+        body['text'] = text
+        tokens = self.es.indices.analyze(body=body)['tokens']
+        return sorted(token['token'] for token in tokens)
+
+    def test_exact(self):
+        for stem in [True, False]:
+            for text in EXACT:
+                with self.subTest(text=text, stem=stem):
+                    self.assertEqual(list(analyze(text, stem)),
+                                     self.es_terms(text, stem))
+
+    def test_same_terms(self):
+        for stem in [True, False]:
+            for texts in SAME_TERMS:
+                groups: Dict[Any,Set[Tuple[str,...]]] = {}
+                for text in texts:
+                    es_terms = tuple(self.es_terms(text, stem))
+                    groups.setdefault(analyze(text, stem), set()).add(es_terms)
+                for terms, es_terms in groups.items():
+                    with self.subTest(terms=terms, stem=stem):
+                        self.assertEqual(len(es_terms), 1)
+
+if __name__ == '__main__':
+    unittest.main()
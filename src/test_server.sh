@@ -29,6 +29,13 @@ test_read() {
     curl "localhost:8080/index?docId=*"
 }
 
+test_read_page() {
+    echo -e "\nread (paged, metadata only)"
+    curl "localhost:8080/index?docId=*&limit=2&meta=true"
+    echo -e "\nread (streamed)"
+    curl "localhost:8080/index?docId=*&stream=true"
+}
+
 test_delete() {
     echo -e "\ndelete"
     curl -XDELETE "localhost:8080/index?docId=$1" 
@@ -54,6 +61,7 @@ case "$1" in
     '-d') test_delete "__test.txt" ;;
     '-m') test_multi_update ;;
     '-r') test_read ;;
+    '-p') test_read_page ;;
 esac
 
 echo -e "\ndone"
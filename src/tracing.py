@@ -0,0 +1,197 @@
+# tracing.py
+"""
+Per-request trace spans, tail sampled, exported in Chrome trace format
+
+Each request gets a trace keyed by its uuid (see `trace_middleware` in
+server.py); code anywhere below the handler opens child spans with
+
+    with span('es search', 'es', index=index):
+        ...
+
+and waits for locks with `traced_lock`.  The current trace follows the
+request through awaits and into tasks it starts (a context variable), but
+not onto executor threads, so spans are opened around the awaits.
+
+When the request is done the whole trace is kept only if it was slow (at
+least `slow_s`) or errored, or for a small random `sample` of the rest;
+kept traces are written by a background thread, so requests never wait on
+the file.  The file is in the trace event format (a JSON array of complete
+events, one per line, with the closing bracket left off, which the format
+allows), so chrome://tracing, Perfetto or speedscope open it as is.  Each
+request shows up as its own thread, named after it.
+"""
+
+import itertools
+import json
+import os
+import queue
+import random
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+from asyncio import Lock
+
+from util import log
+
+# traces waiting for the writer thread, beyond this they're dropped
+EXPORT_QUEUE = 1000
+
+class Span:
+    name: str
+    cat: str
+    start: float
+    end: Optional[float]
+    args: Dict[str,Any]
+
+    def __init__(self, name: str, cat: str, args: Dict[str,Any]):
+        self.name = name
+        self.cat = cat
+        self.start = time.perf_counter()
+        self.end = None
+        self.args = args
+
+class Trace:
+    uuid: str
+    name: str
+    spans: List[Span]
+    error: bool
+    # wall clock time at perf_counter() == 0, to timestamp the events
+    epoch: float
+    # resets the current trace when the request is done
+    token: Any
+
+    def __init__(self, uuid: str, name: str):
+        self.uuid = uuid
+        self.name = name
+        self.spans = []
+        self.error = False
+        self.epoch = time.time() - time.perf_counter()
+        self.token = None
+
+    @property
+    def duration(self) -> float:
+        root = self.spans[0]
+        return (root.end or time.perf_counter()) - root.start
+
+    def events(self, pid: int, tid: int) -> List[Dict[str,Any]]:
+        """Trace event format: a thread name and a complete event per span."""
+        events: List[Dict[str,Any]] = [{
+            'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+            'args': {'name': f'{self.name} {self.uuid}'},
+        }]
+        for s in self.spans:
+            end = s.end if s.end is not None else s.start
+            events.append({
+                'name': s.name, 'cat': s.cat, 'ph': 'X', 'pid': pid, 'tid': tid,
+                'ts': round(1e6 * (self.epoch + s.start)),
+                'dur': round(1e6 * (end - s.start)),
+                'args': s.args,
+            })
+        return events
+
+current_trace: 'ContextVar[Optional[Trace]]' = ContextVar('current_trace', default=None)
+
+class span:
+    """Context manager timing a child span of the current trace (if any)."""
+    def __init__(self, name: str, cat: str = 'app', **args: Any):
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.span: Optional[Span] = None
+
+    def __enter__(self) -> Optional[Span]:
+        trace = current_trace.get()
+        # background tasks started by a request inherit its (finished) trace
+        if trace is not None and trace.spans[0].end is None:
+            self.span = Span(self.name, self.cat, self.args)
+            trace.spans.append(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.span is not None:
+            self.span.end = time.perf_counter()
+            if exc_type is not None:
+                self.span.args['error'] = repr(exc)
+
+class traced_lock:
+    """`async with` a lock, with the wait for it as a span."""
+    def __init__(self, lock: Lock, name: str):
+        self.lock = lock
+        self.name = name
+
+    async def __aenter__(self):
+        with span(f'lock {self.name}', 'lock'):
+            await self.lock.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.lock.release()
+
+class Tracer:
+    path: str
+    slow_s: float
+    sample: float
+    max_bytes: int
+    counts: Dict[str,int]
+
+    def __init__(self, path: str, slow_s: float, sample: float, max_bytes: int):
+        self.path = path
+        self.slow_s = slow_s
+        self.sample = sample
+        self.max_bytes = max_bytes
+        self.counts = {'traced': 0, 'kept': 0, 'dropped': 0}
+        self._queue: queue.Queue = queue.Queue(maxsize=EXPORT_QUEUE)
+        self._tids = itertools.count(1)
+        self._writer: Optional[threading.Thread] = None
+
+    def begin(self, uuid: str, name: str) -> Trace:
+        """Start the trace of a request, with its root span."""
+        trace = Trace(uuid, name)
+        trace.spans.append(Span(name, 'request', {'uuid': uuid}))
+        trace.token = current_trace.set(trace)
+        return trace
+
+    def end(self, trace: Trace, error: bool = False):
+        """Finish a trace, and keep it if it's slow, errored or sampled."""
+        trace.spans[0].end = time.perf_counter()
+        current_trace.reset(trace.token)
+        trace.error = trace.error or error
+        self.counts['traced'] += 1
+        if not (trace.error or trace.duration >= self.slow_s
+                or random.random() < self.sample):
+            return
+        trace.spans[0].args['error'] = trace.error
+        try:
+            self._queue.put_nowait(trace.events(os.getpid(), next(self._tids)))
+        except queue.Full:
+            self.counts['dropped'] += 1
+            return
+        self.counts['kept'] += 1
+        if self._writer is None:
+            self._writer = threading.Thread(
+                target=self._write_loop, name='trace-exporter', daemon=True
+            )
+            self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            events = self._queue.get()
+            try:
+                self._write(events)
+            except OSError as e:
+                log.error(f'trace not written: {e}')
+
+    def _write(self, events: List[Dict[str,Any]]):
+        if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+            os.replace(self.path, self.path + '.1')
+        new = not os.path.exists(self.path)
+        with open(self.path, 'a') as file:
+            if new:
+                file.write('[\n')
+            for event in events:
+                file.write(json.dumps(event) + ',\n')
+
+    def stats(self) -> Dict[str,Any]:
+        stats: Dict[str,Any] = dict(self.counts)
+        stats['queued'] = self._queue.qsize()
+        return stats
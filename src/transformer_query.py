@@ -1,44 +1,106 @@
 # test.py
 
+import asyncio
 from pprint import pprint
 from functools import partial
-from typing import List, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Union
 import re
 
 from transformers import AutoModelForQuestionAnswering, AutoTokenizer # type: ignore
 from transformers import QuestionAnsweringPipeline # type: ignore
 
-from util import INDEX_NAME
+from util import INDEX_NAME, MODEL_NAME, MAX_SEQ_LEN, MAX_QUESTION_LEN
+from util import INFERENCE_THREADS
 from util import answer_to_complete_sentence, print_paragraph, loop
 from create_index import get_paragraphs_for_query
 
-model_name = 'twmkn9/distilbert-base-uncased-squad2'
+model_name = MODEL_NAME
 
-tokenizer = AutoTokenizer.from_pretrained(model_name)
+def load_pipeline(name: str) -> QuestionAnsweringPipeline:
+    """Load a QA model (blocking, run it in an executor)."""
+    tokenizer_ = AutoTokenizer.from_pretrained(name)
+    model_ = AutoModelForQuestionAnswering.from_pretrained(name)
+    #model_.cuda()
+    model_.eval()
+    #return QuestionAnsweringPipeline(model=model_, tokenizer=tokenizer_, device=0)
+    return QuestionAnsweringPipeline(model=model_, tokenizer=tokenizer_, device=-1)
 
-# not currently used
-#
-# cpu_model = AutoModelForQuestionAnswering.from_pretrained(model_name)
-# cpu_pipeline = QuestionAnsweringPipeline(model=cpu_model, tokenizer=tokenizer)
+_pipeline: Optional[QuestionAnsweringPipeline] = None
 
-model = AutoModelForQuestionAnswering.from_pretrained(model_name)
-#model.cuda()
-model.eval()
-#pipeline = QuestionAnsweringPipeline(model=model, tokenizer=tokenizer, device=0)
-pipeline = QuestionAnsweringPipeline(model=model, tokenizer=tokenizer, device=-1)
+def get_pipeline() -> QuestionAnsweringPipeline:
+    """Pipeline of MODEL_NAME, loaded on first use.
+
+    Processes that answer with another model never load it.
+    """
+    global _pipeline
+    if _pipeline is None:
+        _pipeline = load_pipeline(model_name)
+    return _pipeline
+
+inference_pool = ThreadPoolExecutor(max_workers=INFERENCE_THREADS)
+
+async def run_pipeline(
+        question: str, context: str,
+        pipeline: Optional[QuestionAnsweringPipeline] = None,
+        pool: ThreadPoolExecutor = inference_pool,
+        ) -> Dict[str,Any]:
+    """Answer question from context on the inference thread(s).
+
+    Keeps the event loop free while the model runs, so other requests can
+    be retrieved, shed or timed out meanwhile.  The pipeline defaults to
+    MODEL_NAME's.
+    """
+    if pipeline is None:
+        pipeline = get_pipeline()
+    call = partial(pipeline, {'question': question, 'context': context},
+                   handle_impossible_answer=True,
+                   max_seq_len=MAX_SEQ_LEN,
+                   max_question_len=MAX_QUESTION_LEN,
+                   topk=1)
+    return await asyncio.get_running_loop().run_in_executor(pool, call)
+
+async def run_pipeline_batch(
+        question: Union[str,List[str]], contexts: List[str],
+        pipeline: Optional[QuestionAnsweringPipeline] = None,
+        pool: ThreadPoolExecutor = inference_pool,
+        ) -> List[Dict[str,Any]]:
+    """Answer question from each of contexts, in one call of the pipeline.
+
+    `question` may also be a list of questions, one per context.
+    """
+    if len(contexts) == 0:
+        return []
+    if pipeline is None:
+        pipeline = get_pipeline()
+    questions = [question] * len(contexts) if isinstance(question, str) else question
+    batch = [{'question': q, 'context': context}
+             for q, context in zip(questions, contexts)]
+    call = partial(pipeline, batch,
+                   handle_impossible_answer=True,
+                   max_seq_len=MAX_SEQ_LEN,
+                   max_question_len=MAX_QUESTION_LEN,
+                   topk=1)
+    answers = await asyncio.get_running_loop().run_in_executor(pool, call)
+    # the pipeline unwraps the answer to a batch of one
+    return [answers] if isinstance(answers, dict) else list(answers)
 
 def query(
         _query: str,
-        pipeline: QuestionAnsweringPipeline = pipeline,
+        pipeline: Optional[QuestionAnsweringPipeline] = None,
         topk=5,
         ):
     """query intended for use at the command line"""
+    if pipeline is None:
+        pipeline = get_pipeline()
     paragraph_coro = get_paragraphs_for_query(_query, INDEX_NAME, topk=topk)
     paragraphs: List[Dict[str,Any]] = loop.run_until_complete(paragraph_coro)
     for paragraph in paragraphs:
         context = paragraph['text']
         answer = pipeline({'question': _query, 'context': context},
                            handle_impossible_answer=True,
+                           max_seq_len=MAX_SEQ_LEN,
+                           max_question_len=MAX_QUESTION_LEN,
                            topk=1)
         if answer['answer'] == '':
             print('no answer found')
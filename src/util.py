@@ -2,10 +2,11 @@
 """
 Hodgepodge of utility functions and cross script dependencies
 """
+import os
 import re
 import sys
 from termcolor import colored
-from typing import List, Set, DefaultDict
+from typing import List, Optional, Set, DefaultDict
 from collections import defaultdict
 import asyncio
 from asyncio import Lock
@@ -20,6 +21,74 @@ from elasticsearch import Elasticsearch # type: ignore
 INDEX_NAME = 'site-txt-stem'
 ANALYZER_NAME = 'myanalyzer'
 SOURCE_DIR = './mono-qa-knowledge-base'
+# packed copy of SOURCE_DIR that search results are sliced from
+PACKED_DIR = './packed-knowledge-base'
+# searches cached by their analyzed terms (see retrieval_cache.py)
+RETRIEVAL_CACHE_SIZE = 10000
+# The knowledge base above is called DEFAULT_KB.  More can be served from
+# the same process, each with its own source dir and index, by listing them
+# in KB_CONFIG_PATH (see knowledge_base.py).
+DEFAULT_KB = 'default'
+KB_CONFIG_PATH = 'knowledge_bases.json'
+# derived state of the knowledge base by commit (see snapshots.py), the
+# SNAPSHOT_KEEP most recent are kept
+SNAPSHOT_DIR = './snapshots'
+SNAPSHOT_KEEP = 3
+# sampled request profiles (see profiling.py), the PROFILE_KEEP latest are
+# kept.  Requests with an `x-profile: <QA_PROFILE_TOKEN>` header are always
+# profiled.  Without the environment variable /admin/profiling is disabled.
+PROFILE_DIR = './profiles'
+PROFILE_KEEP = 200
+PROFILE_INTERVAL = 0.005
+PROFILE_TOKEN = os.environ.get('QA_PROFILE_TOKEN', None)
+# required (as an `x-admin-token` header) to load, activate, shadow or unload
+# models on POST /models.  Without the environment variable it is disabled.
+ADMIN_TOKEN = os.environ.get('QA_ADMIN_TOKEN', None)
+# request traces (see tracing.py): those taking TRACE_SLOW_S or more, those
+# that failed and TRACE_SAMPLE of the rest are written to TRACE_PATH
+TRACE_PATH = 'traces.json'
+TRACE_SLOW_S = 1.
+TRACE_SAMPLE = 0.01
+TRACE_MAX_BYTES = 64 * 2**20
+# every answered question is appended here
+QA_LOG_PATH = 'qa_log.multi_json'
+# precomputed answers (see answer_store.py), for the WARM_TOP_N most asked
+ANSWER_STORE_PATH = 'answers.sqlite3'
+WARM_TOP_N = 200
+
+# QA model, and the sequence lengths it is run with.  Docs are split into
+# passages at index time so that each one fits in a single forward pass
+# together with the question (see passages.py).
+MODEL_NAME = 'twmkn9/distilbert-base-uncased-squad2'
+MAX_SEQ_LEN = 384
+MAX_QUESTION_LEN = 64
+# tokens shared by consecutive passages of a doc
+PASSAGE_OVERLAP = 32
+# threads running the QA model (the pipeline isn't known to be thread safe)
+INFERENCE_THREADS = 1
+# With CONTEXT_WINDOWS, the model reads only the sentence of each passage
+# sharing the most terms with the question, and WINDOW_MARGIN sentences on
+# each side of it (see context_windows.py).  Passages shorter than
+# WINDOW_MIN_CHARS are read whole.
+CONTEXT_WINDOWS = False
+WINDOW_MARGIN = 1
+WINDOW_MIN_CHARS = 400
+
+# admission control for /question (see admission.py)
+MAX_IN_FLIGHT = 4
+MAX_QUEUED = 16
+# seconds a request may wait for an in-flight slot before being shed
+QUEUE_TIMEOUT = 0.5
+# seconds clients are told to wait before retrying a shed request
+RETRY_AFTER = 1
+# seconds to answer a question, clients may ask for less (or more, up to the
+# max) with the `x-request-timeout` header
+REQUEST_TIMEOUT = 10.
+MAX_REQUEST_TIMEOUT = 60.
+# background reindexing (see reindex_jobs.py): seconds without a new job
+# before a pass starts, and the longest a job waits for one
+REINDEX_DEBOUNCE = 2.
+REINDEX_MAX_DELAY = 30.
 
 es = Elasticsearch()
 named_locks: DefaultDict[str,Lock] = defaultdict(Lock)
@@ -28,6 +97,18 @@ loop = asyncio.get_event_loop()
 # Common Types:
 Paragraph = str
 
+def source_docs_lock(source_dir: str) -> Lock:
+    """Lock held while the files of a source dir are written or listed."""
+    return named_locks[f'source_docs:{source_dir}']
+
+def kb_path(path: str, kb: str) -> str:
+    """Per knowledge-base variant of a path ('answers.sqlite3' for the
+    default one, 'answers.<kb>.sqlite3' for the others)."""
+    if kb == DEFAULT_KB:
+        return path
+    root, ext = os.path.splitext(path)
+    return f'{root}.{kb}{ext}'
+
 #log_format = '[%(levelname)s]    %(filename)s:%(lineno)d:%(funcName)s  %(message)s'
 class LoggingFormatter(logging.Formatter):
     def format(self, record: logging.LogRecord) -> str:
@@ -95,20 +176,30 @@ def print_paragraph(paragraph: Paragraph, query: str, answer: str):
     if line != '': 
         print(' '*15 + highlight(line, query_tokens, 'red'))
 
+def normalize_question(question: str) -> str:
+    """Lowercased words of a question, for matching repeats of it."""
+    return ' '.join(re.findall(r'\w+', question.lower()))
+
 # TODO
 # make this suck less.
-def answer_to_complete_sentence(answer: str, paragraph: str) -> str:
+def answer_to_complete_sentence(
+        answer: str, paragraph: str, start: Optional[int] = None
+    ) -> str:
     r"""Convert an answer into a complete sentence.
 
     Given an answer extracted from a paragraph, return the complete sentence
     containing the answer.
     Right now a particularly naive approach is taken, simply looking for
-    either \n\n or . before and after the position where the answer is found.
+    either \n\n or . before and after the position where the answer is found
+    (`start`, if the model said, otherwise its first occurrence).
     """
     # We don't want to mess up the good work bert already did not finding the
     # answer.
     if answer == '': return ''
-    a_start = paragraph.find(answer)
+    if start is not None and paragraph.startswith(answer, start):
+        a_start = start
+    else:
+        a_start = paragraph.find(answer)
     if a_start == -1:
         # oh well...
         return answer